@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os import environ
+
+BACKFILL_WORKERS = int(environ.get('BACKFILL_WORKERS', 4))
+SLICE_SECONDS = 24 * 60 * 60
+
+
+class Backfill:
+    """Fetch a time range in slices on a pool of workers and ingest each slice as soon as it arrives.
+
+    fetch(since, until) returns the chunks of a slice resolved by DB.resolve_parents along with the fetched and
+    filtered counts of its votes. Slices are
+    checkpointed once their votes are inserted, so an interrupted backfill resumes with the slices left.
+    """
+
+    def __init__(self, db, fetch, workers=BACKFILL_WORKERS, slice_seconds=SLICE_SECONDS):
+        self.db = db
+        self.fetch = fetch
+        self.workers = workers
+        self.slice_seconds = slice_seconds
+        self.counts = {'fetched': 0, 'filtered': 0, 'inserted': 0, 'slices': 0}
+
+    def _ingest_next(self, futures):
+        """Insert the votes of the slices that have finished fetching."""
+        done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            since, until = futures.pop(future)
+            chunks, counts = future.result()
+            # sqlite has a single writer, so slices are inserted one at a time while the next ones are fetched
+            inserted = self.db.add_resolved_votes(chunks)
+            self.db.complete_backfill_slice(since, inserted)
+            self.counts['fetched'] += counts['fetched']
+            self.counts['filtered'] += counts['filtered']
+            self.counts['inserted'] += inserted
+            self.counts['slices'] += 1
+            print('Backfilled {} votes from {} to {}.'.format(inserted, since, until))
+
+    def run(self, since, until):
+        """Backfill every slice between since and until that is not done yet."""
+        slices = self.db.plan_backfill(since, until, self.slice_seconds)
+        print('Backfilling {} slices with {} workers...'.format(len(slices), self.workers))
+        futures = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            try:
+                for since, until in slices:
+                    futures[executor.submit(self.fetch, since, until)] = (since, until)
+                    # only fetch a little ahead of the inserts so fetched votes do not pile up
+                    if len(futures) >= self.workers * 2:
+                        self._ingest_next(futures)
+                while futures:
+                    self._ingest_next(futures)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return self.counts
@@ -1,18 +1,48 @@
+import os
 import re
+import json
 import praw
 import sqlite3
 import base36
+from itertools import islice
+from time import time, perf_counter
+from snapshots import build_snapshot
+from partitions import get_month, get_month_bounds, get_archive_name, get_archives, get_live_since, attach
 from pmaw import PushshiftAPI
 from prawcore.exceptions import ResponseException
 from enum import Enum
 from os import environ
 
 api = PushshiftAPI()
+_reddit = None
 
 REDDIT_CLIENT_ID = environ['REDDIT_CLIENT_ID']
 REDDIT_CLIENT_SECRET = environ['REDDIT_CLIENT_SECRET']
 REDDIT_USERNAME = environ['REDDIT_USERNAME']
 REDDIT_PASSWORD = environ['REDDIT_PASSWORD']
+DAY_IN_SECONDS = 86400
+HOUR_IN_SECONDS = 3600
+YEAR_IN_SECONDS = 31556926
+SNAPSHOT_HISTORY = 2
+SCHEMA_VERSION = 1
+INTERN_CHUNK_SIZE = 500
+
+# Covering indexes for every windowed query of the web app and the snapshots
+INDEXES = {
+    # ranks, bot counts and timelines
+    'idx_votes_timestamp_bot_vote': 'votes (timestamp, bot, vote)',
+    # subreddits
+    'idx_votes_timestamp_subreddit_vote': 'votes (timestamp, subreddit, vote)',
+    # vote counts and latest vote per vote type
+    'idx_votes_vote_timestamp': 'votes (vote, timestamp)',
+    # daily rollups of a window
+    'idx_bot_days_day': 'bot_days (day, bot, good_votes, bad_votes)',
+    'idx_sub_days_day': 'sub_days (day, subreddit, good_votes, bad_votes)',
+}
+OBSOLETE_INDEXES = ['idx_votes_timestamp', 'idx_votes_timestamp_bot']
+CHUNK_SIZE = 1000
+KARMA_TTL = 24 * 60 * 60
+VOTE_REGEX = re.compile(r'^(good|bad) bot.*', re.I)
 
 
 class VoteType(Enum):
@@ -23,8 +53,7 @@ class VoteType(Enum):
 
 def get_vote_type(body):
     """Return type of vote."""
-    regex = re.compile(r'^(good|bad) bot.*', re.I)
-    text = re.search(regex, body)
+    text = VOTE_REGEX.search(body)
     if text:
         vote = text.group(0).lower()
         if 'good bot' in vote:
@@ -43,20 +72,75 @@ def fxn(item):
     """Filter parent posts"""
     return 'author' in item
 
+
+def search_parents(ids, client=None):
+    """Get the parent comments with the ids from pushshift."""
+    return (client or api).search_comments(ids=ids, mem_safe=True, filter_fn=fxn)
+
+
+def get_reddit():
+    """Get the reddit client shared by every update."""
+    global _reddit
+    if _reddit is None:
+        _reddit = praw.Reddit(
+            client_id=REDDIT_CLIENT_ID,
+            client_secret=REDDIT_CLIENT_SECRET,
+            password=REDDIT_PASSWORD,
+            user_agent='mobile:botranker:0.1 (by /u/brandawg93)',
+            username=REDDIT_USERNAME)
+    return _reddit
+
+
+class Stage:
+    """Accumulated item count and run time of one ingest stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed += perf_counter() - self._start
+
+    @property
+    def rate(self):
+        return self.count / self.elapsed if self.elapsed else 0
+
+
 class DB:
-    def __init__(self, file, vacuum=False, debug=False):
+    def __init__(self, file, vacuum=False, debug=False, reddit=None):
         self.file = file
         self.conn = None
         self.debug = debug
+        self.vote_ids = None
+        self._reddit = reddit
+        self._ids = {}
         if vacuum:
             self._open()
             self._vacuum()
             self._close()
 
 
+    @property
+    def reddit(self):
+        if self._reddit is None:
+            self._reddit = get_reddit()
+        return self._reddit
+
     def _vacuum(self):
+        # only the live db is rewritten, archived months are never written again
         c = self.conn.cursor()
-        c.execute("VACUUM")
+        c.execute("VACUUM main")
+
+    def vacuum(self):
+        """Reclaim the space of the votes moved to archives."""
+        self._open()
+        self._vacuum()
+        self._close()
 
     def _check_if_exists(self, table):
         c = self.conn.cursor()
@@ -67,50 +151,420 @@ class DB:
         # if the count is 1, then table exists
         return c.fetchone()[0] == 1
 
-    def _create_votes_table(self):
+    def _check_if_column_exists(self, table, column):
+        c = self.conn.cursor()
+        c.execute("SELECT count(name) FROM pragma_table_info(?) WHERE name=?", [table, column])
+        return c.fetchone()[0] == 1
+
+    def _get_schema_version(self):
         c = self.conn.cursor()
+        c.execute("PRAGMA user_version")
+        return c.fetchone()[0]
 
-        # Create table
-        c.execute('''CREATE TABLE votes
-                     (bot text, 
-                     id text, 
-                     subreddit text, 
-                     timestamp INTEGER, 
-                     vote text, 
-                     author text)''')
+    def _create_votes_table(self, schema='main'):
+        c = self.conn.cursor()
 
-        c.execute("CREATE UNIQUE INDEX idx_votes_id ON votes (id)")
+        # Create table, the id is the integer value of the base36 comment id and vote is 1 for good and 0 for bad
+        c.execute('''CREATE TABLE {}.votes
+                     (id INTEGER PRIMARY KEY,
+                     bot INTEGER,
+                     subreddit INTEGER,
+                     author INTEGER,
+                     timestamp INTEGER,
+                     vote INTEGER)'''.format(schema))
 
     def _create_bots_table(self):
         c = self.conn.cursor()
 
         # Create table
-        c.execute("CREATE TABLE bots (bot text, comment_karma INTEGER, link_karma INTEGER)")
+        c.execute('''CREATE TABLE bots
+                     (id INTEGER PRIMARY KEY,
+                     bot text,
+                     comment_karma INTEGER,
+                     link_karma INTEGER,
+                     last_refreshed INTEGER)''')
 
         c.execute("CREATE UNIQUE INDEX idx_bots_bot ON bots (bot)")
 
-    def _filter_valid(self, vote):
-        """Filter existing votes."""
-        vote_type = get_vote_type(vote['body'])
-        if vote_type == VoteType.NONE:
-            return False
+    def _create_names_table(self, table):
+        c = self.conn.cursor()
+
+        # Create table of interned subreddit or author names
+        c.execute("CREATE TABLE {} (id INTEGER PRIMARY KEY, name text UNIQUE)".format(table))
+
+    def _create_bot_days_table(self, schema='main'):
         c = self.conn.cursor()
-        c.execute("SELECT count(id) from votes where id = ? LIMIT 1", [vote['id']])
-        return c.fetchone()[0] == 0
+
+        # Create table of per-bot daily vote counts
+        c.execute('''CREATE TABLE {}.bot_days
+                     (bot INTEGER,
+                     day INTEGER,
+                     good_votes INTEGER,
+                     bad_votes INTEGER,
+                     PRIMARY KEY (bot, day))'''.format(schema))
+        if schema != 'main':
+            return
+
+        # Keep the daily counts current for every vote inserted by the app or the web api
+        c.execute('''CREATE TRIGGER trg_votes_bot_days AFTER INSERT ON votes
+                     BEGIN
+                        INSERT INTO bot_days VALUES (NEW.bot, NEW.timestamp / {0}, NEW.vote, 1 - NEW.vote)
+                        ON CONFLICT (bot, day) DO UPDATE SET good_votes = good_votes + excluded.good_votes,
+                                                             bad_votes = bad_votes + excluded.bad_votes;
+                     END'''.format(DAY_IN_SECONDS))
+
+    def _create_sub_days_table(self, schema='main'):
+        c = self.conn.cursor()
+
+        # Create table of per-subreddit daily vote counts
+        c.execute('''CREATE TABLE {}.sub_days
+                     (subreddit INTEGER,
+                     day INTEGER,
+                     good_votes INTEGER,
+                     bad_votes INTEGER,
+                     PRIMARY KEY (subreddit, day))'''.format(schema))
+        if schema != 'main':
+            return
+
+        c.execute('''CREATE TRIGGER trg_votes_sub_days AFTER INSERT ON votes WHEN NEW.subreddit IS NOT NULL
+                     BEGIN
+                        INSERT INTO sub_days VALUES (NEW.subreddit, NEW.timestamp / {0}, NEW.vote, 1 - NEW.vote)
+                        ON CONFLICT (subreddit, day) DO UPDATE SET good_votes = good_votes + excluded.good_votes,
+                                                                   bad_votes = bad_votes + excluded.bad_votes;
+                     END'''.format(DAY_IN_SECONDS))
+
+    def _create_vote_hours_table(self, schema='main'):
+        c = self.conn.cursor()
+
+        # Create table of hourly vote counts that timelines are bucketed from
+        c.execute('''CREATE TABLE {}.vote_hours
+                     (hour INTEGER PRIMARY KEY,
+                     good_votes INTEGER,
+                     bad_votes INTEGER)'''.format(schema))
+        if schema != 'main':
+            return
+
+        # Only the bucket of the hour a vote was made in changes when it is inserted
+        c.execute('''CREATE TRIGGER trg_votes_vote_hours AFTER INSERT ON votes
+                     BEGIN
+                        INSERT INTO vote_hours VALUES (NEW.timestamp / {0}, NEW.vote, 1 - NEW.vote)
+                        ON CONFLICT (hour) DO UPDATE SET good_votes = good_votes + excluded.good_votes,
+                                                         bad_votes = bad_votes + excluded.bad_votes;
+                     END'''.format(HOUR_IN_SECONDS))
+
+    def _create_vote_total_table(self):
+        c = self.conn.cursor()
+
+        # Create table of the single running count of every vote, archived ones included
+        c.execute("CREATE TABLE vote_total (id INTEGER PRIMARY KEY CHECK (id = 0), votes INTEGER)")
+        c.execute("INSERT INTO vote_total VALUES (0, 0)")
+
+        # Archiving moves votes without changing the count, so only inserts update it
+        c.execute('''CREATE TRIGGER trg_votes_vote_total AFTER INSERT ON votes
+                     BEGIN
+                        UPDATE vote_total SET votes = votes + 1 WHERE id = 0;
+                     END''')
+
+    def _create_snapshots_table(self):
+        c = self.conn.cursor()
+
+        # Create table of precomputed results published for the web app
+        c.execute("CREATE TABLE snapshots (version INTEGER PRIMARY KEY, timestamp INTEGER, data text)")
+
+    def _create_ingest_metrics_table(self):
+        c = self.conn.cursor()
+
+        # Create table of ingest counters and gauges exposed by the web app's /metrics
+        c.execute("CREATE TABLE ingest_metrics (name text PRIMARY KEY, value REAL)")
+
+    def _create_backfill_slices_table(self):
+        c = self.conn.cursor()
+
+        # Create table of the time slices of a backfill, done once their votes are all inserted
+        c.execute('''CREATE TABLE backfill_slices
+                     (since INTEGER PRIMARY KEY,
+                     until INTEGER,
+                     done INTEGER DEFAULT 0,
+                     votes INTEGER,
+                     updated INTEGER)''')
+
+    def _create_partitions_table(self):
+        c = self.conn.cursor()
+
+        # Create table of the months archived to read-only files next to the live db
+        c.execute('''CREATE TABLE partitions
+                     (month text PRIMARY KEY,
+                     since INTEGER,
+                     until INTEGER,
+                     file text,
+                     votes INTEGER,
+                     archived INTEGER)''')
+
+    def _create_indexes(self, schema='main'):
+        """Create the managed indexes and drop the ones they replace."""
+        c = self.conn.cursor()
+        for name in OBSOLETE_INDEXES:
+            c.execute("DROP INDEX IF EXISTS {}.{}".format(schema, name))
+        for name, definition in INDEXES.items():
+            c.execute("CREATE INDEX IF NOT EXISTS {}.{} ON {}".format(schema, name, definition))
+
+    def _rebuild_bot_days(self):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM bot_days")
+        c.execute('''INSERT INTO bot_days
+                     SELECT bot,
+                            timestamp / ? as day,
+                            sum(vote),
+                            count(*) - sum(vote)
+                     FROM votes
+                     GROUP BY bot, day''', [DAY_IN_SECONDS])
+        self._restore_archived('bot_days')
+
+    def _rebuild_sub_days(self):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM sub_days")
+        c.execute('''INSERT INTO sub_days
+                     SELECT subreddit,
+                            timestamp / ? as day,
+                            sum(vote),
+                            count(*) - sum(vote)
+                     FROM votes
+                     WHERE subreddit IS NOT NULL
+                     GROUP BY subreddit, day''', [DAY_IN_SECONDS])
+        self._restore_archived('sub_days')
+
+    def _rebuild_vote_hours(self):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM vote_hours")
+        c.execute('''INSERT INTO vote_hours
+                     SELECT timestamp / ? as hour,
+                            sum(vote),
+                            count(*) - sum(vote)
+                     FROM votes
+                     GROUP BY hour''', [HOUR_IN_SECONDS])
+        self._restore_archived('vote_hours')
+
+    def _rebuild_vote_total(self):
+        # bot_days already holds the counts of the archives
+        c = self.conn.cursor()
+        c.execute("UPDATE vote_total SET votes = (SELECT coalesce(sum(good_votes + bad_votes), 0) FROM bot_days)")
+
+    def _restore_archived(self, rollup):
+        """Add the frozen rows of a rollup carried by every archive to the live db."""
+        for month, since, until, file in get_archives(self.conn):
+            # sqlite cannot attach a database in the middle of a transaction
+            self.conn.commit()
+            with attach(self.conn, file) as schema:
+                self.conn.execute("INSERT INTO {0} SELECT * FROM {1}.{0}".format(rollup, schema))
+                self.conn.commit()
+
+    def _migrate_to_v1(self):
+        """Move text votes into the integer coded schema."""
+        print('Migrating db to schema version 1...')
+        c = self.conn.cursor()
+        self.conn.create_function("base36_id", 1, lambda x: int(x, 36) if x else None)
+        c.execute("BEGIN")
+        if not self._check_if_column_exists('bots', 'last_refreshed'):
+            c.execute("ALTER TABLE bots ADD COLUMN last_refreshed INTEGER")
+        c.execute("ALTER TABLE votes RENAME TO votes_v0")
+        c.execute("ALTER TABLE bots RENAME TO bots_v0")
+        c.execute("DROP TABLE IF EXISTS bot_days")
+        c.execute("DROP TABLE IF EXISTS vote_hours")
+        c.execute("DROP INDEX IF EXISTS idx_votes_id")
+        c.execute("DROP INDEX IF EXISTS idx_votes_timestamp")
+        c.execute("DROP INDEX IF EXISTS idx_bots_bot")
+        self._create_votes_table()
+        self._create_bots_table()
+        self._create_names_table('subreddits')
+        self._create_names_table('authors')
+
+        c.execute('''INSERT INTO bots (bot, comment_karma, link_karma, last_refreshed)
+                     SELECT bot, comment_karma, link_karma, last_refreshed FROM bots_v0''')
+        c.execute("INSERT OR IGNORE INTO bots (bot) SELECT DISTINCT bot FROM votes_v0 WHERE bot IS NOT NULL")
+        c.execute('''INSERT OR IGNORE INTO subreddits (name)
+                     SELECT DISTINCT subreddit FROM votes_v0 WHERE subreddit != ''
+                  ''')
+        c.execute("INSERT OR IGNORE INTO authors (name) SELECT DISTINCT author FROM votes_v0 WHERE author IS NOT NULL")
+        c.execute('''INSERT OR IGNORE INTO votes (id, bot, subreddit, author, timestamp, vote)
+                     SELECT base36_id(v.id), b.id, s.id, a.id, v.timestamp, v.vote = 'G'
+                     FROM votes_v0 v
+                     INNER JOIN bots b ON b.bot = v.bot
+                     LEFT JOIN subreddits s ON s.name = v.subreddit
+                     LEFT JOIN authors a ON a.name = v.author''')
+        c.execute("DROP TABLE votes_v0")
+        c.execute("DROP TABLE bots_v0")
+        c.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        self.conn.commit()
 
     def create_tables(self):
-        """Create necessary tables if they do not exist."""
+        """Create necessary tables if they do not exist and migrate old ones."""
         self._open()
+        if self._check_if_exists('votes') and self._get_schema_version() < 1:
+            self._migrate_to_v1()
         if not self._check_if_exists('votes'):
             self._create_votes_table()
+            self.conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
         if not self._check_if_exists('bots'):
             self._create_bots_table()
+        if not self._check_if_exists('subreddits'):
+            self._create_names_table('subreddits')
+        if not self._check_if_exists('authors'):
+            self._create_names_table('authors')
+        if not self._check_if_exists('bot_days'):
+            self._create_bot_days_table()
+            self._rebuild_bot_days()
+        if not self._check_if_exists('partitions'):
+            self._create_partitions_table()
+        if not self._check_if_exists('vote_hours'):
+            self._create_vote_hours_table()
+            self._rebuild_vote_hours()
+        if not self._check_if_exists('sub_days'):
+            self._create_sub_days_table()
+            self._rebuild_sub_days()
+        if not self._check_if_exists('vote_total'):
+            self._create_vote_total_table()
+            self._rebuild_vote_total()
+        if not self._check_if_exists('snapshots'):
+            self._create_snapshots_table()
+        if not self._check_if_exists('ingest_metrics'):
+            self._create_ingest_metrics_table()
+        if not self._check_if_exists('backfill_slices'):
+            self._create_backfill_slices_table()
+        self._create_indexes()
         self._close()
 
+    def rebuild_rollups(self):
+        """Recompute the daily and hourly vote counts and the total from the live votes and the rollups of the archives."""
+        self._open()
+        self._rebuild_bot_days()
+        self._rebuild_sub_days()
+        self._rebuild_vote_hours()
+        self._rebuild_vote_total()
+        self._close()
+
+    def _archive_month(self, month):
+        """Copy the votes and rollups of a month to a new archive, then drop its votes from the live db."""
+        since, until = get_month_bounds(month)
+        file = get_archive_name(self.file, month)
+        path = os.path.join(os.path.dirname(self.file), file)
+        if os.path.exists(path):
+            # left behind by an archive that did not finish, so the month is still in the live db
+            os.chmod(path, 0o644)
+            os.remove(path)
+        c = self.conn.cursor()
+        self.conn.commit()
+        c.execute("ATTACH DATABASE ? AS archive", [path])
+        try:
+            self._create_votes_table('archive')
+            self._create_bot_days_table('archive')
+            self._create_sub_days_table('archive')
+            self._create_vote_hours_table('archive')
+            c.execute('''INSERT INTO archive.votes SELECT * FROM votes WHERE timestamp >= ? AND timestamp < ?
+                         ORDER BY id''', [since, until])
+            votes = c.rowcount
+            c.execute("INSERT INTO archive.bot_days SELECT * FROM bot_days WHERE day >= ? AND day < ?",
+                      [since // DAY_IN_SECONDS, until // DAY_IN_SECONDS])
+            c.execute("INSERT INTO archive.sub_days SELECT * FROM sub_days WHERE day >= ? AND day < ?",
+                      [since // DAY_IN_SECONDS, until // DAY_IN_SECONDS])
+            c.execute("INSERT INTO archive.vote_hours SELECT * FROM vote_hours WHERE hour >= ? AND hour < ?",
+                      [since // HOUR_IN_SECONDS, until // HOUR_IN_SECONDS])
+            self._create_indexes('archive')
+            self.conn.commit()
+        finally:
+            c.execute("DETACH DATABASE archive")
+        # closed months are never written again
+        os.chmod(path, 0o444)
+
+        # the archive only counts once its votes have left the live db
+        c.execute("INSERT INTO partitions VALUES (?, ?, ?, ?, ?, ?)", [month, since, until, file, votes, int(time())])
+        c.execute("DELETE FROM votes WHERE timestamp >= ? AND timestamp < ?", [since, until])
+        self.conn.commit()
+        print('Archived {} votes of {} to {}.'.format(votes, month, file))
+        return month
+
+    def archive_months(self, before):
+        """Move every month that ended before a timestamp out of the live db into its own read-only file.
+
+        The rollups of archived months stay in the live db, so windowed queries only read the raw votes of an
+        archive for the first day of a window and for the hot sort. Vacuuming only rewrites the live db.
+        """
+        self._open()
+        archived = []
+        c = self.conn.cursor()
+        c.execute("SELECT min(timestamp) FROM votes")
+        first = c.fetchone()[0]
+        month = get_month(max(first, get_live_since(self.conn))) if first is not None else None
+        while month and get_month_bounds(month)[1] <= before:
+            archived.append(self._archive_month(month))
+            month = get_month(get_month_bounds(month)[1])
+        self._close()
+        return archived
+
+    def get_live_since(self):
+        """Get the time the live partition starts at, votes before it belong to read-only archives."""
+        self._open()
+        since = get_live_since(self.conn)
+        self._close()
+        return since
+
+    def publish_snapshot(self):
+        """Compute the standard windows and publish them as a new snapshot version."""
+        self._open()
+        self.conn.create_function("power", 2, lambda x, y: x ** y)
+        data = json.dumps(build_snapshot(self.conn), separators=(',', ':'))
+        c = self.conn.cursor()
+        c.execute("INSERT INTO snapshots (timestamp, data) VALUES (?, ?)", [int(time()), data])
+        version = c.lastrowid
+        c.execute("DELETE FROM snapshots WHERE version <= ?", [version - SNAPSHOT_HISTORY])
+        self._close()
+        return version
+
+    def record_ingest(self, counters, gauges):
+        """Add to the ingest counters and replace the gauges."""
+        self._open()
+        c = self.conn.cursor()
+        c.executemany('''INSERT INTO ingest_metrics VALUES (?, ?)
+                         ON CONFLICT (name) DO UPDATE SET value = value + excluded.value''', counters.items())
+        c.executemany("INSERT OR REPLACE INTO ingest_metrics VALUES (?, ?)", gauges.items())
+        self._close()
+
+    def plan_backfill(self, since, until, slice_seconds):
+        """Get the (since, until) slices between since and until that have not been backfilled yet."""
+        # slices are aligned to their length so a later run with a new until resumes the same ones
+        first = since // slice_seconds * slice_seconds
+        self._open()
+        c = self.conn.cursor()
+        c.executemany("INSERT OR IGNORE INTO backfill_slices (since, until) VALUES (?, ?)",
+                      [[start, start + slice_seconds] for start in range(first, until, slice_seconds)])
+        c.execute("SELECT since, until FROM backfill_slices WHERE done = 0 AND since >= ? AND since < ? ORDER BY since",
+                  [first, until])
+        slices = c.fetchall()
+        self._close()
+        return slices
+
+    def complete_backfill_slice(self, since, votes):
+        self._open()
+        self.conn.execute("UPDATE backfill_slices SET done = 1, votes = ?, updated = ? WHERE since = ?",
+                          [votes, int(time()), since])
+        self._close()
+
+    def load_vote_ids(self, timestamp):
+        """Load the ids of votes since timestamp so new votes can be deduplicated in memory."""
+        self._open()
+        c = self.conn.cursor()
+        c.execute("SELECT id from votes where timestamp >= ?", [timestamp])
+        self.vote_ids = set(row[0] for row in c)
+        self._close()
+        return self.vote_ids
+
+    def is_new_vote(self, vote):
+        """Check if a vote has not been added yet."""
+        return self.vote_ids is None or int(vote['id'], 36) not in self.vote_ids
+
     def get_last_updated_timestamp(self):
         self._open()
         c = self.conn.cursor()
-        c.execute("SELECT timestamp from votes order by id DESC LIMIT 1")
+        c.execute("SELECT max(timestamp) from votes")
         query = c.fetchone()
         self._close()
         if query and len(query) > 0:
@@ -118,78 +572,162 @@ class DB:
         else:
             return None
 
-    def add_bots(self, parents):
-        """Add bots to db."""
+    def get_vote_total(self):
+        """Get the running count of every vote, whoever inserted it."""
         self._open()
         c = self.conn.cursor()
-        r = praw.Reddit(
-            client_id=REDDIT_CLIENT_ID,
-            client_secret=REDDIT_CLIENT_SECRET,
-            password=REDDIT_PASSWORD,
-            user_agent='mobile:botranker:0.1 (by /u/brandawg93)',
-            username=REDDIT_USERNAME)
+        c.execute("SELECT votes FROM vote_total WHERE id = 0")
+        (total,) = c.fetchone()
+        self._close()
+        return total
 
-        for bot in r.redditors.partial_redditors(ids=parents):
-            try:
-                # Insert a row of data
-                data = [str(bot.name), bot.comment_karma, bot.link_karma]
-                c.execute("INSERT INTO bots VALUES (?, ?, ?)", data)
-                if self.debug:
-                    print('Adding bot {} with comment karma={}, link karma={}.'.format(bot.name, bot.comment_karma,
-                                                                                        bot.link_karma))
-            except sqlite3.IntegrityError:
-                data = [bot.comment_karma, bot.link_karma, str(bot.name)]
-                c.execute("UPDATE bots SET comment_karma = ?, link_karma = ? WHERE bot = ?", data)
-                if self.debug:
-                    print('Updating bot {} with comment karma={}, link karma={}.'.format(bot.name, bot.comment_karma,
-                                                                                            bot.link_karma))
+    def _get_stale_bots(self, names, ttl=KARMA_TTL):
+        """Get the bots whose karma is missing or older than ttl."""
+        c = self.conn.cursor()
+        unique = list(set(names))
+        fresh = set()
+        # only the asked for bots are read, through the unique index on bot
+        for i in range(0, len(unique), INTERN_CHUNK_SIZE):
+            chunk = unique[i:i + INTERN_CHUNK_SIZE]
+            c.execute("SELECT bot FROM bots WHERE bot IN ({}) AND last_refreshed >= ?".format(
+                ', '.join('?' * len(chunk))), chunk + [int(time()) - ttl])
+            fresh.update(row[0] for row in c)
+        return [name for name in names if name not in fresh]
 
-            except Exception as e:
-                print(e)
-        
+    def add_bots(self, parents):
+        """Add or refresh the karma of bots that are stale."""
+        self._open()
+        c = self.conn.cursor()
+        stale = set(self._get_stale_bots(parents.values()))
+        ids = [fullname for fullname, name in parents.items() if name in stale]
+        now = int(time())
+        rows = []
+        if ids:
+            # partial_redditors looks the bots up 100 ids per request
+            for bot in self.reddit.redditors.partial_redditors(ids=ids):
+                try:
+                    rows.append([str(bot.name), bot.comment_karma, bot.link_karma, now])
+                    if self.debug:
+                        print('Refreshing bot {} with comment karma={}, link karma={}.'.format(bot.name,
+                                                                                               bot.comment_karma,
+                                                                                               bot.link_karma))
+                except Exception as e:
+                    print(e)
+        c.executemany('''INSERT INTO bots (bot, comment_karma, link_karma, last_refreshed) VALUES (?, ?, ?, ?)
+                         ON CONFLICT (bot) DO UPDATE SET comment_karma = excluded.comment_karma,
+                                                         link_karma = excluded.link_karma,
+                                                         last_refreshed = excluded.last_refreshed''', rows)
+        print('Refreshed karma of {} of {} bots.'.format(len(rows), len(parents)))
         self._close()
 
-    def add_votes(self, votes):
-        """Add votes to db."""
-        updates = 0
-        votes_lst = list(map(generate_parent, votes))
-        parents = list(api.search_comments(ids=[l['parent_id'] for l in votes_lst], mem_safe=True, filter_fn=fxn))
-        self._open()
+    def _intern(self, table, column, names):
+        """Get the ids of names in a dimension table, adding the missing ones."""
+        ids = self._ids.setdefault(table, {})
+        missing = list(set(name for name in names if name and name not in ids))
         c = self.conn.cursor()
-        for vote in votes_lst:
+        c.executemany("INSERT OR IGNORE INTO {} ({}) VALUES (?)".format(table, column), [[name] for name in missing])
+        for i in range(0, len(missing), INTERN_CHUNK_SIZE):
+            chunk = missing[i:i + INTERN_CHUNK_SIZE]
+            c.execute("SELECT id, {1} FROM {0} WHERE {1} IN ({2})".format(table, column, ', '.join('?' * len(chunk))),
+                      chunk)
+            ids.update((name, row_id) for row_id, name in c)
+        return ids
+
+    def _votes_to_rows(self, votes, parents):
+        """Join votes with their parents into rows for the votes table."""
+        votes_lst = []
+        for vote in votes:
             try:
-                parent = next((p for p in parents if p['id'] == vote['parent_id']), None)
+                parent = parents.get(vote['parent_id'])
                 if parent:
-                    try:
-                        vote_type = get_vote_type(vote['body'])
-                        # Insert a row of data
-                        c.execute("INSERT INTO votes VALUES (?, ?, ?, ?, ?, ?)",
-                                    [parent['author'],
-                                    vote['id'],
-                                    vote['subreddit'],
-                                    vote['created_utc'],
-                                    vote_type.name[0],
-                                    vote['author']
-                                    ])
-                        updates += 1
-                        if self.debug:
-                            print('Adding vote with id={}, bot={}, vote={}.'.format(vote['id'],
-                                                                                    parent['author'],
-                                                                                    vote_type.name[0]))
-
-                    except sqlite3.IntegrityError:
-                        pass
+                    votes_lst.append((vote, parent['author'], int(get_vote_type(vote['body']) == VoteType.GOOD)))
             except Exception as e:
                 print(e)
+
+        bots = self._intern('bots', 'bot', [bot for vote, bot, flag in votes_lst])
+        subreddits = self._intern('subreddits', 'name', [vote.get('subreddit') for vote, bot, flag in votes_lst])
+        authors = self._intern('authors', 'name', [vote.get('author') for vote, bot, flag in votes_lst])
+        rows = []
+        for vote, bot, flag in votes_lst:
+            rows.append([int(vote['id'], 36),
+                         bots[bot],
+                         subreddits.get(vote.get('subreddit')),
+                         authors.get(vote.get('author')),
+                         vote['created_utc'],
+                         flag
+                         ])
+        return rows
+
+    def resolve_parents(self, votes, chunk_size=CHUNK_SIZE, get_parents=search_parents, stages=None):
+        """Yield chunks of votes with their parent comments. The db is not touched, so any thread can resolve.
+
+        get_parents(ids) gets the parent comments with the ids.
+        """
+        stages = stages or {'votes': Stage(), 'parents': Stage()}
+        votes = iter(votes)
+        while True:
+            with stages['votes'] as stage:
+                chunk = [generate_parent(vote) for vote in islice(votes, chunk_size)]
+                stage.count += len(chunk)
+            if not chunk:
+                return
+
+            with stages['parents'] as stage:
+                parents = {}
+                for parent in get_parents([vote['parent_id'] for vote in chunk]):
+                    if fxn(parent):
+                        parents[parent['id']] = parent
+                stage.count += len(parents)
+            yield chunk, parents
+
+    def add_votes(self, votes, chunk_size=CHUNK_SIZE, get_parents=search_parents):
+        """Add votes to db one chunk at a time."""
+        stages = {'votes': Stage(), 'parents': Stage(), 'inserts': Stage()}
+        return self.add_resolved_votes(self.resolve_parents(votes, chunk_size, get_parents, stages), stages)
+
+    def add_resolved_votes(self, chunks, stages=None):
+        """Add chunks of votes along with their resolved parents to db."""
+        updates = 0
+        unique_bots = {}
+        stages = stages or {'inserts': Stage()}
+        self._open()
+        c = self.conn.cursor()
+        live_since = get_live_since(self.conn)
+        archived = 0
+        for chunk, parents in chunks:
+            for parent in parents.values():
+                if 'author_fullname' in parent:
+                    unique_bots[parent['author_fullname']] = parent['author']
+
+            with stages['inserts'] as stage:
+                rows = self._votes_to_rows(chunk, parents)
+                # archived months are immutable, so their late votes are dropped
+                archived += len(rows)
+                rows = [row for row in rows if row[4] >= live_since]
+                archived -= len(rows)
+                # existing ids are skipped by the unique index
+                c.executemany('''INSERT OR IGNORE INTO votes (id, bot, subreddit, author, timestamp, vote)
+                                 VALUES (?, ?, ?, ?, ?, ?)''', rows)
+                self.conn.commit()
+                if self.vote_ids is not None:
+                    self.vote_ids.update(row[0] for row in rows)
+                stage.count += c.rowcount
+                updates += c.rowcount
+            if self.debug:
+                print('Added {} of {} votes in chunk.'.format(c.rowcount, len(chunk)))
         self._close()
+        if archived:
+            print('Dropped {} votes of archived months.'.format(archived))
+
+        for name, stage in stages.items():
+            print('Processed {} {} in {:.2f}s ({:.0f}/s).'.format(stage.count, name, stage.elapsed, stage.rate))
 
-        unique_bots = set([parent['author_fullname'] for parent in parents if 'author_fullname' in parent])
         self.add_bots(unique_bots)
         return updates
 
     def _open(self):
-        # open the connection
-        self.conn = sqlite3.connect(self.file)
+        # open the connection, uris open archives read-only
+        self.conn = sqlite3.connect(self.file, uri=True)
 
     def _close(self):
         # commit the changes to db
@@ -0,0 +1,184 @@
+import asyncio
+import random
+import signal
+from datetime import datetime
+from os import environ
+from time import time, perf_counter
+from db import VOTE_REGEX, YEAR_IN_SECONDS
+from partitions import ARCHIVE_DELAY
+
+POLL_INTERVAL = float(environ.get('POLL_INTERVAL', 10))
+MAX_POLL_INTERVAL = 5 * 60
+# Sources index comments a little late, so every poll also looks this far behind the newest vote seen
+OVERLAP_SECONDS = 5 * 60
+BATCH_SIZE = 500
+MAX_INFLIGHT = 4
+PUBLISH_INTERVAL = 60
+
+
+def make_filter(db, counts, seen=()):
+    """Filter votes that are valid and not in the db yet, counting the fetched and filtered out ones."""
+    def fxn(item):
+        counts['fetched'] += 1
+        valid = item['parent_id'] is not None and VOTE_REGEX.search(item['body']) is not None and \
+            db.is_new_vote(item) and item['id'] not in seen
+        if not valid:
+            counts['filtered'] += 1
+        return valid
+    return fxn
+
+
+class Ingester:
+    """Poll a source for the votes after a high watermark and insert them as they arrive.
+
+    Polling speeds up while votes keep coming and backs off while the source is quiet or failing. Polled votes
+    wait in a bounded queue of batches for the single writer, which also publishes a snapshot at most every
+    publish_interval once the vote total has moved, so votes added by the web api or a backfill are published
+    too. stop() lets the batches that were already polled finish first.
+    """
+
+    def __init__(self, db, source, interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, batch_size=BATCH_SIZE,
+                 max_inflight=MAX_INFLIGHT, publish_interval=PUBLISH_INTERVAL):
+        self.db = db
+        self.source = source
+        self.interval = interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.publish_interval = publish_interval
+        self.max_inflight = max_inflight
+        self.watermark = None
+        self._queue = None
+        self._stopping = None
+        # ids of the comments polled within the overlap, so they are only processed once
+        self._seen = {}
+        # the vote total of the last published snapshot
+        self._published_total = None
+        self._published = perf_counter()
+
+    def stop(self):
+        if self._stopping and not self._stopping.is_set():
+            print('Stopping after the polled votes are ingested...')
+            self._stopping.set()
+
+    async def _sleep(self, seconds):
+        """Sleep until the next poll unless stopped first."""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def _see(self, comments):
+        self._seen.update((comment['id'], comment['created_utc']) for comment in comments)
+        cutoff = self.watermark - OVERLAP_SECONDS
+        self._seen = {comment_id: created for comment_id, created in self._seen.items() if created >= cutoff}
+
+    async def _poll(self):
+        """Queue the votes of each poll in batches until stopped."""
+        interval = self.interval
+        while not self._stopping.is_set():
+            start = perf_counter()
+            try:
+                comments = await asyncio.to_thread(self.source.get_votes, self.watermark - OVERLAP_SECONDS)
+            except Exception as e:
+                interval = min(interval * 2, self.max_interval)
+                print('Could not poll for votes, retrying in {:.0f}s: {}'.format(interval, e))
+            else:
+                counts = {'fetched': 0, 'filtered': 0}
+                votes = list(filter(make_filter(self.db, counts, self._seen), comments))
+                self.watermark = max([self.watermark] + [comment['created_utc'] for comment in comments])
+                self._see(comments)
+                batches = [votes[i:i + self.batch_size] for i in range(0, len(votes), self.batch_size)] or [[]]
+                for i, batch in enumerate(batches):
+                    # waits while max_inflight batches are queued
+                    await self._queue.put((batch, counts if i == 0 else None, start))
+                # poll right away while votes keep coming and twice as late each time nothing new came
+                interval = self.interval if votes else min(interval * 2, self.max_interval)
+            await self._sleep(interval * random.uniform(0.9, 1.1))
+        await self._queue.put(None)
+
+    async def _insert(self, votes):
+        try:
+            return await asyncio.to_thread(self.db.add_votes, votes, get_parents=self.source.get_parents)
+        except Exception:
+            # votes that were not inserted are polled again while they are within the overlap
+            for vote in votes:
+                self._seen.pop(vote['id'], None)
+            raise
+
+    def _publish(self):
+        """Publish a snapshot if any vote was added since the last one."""
+        total = self.db.get_vote_total()
+        if total == self._published_total:
+            return
+        # months are closed once their late votes have had time to arrive
+        self.db.archive_months(int(time()) - ARCHIVE_DELAY)
+        version = self.db.publish_snapshot()
+        # the votes seen since the last publish are in the db, so only the overlap has to stay in memory
+        self.db.load_vote_ids(self.watermark - OVERLAP_SECONDS)
+        print('db updated at {} with {} updates, published snapshot {}.'.format(
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'), total - (self._published_total or 0), version))
+        self._published_total = total
+        self._published = perf_counter()
+
+    async def _publish_if_due(self):
+        if perf_counter() - self._published >= self.publish_interval:
+            await asyncio.to_thread(self._publish)
+
+    def _record(self, counts, inserted, start):
+        counters = {'ingest_votes_inserted_total': inserted}
+        if counts is not None:
+            counters.update({'ingest_votes_fetched_total': counts['fetched'],
+                             'ingest_votes_filtered_total': counts['filtered'],
+                             'ingest_cycles_total': 1})
+        self.db.record_ingest(counters, {'ingest_last_cycle_seconds': round(perf_counter() - start, 3),
+                                         'ingest_last_cycle_timestamp': int(time()),
+                                         'ingest_lag_seconds': int(time()) - self.watermark})
+
+    async def _ingest(self):
+        """Insert the queued batches one at a time until the poller is done."""
+        while True:
+            try:
+                item = await asyncio.wait_for(self._queue.get(), self.publish_interval)
+            except asyncio.TimeoutError:
+                # votes added by the web api or a backfill are published while the source is quiet too
+                try:
+                    await self._publish_if_due()
+                except Exception as e:
+                    print('Could not publish: {}'.format(e))
+                continue
+            if item is None:
+                break
+            votes, counts, start = item
+            inserted = 0
+            try:
+                if votes:
+                    inserted = await self._insert(votes)
+                await asyncio.to_thread(self._record, counts, inserted, start)
+                await self._publish_if_due()
+            except Exception as e:
+                print('Could not ingest {} votes: {}'.format(len(votes), e))
+        await asyncio.to_thread(self._publish)
+
+    async def run(self):
+        """Ingest until stop() is called or the process is interrupted or terminated."""
+        self._queue = asyncio.Queue(maxsize=self.max_inflight)
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # signal handlers can only be added on unix from the main thread
+                pass
+        self.watermark = await asyncio.to_thread(self.db.get_last_updated_timestamp) or \
+            int(time()) - YEAR_IN_SECONDS
+        await asyncio.to_thread(self.db.load_vote_ids, self.watermark - OVERLAP_SECONDS)
+        print('Ingesting votes since {}...'.format(self.watermark - OVERLAP_SECONDS))
+        try:
+            await asyncio.gather(self._poll(), self._ingest())
+        finally:
+            for sig in [signal.SIGINT, signal.SIGTERM]:
+                try:
+                    loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
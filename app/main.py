@@ -1,69 +1,99 @@
 from pmaw import PushshiftAPI
-from db import DB
+from db import DB, YEAR_IN_SECONDS
+from partitions import ARCHIVE_DELAY
+from backfill import Backfill
+from ingester import Ingester, make_filter
+from sources import PushshiftSource, HttpSource, FileSource, get_votes
 from datetime import datetime
-from time import sleep, time
-import re
+from time import time, perf_counter
+import asyncio
 import sys
 
 api = PushshiftAPI()
 
-UPDATE_INTERVAL = 10
-YEAR_IN_SECONDS = 31556926
 DB_FILE = '../votes.db'
 
-def fxn(item):
-        regex = re.compile(r'^(good|bad) bot.*', re.I)
-        text = re.search(regex, item['body'])
-        db = DB(DB_FILE)
-        db._open()
-        valid = db._filter_valid(item)
-        db._close()
-        return text is not None and valid and item['parent_id'] is not None
-
-
-def search_pushshift(q, timestamp):
-    """Search pushshift for specific criteria."""
-    fields = ['author', 'body', 'created_utc', 'id', 'link_id', 'parent_id', 'subreddit']
-    if not timestamp:
-        return api.search_comments(q=q, search_window=365, filter=fields, mem_safe=True, filter_fn=fxn)
-    return api.search_comments(q=q, since=timestamp, filter=fields, mem_safe=True, filter_fn=fxn)
-
-
-def get_votes(timestamp):
-    """Get last timestamp worth of votes."""
-    query = '"good bot"|"bad bot"'
-    return search_pushshift(query, timestamp)
-
-
-def update_db():
-    try:
-        backfill = '--backfill' in sys.argv
-        vacuum = '--vacuum' in sys.argv
-        last_update = None
-        db = DB(DB_FILE, vacuum=vacuum, debug=backfill)
-        db.create_tables()
-
-        if backfill:
-            print('Backfilling db...')
-        else:
-            print('Updating db...')
-            last_update = db.get_last_updated_timestamp()
-
-        votes = get_votes(last_update)
-        num_of_updates = db.add_votes(votes)
-
-        now = datetime.now()
-        print('db updated at {} with {} updates.'.format(now.strftime('%Y-%m-%d %H:%M:%S'), num_of_updates))
-    except KeyboardInterrupt:
-        print('\nExiting...')
-        sys.exit(0)
-    except Exception as e:
-        print(e)
+
+def make_source():
+    """Get the source given with --file or --url, pushshift otherwise."""
+    if '--file' in sys.argv:
+        return FileSource(sys.argv[sys.argv.index('--file') + 1])
+    if '--url' in sys.argv:
+        return HttpSource(sys.argv[sys.argv.index('--url') + 1])
+    return PushshiftSource(api)
+
+
+def fetch_slice(db, since, until):
+    """Get the votes of one backfill slice with their parents along with how many were fetched and filtered out."""
+    counts = {'fetched': 0, 'filtered': 0}
+    # a search keeps its state on the client, so every slice gets its own
+    source = PushshiftSource()
+    votes = get_votes(since, make_filter(db, counts), until, source.client)
+    return list(db.resolve_parents(votes, get_parents=source.get_parents)), counts
+
+
+def record_cycle(db, counts, inserted, start):
+    db.record_ingest({'ingest_votes_fetched_total': counts['fetched'],
+                      'ingest_votes_filtered_total': counts['filtered'],
+                      'ingest_votes_inserted_total': inserted,
+                      'ingest_cycles_total': 1},
+                     {'ingest_last_cycle_seconds': round(perf_counter() - start, 3),
+                      'ingest_last_cycle_timestamp': int(time())})
+
+
+def rebuild_db():
+    db = DB(DB_FILE)
+    db.create_tables()
+    print('Rebuilding rollups...')
+    db.rebuild_rollups()
+    print('Rollups rebuilt at {}.'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def archive_db():
+    db = DB(DB_FILE)
+    db.create_tables()
+    print('Archiving closed months...')
+    months = db.archive_months(int(time()) - ARCHIVE_DELAY)
+    if months and '--vacuum' in sys.argv:
+        db.vacuum()
+    print('Archived {} months at {}.'.format(len(months), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def backfill_db():
+    """Backfill the last year in checkpointed slices, resuming the slices an earlier run did not finish."""
+    start = perf_counter()
+    db = DB(DB_FILE, vacuum='--vacuum' in sys.argv, debug=True)
+    db.create_tables()
+    now = int(time())
+    # archived months are immutable, so only the live partition is backfilled
+    since = max(now - YEAR_IN_SECONDS, db.get_live_since())
+    db.load_vote_ids(since)
+    counts = Backfill(db, lambda since, until: fetch_slice(db, since, until)).run(since, now)
+    version = db.publish_snapshot()
+    record_cycle(db, counts, counts['inserted'], start)
+    print('db backfilled at {} with {} updates from {} slices, published snapshot {}.'.format(
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'), counts['inserted'], counts['slices'], version))
+
+
+async def ingest_db():
+    """Ingest new votes from the source as they arrive until interrupted or terminated."""
+    db = DB(DB_FILE, vacuum='--vacuum' in sys.argv)
+    db.create_tables()
+    await Ingester(db, make_source()).run()
+    print('Exiting...')
 
 
 if __name__ == "__main__":
-    update_db()
-    if '--backfill' not in sys.argv:
-        while True:
-            sleep(60 * UPDATE_INTERVAL)
-            update_db()
+    if '--rebuild' in sys.argv:
+        rebuild_db()
+        sys.exit(0)
+    if '--archive' in sys.argv:
+        archive_db()
+        sys.exit(0)
+    if '--backfill' in sys.argv:
+        try:
+            backfill_db()
+        except KeyboardInterrupt:
+            print('\nExiting, the backfill will resume from its last finished slice...')
+        sys.exit(0)
+    asyncio.run(ingest_db())
@@ -0,0 +1,75 @@
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+# Months are archived a week after they end so late and backfilled votes still reach them
+ARCHIVE_DELAY = 7 * 24 * 60 * 60
+
+
+def get_month(timestamp):
+    """Get the utc month of a timestamp as YYYY-MM."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m')
+
+
+def get_month_bounds(month):
+    """Get the first second of a month and of the month after it."""
+    year, number = [int(part) for part in month.split('-')]
+    start = datetime(year, number, 1, tzinfo=timezone.utc)
+    end = datetime(year + number // 12, number % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def get_archive_name(file, month):
+    """Get the file name of a month archived from a live db, e.g. votes-2022-01.db for votes.db."""
+    stem, ext = os.path.splitext(os.path.basename(file))
+    return '{}-{}{}'.format(stem, month, ext or '.db')
+
+
+def get_archives(conn, epoch=0):
+    """Get the (month, since, until, file) rows of the archived months with votes since epoch, oldest first."""
+    c = conn.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='partitions'")
+    if c.fetchone()[0] == 0:
+        return []
+    c = conn.execute("SELECT month, since, until, file FROM partitions WHERE until > ? ORDER BY since", [epoch])
+    return c.fetchall()
+
+
+def get_live_since(conn):
+    """Get the time the live partition starts at, every vote before it is archived."""
+    archives = get_archives(conn)
+    return archives[-1][2] if archives else 0
+
+
+@contextmanager
+def attach(conn, file, schema='archive'):
+    """Attach an archive next to the main db read-only while the block runs."""
+    main = conn.execute("PRAGMA database_list").fetchone()[2]
+    path = os.path.join(os.path.dirname(main), file)
+    conn.execute("ATTACH DATABASE ? AS {}".format(schema), ['file:{}?mode=ro'.format(quote(path))])
+    try:
+        yield schema
+    finally:
+        conn.execute("DETACH DATABASE {}".format(schema))
+
+
+@contextmanager
+def schema_at(conn, timestamp):
+    """Get the schema holding the votes of a timestamp, attaching its archive if it has one."""
+    for month, since, until, file in get_archives(conn, timestamp):
+        if since <= timestamp:
+            with attach(conn, file) as schema:
+                yield schema
+            return
+    yield 'main'
+
+
+def iter_schemas(conn, epoch):
+    """Yield the schema of every partition with votes since epoch, oldest first, attaching archives one at a time.
+
+    A year spans more archives than sqlite can attach at once, so results are combined between partitions.
+    """
+    for month, since, until, file in get_archives(conn, epoch):
+        with attach(conn, file) as schema:
+            yield schema
+    yield 'main'
@@ -0,0 +1,201 @@
+from datetime import datetime, timedelta
+from partitions import schema_at, iter_schemas
+
+MINVOTES = 3
+DAY_IN_SECONDS = 86400
+HOUR_IN_SECONDS = 3600
+
+# Standard windows served by the web app and the resolution each one is graphed at
+WINDOWS = {
+    '1d': 'hourly',
+    '1w': 'daily',
+    '1M': 'daily',
+    '1y': 'monthly',
+}
+# Bucket of an hour of vote_hours at each resolution, weeks start on monday and the epoch was a thursday
+BUCKETS = {
+    'hourly': 'hour',
+    'daily': 'hour / 24',
+    'weekly': '(hour / 24 + 3) / 7',
+    'monthly': "strftime('%Y-%m', hour * 3600, 'unixepoch')",
+}
+SORTS = ['top', 'controversial']
+
+
+def get_epoch(after):
+    """Get epoch of a standard window."""
+    length = int(after[:-1])
+    days = {'d': 1, 'w': 7, 'M': 30, 'y': 365}[after[-1]]
+    return int((datetime.now() - timedelta(days=length * days)).strftime('%s'))
+
+
+def load_window_votes(conn, epoch, now):
+    """Fill temp.window_votes with the time weighted vote counts of every bot in each partition since epoch."""
+    conn.execute('''CREATE TEMP TABLE IF NOT EXISTS window_votes
+                    (bot INTEGER,
+                    part INTEGER,
+                    good_votes INTEGER,
+                    bad_votes INTEGER,
+                    good_time REAL,
+                    bad_time REAL,
+                    PRIMARY KEY (bot, part)) WITHOUT ROWID''')
+    conn.execute("DELETE FROM temp.window_votes")
+    for part, schema in enumerate(iter_schemas(conn, epoch)):
+        conn.execute('''INSERT INTO temp.window_votes
+                        select bot,
+                            {1},
+                            sum(vote),
+                            count(*) - sum(vote),
+                            sum(CASE WHEN vote = 1 THEN {0}.0 / (({0} - timestamp) * ({0} - timestamp))
+                                ELSE 0 END),
+                            sum(CASE WHEN vote = 0 THEN {0}.0 / (({0} - timestamp) * ({0} - timestamp))
+                                ELSE 0 END)
+                        from {2}.votes
+                        where timestamp >= ?
+                        group by bot'''.format(now, part, schema), [epoch])
+        # archives can only be detached outside of a transaction
+        conn.commit()
+
+
+def get_ranks(conn, epoch, sort, minvotes=MINVOTES):
+    """Get rank rows in the same shape as the web app's DB.get_ranks."""
+    now = int((datetime.now()).strftime('%s'))
+    if sort == 'hot':
+        # the partitions are summed one at a time and combined per bot
+        load_window_votes(conn, epoch, now)
+        votes_str = '''select bot,
+                            sum(good_votes) as good_votes,
+                            sum(bad_votes) as bad_votes,
+                            sum(good_time) as good_time,
+                            sum(bad_time) as bad_time
+                        from temp.window_votes
+                        group by bot'''
+        return _rank(conn, sort, votes_str, [], minvotes)
+
+    epoch_day = epoch // DAY_IN_SECONDS
+    with schema_at(conn, epoch) as schema:
+        votes_str = '''select bot,
+                            sum(good_votes) as good_votes,
+                            sum(bad_votes) as bad_votes,
+                            sum(good_votes) as good_time,
+                            sum(bad_votes) as bad_time
+                        from (select bot, good_votes, bad_votes
+                                from bot_days
+                                where day > ?
+                              union all
+                              select bot, vote, 1 - vote
+                                from {}.votes
+                                where timestamp >= ? AND timestamp < ?)
+                        group by bot'''.format(schema)
+        return _rank(conn, sort, votes_str, [epoch_day, epoch, (epoch_day + 1) * DAY_IN_SECONDS], minvotes)
+
+
+def _rank(conn, sort, votes_str, params, minvotes):
+    c = conn.execute('''select
+            row_number () over (
+                order by {} desc, good_votes desc, bad_votes
+            ) rank, *
+            from (
+                select b.bot,
+                b.link_karma,
+                b.comment_karma,
+                v.good_votes,
+                v.bad_votes,
+                ROUND(((v.good_votes + 1.9208) / (v.good_votes + v.bad_votes) - 1.96 * power(
+                (v.good_votes * v.bad_votes) / (v.good_votes + v.bad_votes) + 0.9604, 0.5) /
+                (v.good_votes + v.bad_votes)) / (
+                1 + 3.8416 / (v.good_votes + v.bad_votes)), 4) as top,
+                ((v.good_time + 1.9208) / (v.good_time + v.bad_time) - 1.96 * power(
+                (v.good_time * v.bad_time) / (v.good_time + v.bad_time) + 0.9604, 0.5) /
+                (v.good_time + v.bad_time)) / (
+                1 + 3.8416 / (v.good_time + v.bad_time)) as hot,
+                (v.good_votes + v.bad_votes) / (abs(v.good_votes - v.bad_votes) + 1) as controversial
+                    from ({}) v
+                    inner join bots b on v.bot = b.id
+                    where b.comment_karma IS NOT NULL AND v.good_votes + v.bad_votes >= ?
+            )'''.format(sort, votes_str), params + [minvotes])
+    return c.fetchall()
+
+
+def get_subs(conn, epoch):
+    epoch_day = epoch // DAY_IN_SECONDS
+    with schema_at(conn, epoch) as schema:
+        c = conn.execute('''select s.name,
+                                sum(v.good_votes) as good_votes,
+                                sum(v.bad_votes) as bad_votes
+                            from (select subreddit, good_votes, bad_votes
+                                    from sub_days
+                                    where day > ?
+                                  union all
+                                  select subreddit, vote, 1 - vote
+                                    from {}.votes
+                                    where timestamp >= ? AND timestamp < ?) v
+                            inner join subreddits s on v.subreddit = s.id
+                            group by v.subreddit
+                            order by sum(v.good_votes + v.bad_votes) desc'''.format(schema),
+                         [epoch_day, epoch, (epoch_day + 1) * DAY_IN_SECONDS])
+        return c.fetchall()
+
+
+def get_vote_counts(conn, epoch):
+    epoch_hour = epoch // HOUR_IN_SECONDS
+    with schema_at(conn, epoch) as schema:
+        c = conn.execute('''select sum(good_votes + bad_votes), sum(good_votes)
+                            from (select good_votes, bad_votes
+                                    from vote_hours
+                                    where hour > ?
+                                  union all
+                                  select vote, 1 - vote
+                                    from {}.votes
+                                    where timestamp >= ? AND timestamp < ?)'''.format(schema),
+                         [epoch_hour, epoch, (epoch_hour + 1) * HOUR_IN_SECONDS])
+        total, good = c.fetchone()
+    total = total or 0
+    good = good or 0
+    return {'': total, 'G': good, 'B': total - good}
+
+
+def get_timeline(conn, epoch, resolution):
+    """Get the vote counts of each bucket since epoch in the same shape as the web app's DB.get_timeline."""
+    epoch_hour = epoch // HOUR_IN_SECONDS
+    with schema_at(conn, epoch) as schema:
+        return _get_buckets(conn, epoch, epoch_hour, resolution, schema)
+
+
+def _get_buckets(conn, epoch, epoch_hour, resolution, schema):
+    c = conn.execute('''select {} as bucket,
+                           sum(good_votes),
+                           sum(bad_votes)
+                    from (select hour, good_votes, bad_votes
+                            from vote_hours
+                            where hour > ?
+                          union all
+                          select timestamp / {}, vote, 1 - vote
+                            from {}.votes
+                            where timestamp >= ? AND timestamp < ?)
+                    group by bucket
+                    order by bucket'''.format(BUCKETS[resolution], HOUR_IN_SECONDS, schema),
+                     [epoch_hour, epoch, (epoch_hour + 1) * HOUR_IN_SECONDS])
+    return c.fetchall()
+
+
+def build_snapshot(conn):
+    """Compute the results of every standard window for the web app."""
+    snapshot = {'ranks': {}, 'subs': {}, 'stats': {}, 'series': {}}
+    # read first, so the snapshot holds at least this many votes and the web app can tell when it is behind
+    (snapshot['total'],) = conn.execute("SELECT votes FROM vote_total WHERE id = 0").fetchone()
+    now = int((datetime.now()).strftime('%s'))
+    for after, resolution in WINDOWS.items():
+        epoch = get_epoch(after)
+        for sort in SORTS:
+            snapshot['ranks']['{}:{}'.format(after, sort)] = get_ranks(conn, epoch, sort)
+        snapshot['subs'][after] = get_subs(conn, epoch)
+        # every ranked bot has the minimum number of votes, so the ranking is also the bot count
+        snapshot['stats'][after] = {'count': get_vote_counts(conn, epoch),
+                                    'bots': len(snapshot['ranks']['{}:top'.format(after)])}
+        snapshot['series'][after] = {'epoch': epoch, 'now': now, 'resolution': resolution,
+                                     'rows': get_timeline(conn, epoch, resolution)}
+
+    # the hot sort always ranks over the last year
+    snapshot['ranks']['1y:hot'] = get_ranks(conn, get_epoch('1y'), 'hot')
+    return snapshot
@@ -0,0 +1,113 @@
+import json
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from pmaw import PushshiftAPI
+from db import search_parents
+
+QUERY = '"good bot"|"bad bot"'
+FIELDS = ['author', 'body', 'created_utc', 'id', 'link_id', 'parent_id', 'subreddit']
+HTTP_TIMEOUT = 30
+PAGE_SIZE = 100
+
+
+def search_pushshift(q, timestamp, fxn, until=None, client=None):
+    """Search pushshift for specific criteria."""
+    client = client or PushshiftAPI()
+    if not timestamp:
+        return client.search_comments(q=q, search_window=365, filter=FIELDS, mem_safe=True, filter_fn=fxn)
+    if until:
+        return client.search_comments(q=q, since=timestamp, until=until, filter=FIELDS, mem_safe=True, filter_fn=fxn)
+    return client.search_comments(q=q, since=timestamp, filter=FIELDS, mem_safe=True, filter_fn=fxn)
+
+
+def get_votes(timestamp, fxn, until=None, client=None):
+    """Get last timestamp worth of votes."""
+    return search_pushshift(QUERY, timestamp, fxn, until, client)
+
+
+class Source:
+    """Where the ingester polls for votes and looks up their parent comments.
+
+    Comments are dicts in the pushshift format with the parent_id of votes as an integer.
+    """
+
+    def get_votes(self, since):
+        """Get the comments made since a timestamp that may be votes."""
+        raise NotImplementedError
+
+    def get_parents(self, ids):
+        """Get the comments with the base36 ids."""
+        raise NotImplementedError
+
+
+class PushshiftSource(Source):
+    """Pushshift through one pmaw client kept for every poll."""
+
+    def __init__(self, client=None):
+        self.client = client or PushshiftAPI()
+
+    def get_votes(self, since):
+        return list(get_votes(since, None, client=self.client))
+
+    def get_parents(self, ids):
+        return search_parents(ids, self.client)
+
+
+class HttpSource(Source):
+    """A pushshift compatible http api, such as a local fake of it."""
+
+    def __init__(self, url, timeout=HTTP_TIMEOUT, page_size=PAGE_SIZE):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.page_size = page_size
+
+    def _search(self, **params):
+        url = '{}/reddit/comment/search?{}'.format(self.url, urlencode(params))
+        with urlopen(url, timeout=self.timeout) as response:
+            return json.load(response)['data']
+
+    def get_votes(self, since):
+        """Page through the comments oldest first until a short page, so none are skipped by the watermark."""
+        comments = {}
+        while True:
+            page = self._search(q=QUERY, since=since, sort='asc', sort_type='created_utc', size=self.page_size,
+                                fields=','.join(FIELDS))
+            comments.update((comment['id'], comment) for comment in page)
+            if len(page) < self.page_size:
+                return list(comments.values())
+            # comments made in the last second of a page may continue on the next one, which repeats that second
+            last = max(comment['created_utc'] for comment in page)
+            since = last if last > since else last + 1
+
+    def get_parents(self, ids):
+        return self._search(ids=','.join(ids)) if ids else []
+
+
+class FileSource(Source):
+    """Comments read from a file of json lines, picking up the lines appended to it since the last poll."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.comments = {}
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # a line that is still being written is read on the next poll
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        for line in data[:end].splitlines():
+            if line.strip():
+                comment = json.loads(line)
+                self.comments[comment['id']] = comment
+
+    def get_votes(self, since):
+        self._read()
+        # the ingester changes the votes it is given, so it gets copies
+        return [dict(comment) for comment in self.comments.values()
+                if comment.get('parent_id') is not None and comment['created_utc'] >= since]
+
+    def get_parents(self, ids):
+        return [dict(self.comments[i]) for i in ids if i in self.comments]
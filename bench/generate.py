@@ -0,0 +1,91 @@
+"""Generate a synthetic vote database with the ingester's schema.
+
+Usage: python generate.py <file> <rows> [seed]
+"""
+import random
+import sys
+from itertools import accumulate
+from time import time, perf_counter
+from stubs import install, load_app_db
+
+YEAR_IN_SECONDS = 365 * 86400
+CHUNK_SIZE = 100000
+
+
+def parse_size(size):
+    """Get a row count from a size like 10k or 1M."""
+    units = {'k': 1000, 'M': 1000000}
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def zipf_weights(count, exponent):
+    """Get cumulative weights that make the first items far more likely than the rest."""
+    return list(accumulate(1 / (i + 1) ** exponent for i in range(count)))
+
+
+def generate(file, rows, seed=0, span=2 * YEAR_IN_SECONDS):
+    """Create a db of rows votes spread over span seconds up to now."""
+    install()
+    app_db = load_app_db()
+    rand = random.Random(seed)
+    now = int(time())
+    start = perf_counter()
+
+    n_bots = max(100, rows // 500)
+    n_subreddits = max(50, rows // 2000)
+    n_authors = max(1000, rows // 4)
+    bot_weights = zipf_weights(n_bots, 1.1)
+    subreddit_weights = zipf_weights(n_subreddits, 1.0)
+    # every bot has its own share of good votes
+    good_ratios = [rand.betavariate(7, 3) for i in range(n_bots)]
+
+    db = app_db.DB(file)
+    db._open()
+    conn = db.conn
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    # the rollups and indexes are built by create_tables after the votes are in
+    db._create_votes_table()
+    db._create_bots_table()
+    db._create_names_table('subreddits')
+    db._create_names_table('authors')
+    conn.execute("PRAGMA user_version = {}".format(app_db.SCHEMA_VERSION))
+
+    # a few bots have not had their karma looked up yet and are left out of the ranks
+    conn.executemany("INSERT INTO bots (id, bot, comment_karma, link_karma, last_refreshed) VALUES (?, ?, ?, ?, ?)",
+                     [[i + 1, 'bench_bot_{}'.format(i),
+                       None if rand.random() < 0.03 else rand.randint(1, 10 ** 6),
+                       rand.randint(1, 10 ** 4), now] for i in range(n_bots)])
+    conn.executemany("INSERT INTO subreddits (id, name) VALUES (?, ?)",
+                     [[i + 1, 'bench_sub_{}'.format(i)] for i in range(n_subreddits)])
+    conn.executemany("INSERT INTO authors (id, name) VALUES (?, ?)",
+                     [[i + 1, 'bench_user_{}'.format(i)] for i in range(n_authors)])
+
+    bot_ids = range(1, n_bots + 1)
+    subreddit_ids = range(1, n_subreddits + 1)
+    for offset in range(0, rows, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, rows - offset)
+        bots = rand.choices(bot_ids, cum_weights=bot_weights, k=size)
+        subreddits = rand.choices(subreddit_ids, cum_weights=subreddit_weights, k=size)
+        chunk = []
+        for i in range(size):
+            n = offset + i
+            # ids grow with time and votes get more frequent towards now
+            timestamp = now - span + int(span * (n / rows) ** 0.8)
+            chunk.append([10 ** 9 + n, bots[i], subreddits[i], rand.randint(1, n_authors), timestamp,
+                          int(rand.random() < good_ratios[bots[i] - 1])])
+        conn.executemany("INSERT INTO votes (id, bot, subreddit, author, timestamp, vote) VALUES (?, ?, ?, ?, ?, ?)",
+                         chunk)
+    conn.commit()
+    db._close()
+
+    db.create_tables()
+    db.publish_snapshot()
+    print('Generated {} votes for {} bots in {:.2f}s.'.format(rows, n_bots, perf_counter() - start))
+    return {'bots': n_bots, 'subreddits': n_subreddits, 'authors': n_authors}
+
+
+if __name__ == "__main__":
+    generate(sys.argv[1], parse_size(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 0)
@@ -0,0 +1,701 @@
+"""Benchmark the ingester and the web app against synthetic vote databases.
+
+Every DB query and utils helper is timed cold and warm, the columnar ranking engine is timed and checked against
+the sql when numpy is installed, the api is driven in-process through ASGI and the
+results are written as json that can be compared between commits. A backfill of a fake Pushshift with a
+simulated latency is timed with one and several workers and resumed after an interruption, and votes streamed to
+a file are timed from when they are written until the continuous ingester inserts them. With --archive the closed
+months of the generated dbs are moved to read-only partition files first. Several web workers computing the same
+windows are timed with per-process and with shared caches. A new web process is timed from its imports until it
+reports ready on /api/ping and answers its first query, with and without READ_ONLY. Reddit and Pushshift are
+stubbed.
+
+Usage: python run.py [--sizes 10k,1M,10M] [--dir DIR] [--repeat N] [--requests N] [--concurrency N]
+                     [--ingest N] [--stream SECONDS] [--stream-rate N] [--poll SECONDS]
+                     [--backfill N] [--workers N] [--latency MS] [--archive] [--web-workers N] [--skip-http]
+                     [--output FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from time import perf_counter, time
+from urllib.parse import urlencode
+from stubs import install, load_app_db, load_app_module, ROOT, WEB_DIR, FakeReddit, FakePushshift, fullname, to_base36
+from generate import generate, parse_size
+
+WINDOWS = ['1d', '1w', '1M', '1y']
+SORTS = ['top', 'controversial']
+GRID_QUERY = '''query ($after:String, $sort:String, $first:Int) {
+  bots(after: $after, sort: $sort, first: $first) { rank name score votes { good bad } karma { link comment } }
+  stats(after: $after) { votes { latest count } }
+}'''
+CHART_QUERY = '''query ($after:String) {
+  bots(after: $after, limit: 5) { name votes { good bad } }
+  graph(after: $after) { labels votes { good bad } }
+  subs(after: $after, limit: 5) { name votes { good bad } }
+  goodStats: stats(after: $after, voteType: GOOD) { votes { count } }
+  badStats: stats(after: $after, voteType: BAD) { votes { count } }
+}'''
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+async def timed(fn):
+    start = perf_counter()
+    await fn()
+    return perf_counter() - start
+
+
+def import_web():
+    """Import the web app's modules from its own directory so static files and templates resolve."""
+    os.chdir(WEB_DIR)
+    if WEB_DIR not in sys.path:
+        sys.path.insert(0, WEB_DIR)
+    import db
+    import utils
+    return db, utils
+
+
+def db_calls(utils, names):
+    """Get every query of the web app's DB by name."""
+    calls = {'get_counters': lambda db: db.get_counters()}
+    for after in WINDOWS:
+        epoch = utils.get_epoch(after)
+        for sort in SORTS:
+            calls['get_ranks:{}:{}'.format(after, sort)] = lambda db, e=epoch, s=sort: db.get_ranks(e, s)
+        resolution = utils.default_resolution(after)
+        calls['get_subs:' + after] = lambda db, e=epoch: db.get_subs(e)
+        calls['get_vote_counts:' + after] = lambda db, e=epoch: db.get_vote_counts(e)
+        calls['get_timeline:' + after] = lambda db, e=epoch, r=resolution: db.get_timeline(e, r)
+    calls['get_ranks:1y:hot'] = lambda db: db.get_ranks(utils.get_epoch('1y'), 'hot')
+    calls['get_snapshot'] = lambda db: latest_snapshot(db)
+    calls['get_stale_bots'] = lambda db: db.get_stale_bots(names, 24 * 60 * 60)
+    return calls
+
+
+async def latest_snapshot(db):
+    return await db.get_snapshot(await db.get_snapshot_version())
+
+
+async def bench_db(web_db, utils, file, repeat, names):
+    """Time each query on a new connection and then the median of repeat more on the same one."""
+    results = {}
+    for name, call in db_calls(utils, names).items():
+        db = web_db.DB(file)
+        await db.connect()
+        cold = await timed(lambda: call(db))
+        warm = [await timed(lambda: call(db)) for i in range(repeat)]
+        await db.close()
+        results[name] = {'cold_ms': ms(cold), 'warm_ms': ms(statistics.median(warm))}
+    return results
+
+
+async def bench_columns(web_db, utils, file, repeat):
+    """Time loading the columnar ranking engine and each ranking from it, checking it against the sql."""
+    import columns
+    if columns.np is None:
+        return None
+    db = web_db.DB(file)
+    await db.connect()
+    (total, latest) = await db.get_counters()
+    engine = columns.ColumnarRanks()
+    results = {'load_ms': ms(await timed(lambda: engine.refresh(db, total)))}
+    for after in WINDOWS:
+        for sort in SORTS + ['hot']:
+            epoch = utils.get_epoch(after)
+            # sql takes the time when it starts, so both rank with the same hot weights when it ran within a second
+            while True:
+                now = int(time())
+                rows = [tuple(row) for row in await db.get_ranks(epoch, sort)]
+                if int(time()) == now:
+                    break
+            elapsed = []
+            for i in range(repeat):
+                start = perf_counter()
+                ranks = engine.get_ranks(epoch, sort, now)
+                elapsed.append(perf_counter() - start)
+            assert ranks == rows, 'columns do not match sql for {} {}'.format(after, sort)
+            results['get_ranks:{}:{}'.format(after, sort)] = {
+                'warm_ms': ms(statistics.median(elapsed)),
+                'matches_sql': True}
+    await db.close()
+    return results
+
+
+def reset_web(utils):
+    """Forget every cached result and the loaded snapshot."""
+    for fn in [utils._get_ranking, utils._get_window_stats, utils._get_subs, utils._get_graph]:
+        fn.cache.clear()
+    utils.snapshot = None
+
+
+async def bench_utils(utils, repeat):
+    """Time each helper from the db, from its cache and from a loaded snapshot."""
+    calls = {}
+    for after in WINDOWS:
+        for sort in SORTS:
+            calls['get_ranks:{}:{}'.format(after, sort)] = lambda a=after, s=sort: utils.get_ranks(a, s)
+        calls['get_stats:' + after] = lambda a=after: utils.get_stats(a)
+        calls['get_subs:' + after] = lambda a=after: utils.get_subs(a)
+        calls['get_graph:' + after] = lambda a=after: utils.get_graph(a)
+    calls['get_ranks:1y:hot'] = lambda: utils.get_ranks('1y', 'hot')
+    calls['get_ranks:3M:top'] = lambda: utils.get_ranks('3M', 'top')
+
+    results = {}
+    for name, call in calls.items():
+        reset_web(utils)
+        cold = await timed(call)
+        warm = [await timed(call) for i in range(repeat)]
+        results[name] = {'cold_ms': ms(cold), 'warm_ms': ms(statistics.median(warm))}
+
+    reset_web(utils)
+    results['refresh_snapshot'] = {'cold_ms': ms(await timed(utils.refresh_snapshot))}
+    for name, call in calls.items():
+        results[name]['snapshot_ms'] = ms(statistics.median([await timed(call) for i in range(repeat)]))
+    return results
+
+
+def run_web_worker(file, backend, cache_dir, rounds, barrier, queue):
+    """Compute windows that no snapshot has in a new process, like a uvicorn worker, and report its queries."""
+    os.environ['CACHE_BACKEND'] = backend
+    os.environ['CACHE_DIR'] = cache_dir
+    install()
+    web_db, utils = import_web()
+    import metrics
+
+    async def work():
+        utils.pool.file = file
+        await utils.pool.open()
+        try:
+            barrier.wait()
+            start = perf_counter()
+            for i in range(rounds):
+                await asyncio.gather(*[call() for after in ['2w', '3M', '6M', '2y']
+                                       for call in [lambda a=after: utils.get_ranks(a, 'top'),
+                                                    lambda a=after: utils.get_ranks(a, 'controversial'),
+                                                    lambda a=after: utils.get_stats(a),
+                                                    lambda a=after: utils.get_subs(a),
+                                                    lambda a=after: utils.get_graph(a)]])
+            return perf_counter() - start
+        finally:
+            await utils.pool.close()
+
+    with redirect_stdout(sys.stderr):
+        elapsed = asyncio.run(work())
+    queries = sum(counts[-1] for counts in metrics.QUERY_LATENCY.values.values())
+    queue.put((elapsed, queries))
+
+
+def bench_workers(file, workers, rounds=5):
+    """Time several web workers computing the same windows with a cache per process and with a shared one."""
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for backend in ['memory', 'file']:
+        cache_dir = tempfile.mkdtemp(prefix='bench-cache-')
+        barrier = context.Barrier(workers)
+        queue = context.Queue()
+        processes = [context.Process(target=run_web_worker, args=(file, backend, cache_dir, rounds, barrier, queue))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        reports = [queue.get() for process in processes]
+        for process in processes:
+            process.join()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        seconds = max(elapsed for elapsed, queries in reports)
+        results[backend] = {'seconds': round(seconds, 3), 'queries': sum(queries for elapsed, queries in reports),
+                            'rps': round(workers * rounds * 20 / seconds, 1)}
+    return results
+
+
+class ASGIClient:
+    """Minimal in-process http client for an ASGI app."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def get(self, path, params=None, headers=None):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'root_path': '',
+            'query_string': urlencode(params or {}).encode(),
+            'headers': [(b'host', b'bench')] + [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+            'client': ('127.0.0.1', 0),
+            'server': ('bench', 80),
+        }
+        done = asyncio.Event()
+        requested = False
+        messages = []
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        start = messages[0]
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return start['status'], dict((k.decode(), v.decode()) for k, v in start['headers']), body
+
+
+def check_graphql(status, headers, body):
+    """Fail unless a graphql response answered its query with data and no errors."""
+    assert status == 200, 'graphql answered {}'.format(status)
+    assert headers.get('content-type') == 'application/json', 'graphql answered {}'.format(headers.get('content-type'))
+    response = json.loads(body)
+    assert response.get('data') and not response.get('errors'), 'graphql answered {}'.format(response)
+
+
+def run_startup(file, read_only, queue):
+    """Time a new web process from its first import until it reports ready and answers a query."""
+    start = perf_counter()
+    os.environ['READ_ONLY'] = '1' if read_only else '0'
+    install()
+    web_db, utils = import_web()
+    utils.pool.file = file
+    import app as web_app
+    imported = perf_counter()
+
+    async def serve():
+        app = web_app.app
+        client = ASGIClient(app)
+        await app.router.startup()
+        try:
+            while (await client.get('/api/ping'))[0] != 200:
+                await asyncio.sleep(0.005)
+            ready = perf_counter()
+            status, headers, body = await client.get('/graphql', {
+                'query': GRID_QUERY, 'variables': json.dumps({'after': '1y', 'sort': 'top', 'first': 100})})
+            answered = perf_counter()
+            check_graphql(status, headers, body)
+            return ready, answered, status
+        finally:
+            await app.router.shutdown()
+
+    with redirect_stdout(sys.stderr):
+        ready, answered, status = asyncio.run(serve())
+    queue.put({'import_ms': ms(imported - start), 'ready_ms': ms(ready - start),
+               'first_response_ms': ms(answered - start), 'status': status,
+               'writer_loaded': 'writer' in sys.modules, 'karma_loaded': 'karma' in sys.modules})
+
+
+def bench_startup(file):
+    """Time the startup of a writable and of a read-only web process."""
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mode, read_only in [('default', False), ('read_only', True)]:
+        queue = context.Queue()
+        process = context.Process(target=run_startup, args=(file, read_only, queue))
+        process.start()
+        process.join()
+        # a process that could not start the app reports nothing
+        results[mode] = queue.get() if process.exitcode == 0 else None
+    return results
+
+
+async def drive(client, path, params, headers, requests, concurrency, check=None):
+    """Send requests with at most concurrency in flight and summarize their latencies, checking each response."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def one():
+        async with semaphore:
+            start = perf_counter()
+            status, response_headers, body = await client.get(path, params, headers)
+            latencies.append(perf_counter() - start)
+            if check:
+                check(status, response_headers, body)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = perf_counter()
+    await asyncio.gather(*[one() for i in range(requests)])
+    elapsed = perf_counter() - start
+    return {
+        'requests': requests,
+        'statuses': {str(k): v for k, v in statuses.items()},
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 0.5)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+    }
+
+
+async def bench_http(utils, top_bot, requests, concurrency):
+    """Drive the api in-process from its startup to its shutdown."""
+    import app as web_app
+    app = web_app.app
+    client = ASGIClient(app)
+    await app.router.startup()
+    try:
+        await utils.refresh_snapshot()
+        status, headers, body = await client.get('/api/getbadge/' + top_bot)
+        scenarios = {
+            'getbadge': ('/api/getbadge/' + top_bot, None, None),
+            'getrank': ('/api/getrank/' + top_bot, None, None),
+            'getbadge_not_modified': ('/api/getbadge/' + top_bot, None, {'If-None-Match': headers.get('etag', '')}),
+            'graphql_grid': ('/graphql', {'query': GRID_QUERY,
+                                          'variables': json.dumps({'after': '1y', 'sort': 'top', 'first': 100})}, None),
+            'graphql_chart': ('/graphql', {'query': CHART_QUERY, 'variables': json.dumps({'after': '1M'})}, None),
+            'export': ('/api/bots', {'after': '1y'}, None),
+        }
+        results = {}
+        for name, (path, params, request_headers) in scenarios.items():
+            # exports are large so fewer of them are sent
+            count = max(1, requests // 10) if name == 'export' else requests
+            check = check_graphql if path == '/graphql' else None
+            results[name] = await drive(client, path, params, request_headers, count, concurrency, check)
+        return results
+    finally:
+        await app.router.shutdown()
+
+
+def add_fake_votes(pushshift, reddit, rand, bots, count, first_id, since, until):
+    """Serve count votes for bots made between since and until from the stubbed clients."""
+    for i in range(count):
+        bot = rand.choice(bots)
+        parent_id = 10 ** 12 + first_id + i
+        pushshift.parents[to_base36(parent_id)] = {'id': to_base36(parent_id), 'author': bot,
+                                                   'author_fullname': fullname(bot)}
+        reddit.names[fullname(bot)] = bot
+        pushshift.votes.append({'id': to_base36(first_id + i), 'parent_id': parent_id,
+                                'body': rand.choice(['Good bot', 'Bad bot']), 'author': 'bench_voter',
+                                'subreddit': 'bench_sub_{}'.format(rand.randint(0, 99)),
+                                'created_utc': rand.randint(since, until - 1)})
+
+
+def bench_ingest(file, count, seed):
+    """Time the ingester adding count votes from stubbed Pushshift to a copy of the db."""
+    app_db = load_app_db()
+    copy = file + '.ingest'
+    shutil.copyfile(file, copy)
+    try:
+        rand = random.Random(seed)
+        conn = sqlite3.connect(copy)
+        bots = [row[0] for row in conn.execute("SELECT bot FROM bots")]
+        (max_id,) = conn.execute("SELECT max(id) FROM votes").fetchone()
+        conn.close()
+        # a tenth of the votes are for bots the db has not seen yet
+        bots += ['bench_new_bot_{}'.format(i) for i in range(max(1, len(bots) // 10))]
+
+        reddit = FakeReddit()
+        pushshift = FakePushshift()
+        now = int(time())
+        add_fake_votes(pushshift, reddit, rand, bots, count, max_id + 1, now - 600, now)
+        app_db.api = pushshift
+
+        db = app_db.DB(copy, reddit=reddit)
+        results = {}
+        start = perf_counter()
+        db.load_vote_ids(now - 365 * 86400)
+        results['load_vote_ids_ms'] = ms(perf_counter() - start)
+        start = perf_counter()
+        added = db.add_votes(pushshift.search_comments(filter_fn=db.is_new_vote))
+        elapsed = perf_counter() - start
+        results['add_votes_ms'] = ms(elapsed)
+        results['votes_per_s'] = round(added / elapsed, 1) if elapsed else 0
+        start = perf_counter()
+        db.publish_snapshot()
+        results['publish_snapshot_ms'] = ms(perf_counter() - start)
+        return results
+    finally:
+        os.remove(copy)
+
+
+async def bench_stream(args):
+    """Time how long votes appended to a file take to reach the db through the continuous ingester."""
+    app_db = load_app_db()
+    ingester = load_app_module('ingester')
+    sources = load_app_module('sources')
+    file = os.path.join(args.dir, 'bench-stream.db')
+    comments = os.path.join(args.dir, 'bench-stream.jsonl')
+    for path in [file, comments]:
+        if os.path.exists(path):
+            os.remove(path)
+    open(comments, 'w').close()
+    rand = random.Random(args.seed)
+    bots = ['bench_bot_{}'.format(i) for i in range(50)]
+    db = app_db.DB(file, reddit=FakeReddit())
+    db.create_tables()
+
+    emitted = {}
+    inserted = {}
+    add_votes = db.add_votes
+
+    def timed_add_votes(votes, **kwargs):
+        added = add_votes(votes, **kwargs)
+        now = perf_counter()
+        inserted.update((vote['id'], now) for vote in votes)
+        return added
+    db.add_votes = timed_add_votes
+
+    async def stream():
+        """Append a tenth of a second worth of votes and their parents at a time."""
+        for tick in range(int(args.stream * 10)):
+            with open(comments, 'a') as f:
+                for i in range(args.stream_rate // 10):
+                    vote_id = 1 + tick * args.stream_rate + i
+                    bot = rand.choice(bots)
+                    f.write(json.dumps({'id': to_base36(10 ** 12 + vote_id), 'author': bot,
+                                        'author_fullname': fullname(bot), 'body': 'beep'}) + '\n')
+                    f.write(json.dumps({'id': to_base36(vote_id), 'parent_id': 10 ** 12 + vote_id,
+                                        'body': rand.choice(['Good bot', 'Bad bot']), 'author': 'bench_voter',
+                                        'subreddit': 'bench_sub', 'created_utc': int(time())}) + '\n')
+                    emitted[to_base36(vote_id)] = perf_counter()
+            await asyncio.sleep(0.1)
+        # give the last votes a few polls to arrive
+        for i in range(50):
+            if len(inserted) >= len(emitted):
+                break
+            await asyncio.sleep(args.poll)
+        runner.stop()
+
+    runner = ingester.Ingester(db, sources.FileSource(comments), interval=args.poll, publish_interval=2)
+    start = perf_counter()
+    await asyncio.gather(runner.run(), stream())
+    elapsed = perf_counter() - start
+    lags = sorted(inserted[vote_id] - emitted[vote_id] for vote_id in emitted if vote_id in inserted)
+    conn = sqlite3.connect(file)
+    (votes,) = conn.execute("SELECT count(*) FROM votes").fetchone()
+    (polls,) = conn.execute("SELECT value FROM ingest_metrics WHERE name = 'ingest_cycles_total'").fetchone()
+    conn.close()
+    for path in [file, comments]:
+        os.remove(path)
+    return {'seconds': round(elapsed, 3), 'votes': votes, 'complete': votes == len(emitted), 'polls': int(polls),
+            'lag_p50_ms': ms(lags[len(lags) // 2]) if lags else None,
+            'lag_max_ms': ms(lags[-1]) if lags else None}
+
+
+class Interrupted(Exception):
+    pass
+
+
+def bench_backfill(args):
+    """Time backfills of a fake Pushshift with one and with several workers, then interrupt one and resume it."""
+    app_db = load_app_db()
+    backfill = load_app_module('backfill')
+    rand = random.Random(args.seed)
+    reddit = FakeReddit()
+    pushshift = FakePushshift(latency=args.latency / 1000)
+    now = int(time())
+    days = 30
+    bots = ['bench_bot_{}'.format(i) for i in range(200)]
+    add_fake_votes(pushshift, reddit, rand, bots, args.backfill, 1, now - days * 86400, now)
+    app_db.api = pushshift
+    file = os.path.join(args.dir, 'bench-backfill.db')
+
+    def make_db():
+        if os.path.exists(file):
+            os.remove(file)
+        db = app_db.DB(file, reddit=reddit)
+        db.create_tables()
+        db.load_vote_ids(now - days * 86400)
+        return db
+
+    def make_fetch(db, fail_after=None):
+        fetched = []
+
+        def fetch(since, until):
+            if fail_after is not None and len(fetched) >= fail_after:
+                raise Interrupted()
+            fetched.append(since)
+            counts = {'fetched': 0, 'filtered': 0}
+
+            def fxn(item):
+                counts['fetched'] += 1
+                new = db.is_new_vote(item)
+                counts['filtered'] += not new
+                return new
+            votes = pushshift.search_comments(since=since, until=until, filter_fn=fxn)
+            return list(db.resolve_parents(votes)), counts
+        return fetch
+
+    results = {}
+    for workers in sorted({1, args.workers}):
+        db = make_db()
+        start = perf_counter()
+        counts = backfill.Backfill(db, make_fetch(db), workers).run(now - days * 86400, now)
+        elapsed = perf_counter() - start
+        results['workers_{}'.format(workers)] = {'seconds': round(elapsed, 3), 'slices': counts['slices'],
+                                                 'votes': counts['inserted'],
+                                                 'votes_per_s': round(counts['inserted'] / elapsed, 1)}
+
+    db = make_db()
+    try:
+        backfill.Backfill(db, make_fetch(db, fail_after=days // 2), args.workers).run(now - days * 86400, now)
+    except Interrupted:
+        pass
+    done = len(db.plan_backfill(now - days * 86400, now, backfill.SLICE_SECONDS))
+    counts = backfill.Backfill(db, make_fetch(db), args.workers).run(now - days * 86400, now)
+    conn = sqlite3.connect(file)
+    (total,) = conn.execute("SELECT count(*) FROM votes").fetchone()
+    conn.close()
+    os.remove(file)
+    results['resume'] = {'slices_left': done, 'slices_resumed': counts['slices'], 'votes': total,
+                         'complete': total == args.backfill}
+    return results
+
+
+async def bench_size(args, size):
+    rows = parse_size(size)
+    file = os.path.join(args.dir, 'bench-{}{}.db'.format(size, '-archived' if args.archive else ''))
+    if not os.path.exists(file):
+        generate(file, rows, args.seed)
+        if args.archive:
+            # closed months move to read-only files next to the live db
+            app_db = load_app_db()
+            app_db.DB(file).archive_months(int(time()) - load_app_module('partitions').ARCHIVE_DELAY)
+            app_db.DB(file).publish_snapshot()
+    else:
+        # bring a reused db up to the current schema and keep its snapshot recent enough to be served
+        load_app_db().DB(file).create_tables()
+        load_app_db().DB(file).publish_snapshot()
+
+    web_db, utils = import_web()
+    conn = sqlite3.connect(file)
+    names = [row[0] for row in conn.execute("SELECT bot FROM bots ORDER BY id LIMIT 100")]
+    conn.close()
+
+    results = {'rows': rows, 'file_mb': round(os.path.getsize(file) / 1024 ** 2, 1)}
+    results['db'] = await bench_db(web_db, utils, file, args.repeat, names)
+    results['columns'] = await bench_columns(web_db, utils, file, args.repeat)
+    utils.pool.file = file
+    await utils.pool.open()
+    try:
+        async with utils.pool.acquire() as db:
+            await utils.counters.load(db)
+        results['utils'] = await bench_utils(utils, args.repeat)
+        ranks = await utils.get_ranks('1y', 'top', limit=1)
+    finally:
+        await utils.pool.close()
+    if not args.skip_http:
+        reset_web(utils)
+        results['http'] = await bench_http(utils, ranks[0].name, args.requests, args.concurrency)
+        results['startup'] = bench_startup(file)
+    if args.web_workers:
+        results['workers'] = bench_workers(file, args.web_workers)
+    results['ingest'] = bench_ingest(file, args.ingest, args.seed)
+    return results
+
+
+def flatten(results, prefix=''):
+    """Get every timing of nested results by its path."""
+    flat = {}
+    for key, value in results.items():
+        path = prefix + '.' + key if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and (key.endswith('_ms') or key in ('rps', 'votes_per_s', 'seconds')):
+            flat[path] = value
+    return flat
+
+
+def compare(base, results):
+    """Print the change of every timing against an earlier run."""
+    base = flatten(base)
+    for path, value in flatten(results).items():
+        if path in base and base[path]:
+            print('{}: {} -> {} ({:+.1f}%)'.format(path, base[path], value, (value - base[path]) / base[path] * 100))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+async def main(args):
+    results = {
+        'commit': get_commit(),
+        'timestamp': int(time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'sizes': {},
+    }
+    for size in args.sizes.split(','):
+        print('Benchmarking {} votes...'.format(size), file=sys.stderr)
+        with redirect_stdout(sys.stderr):
+            results['sizes'][size] = await bench_size(args, size)
+    if args.stream:
+        print('Benchmarking {}s of streamed votes...'.format(args.stream), file=sys.stderr)
+        with redirect_stdout(sys.stderr):
+            results['stream'] = await bench_stream(args)
+    if args.backfill:
+        print('Benchmarking backfill of {} votes...'.format(args.backfill), file=sys.stderr)
+        with redirect_stdout(sys.stderr):
+            results['backfill'] = bench_backfill(args)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ingester and the web app.')
+    parser.add_argument('--sizes', default='10k', help='comma separated vote counts like 10k,1M,10M')
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='directory the generated dbs are kept in')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help='warm calls timed per query')
+    parser.add_argument('--requests', type=int, default=200, help='requests sent per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--ingest', type=int, default=10000, help='votes added by the ingest benchmark')
+    parser.add_argument('--backfill', type=int, default=20000, help='votes backfilled from the fake Pushshift, 0 to skip')
+    parser.add_argument('--workers', type=int, default=4, help='workers of the parallel backfill')
+    parser.add_argument('--latency', type=float, default=50, help='milliseconds each fake Pushshift search takes')
+    parser.add_argument('--stream', type=float, default=5, help='seconds of votes streamed to the ingester, 0 to skip')
+    parser.add_argument('--stream-rate', type=int, default=200, help='votes streamed per second')
+    parser.add_argument('--poll', type=float, default=1, help='seconds between polls of the streamed votes')
+    parser.add_argument('--archive', action='store_true', help='archive the closed months of the generated dbs')
+    parser.add_argument('--web-workers', type=int, default=4,
+                        help='web worker processes sharing the cache, 0 to skip')
+    parser.add_argument('--skip-http', action='store_true', help='skip driving the api')
+    parser.add_argument('--output', help='file to write the json results to instead of stdout')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    args = parser.parse_args()
+    args.dir = os.path.abspath(args.dir)
+    os.makedirs(args.dir, exist_ok=True)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+
+    install()
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,131 @@
+import importlib.util
+import os
+import sys
+import types
+from time import sleep
+from base64 import b32encode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT, 'app')
+WEB_DIR = os.path.join(ROOT, 'web')
+APP_MODULES = ['db', 'snapshots', 'partitions', 'backfill', 'sources', 'ingester']
+
+
+def to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    text = ''
+    while number:
+        number, rem = divmod(number, 36)
+        text = digits[rem] + text
+    return text or '0'
+
+
+class FakeRedditor:
+    def __init__(self, name):
+        self.name = name
+        self.comment_karma = sum(name.encode()) * 7
+        self.link_karma = sum(name.encode())
+
+
+class FakeRedditors:
+    def __init__(self, names):
+        self.names = names
+
+    def partial_redditors(self, ids):
+        return [FakeRedditor(self.names.get(fullname, fullname)) for fullname in ids]
+
+
+class FakeReddit:
+    """Reddit client answering karma lookups without the network."""
+
+    def __init__(self, *args, **kwargs):
+        self.names = {}
+        self.redditors = FakeRedditors(self.names)
+
+    async def redditor(self, name, fetch=False):
+        return FakeRedditor(name)
+
+    async def close(self):
+        pass
+
+
+class FakePushshift:
+    """Pushshift client that serves generated votes and their parent comments after a simulated latency."""
+
+    def __init__(self, *args, latency=0, **kwargs):
+        self.votes = []
+        self.parents = {}
+        self.latency = latency
+
+    def search_comments(self, ids=None, since=None, until=None, filter_fn=None, **kwargs):
+        sleep(self.latency)
+        if ids is not None:
+            items = [self.parents[i] for i in ids if i in self.parents]
+        else:
+            items = [vote for vote in self.votes if (since is None or vote['created_utc'] >= since) and
+                     (until is None or vote['created_utc'] < until)]
+        # the ingester changes the votes it is given, so every search gets its own copies
+        return [dict(item) for item in items if filter_fn is None or filter_fn(item)]
+
+
+def fullname(name):
+    return 't2_' + b32encode(name.encode()).decode().lower().rstrip('=')
+
+
+def install():
+    """Register offline stand-ins for the network clients and missing small dependencies."""
+    os.environ.setdefault('REDDIT_CLIENT_ID', 'bench')
+    os.environ.setdefault('REDDIT_CLIENT_SECRET', 'bench')
+    os.environ.setdefault('REDDIT_USERNAME', 'bench')
+    os.environ.setdefault('REDDIT_PASSWORD', 'bench')
+    os.environ.setdefault('API_KEY', 'bench')
+
+    modules = {
+        'praw': {'Reddit': FakeReddit},
+        'asyncpraw': {'Reddit': FakeReddit},
+        'pmaw': {'PushshiftAPI': FakePushshift},
+        'prawcore': {},
+        'prawcore.exceptions': {'ResponseException': type('ResponseException', (Exception,), {})},
+    }
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+    sys.modules['prawcore'].exceptions = sys.modules['prawcore.exceptions']
+
+    try:
+        import base36
+    except ImportError:
+        module = types.ModuleType('base36')
+        module.dumps = to_base36
+        module.loads = lambda text: int(text, 36)
+        sys.modules['base36'] = module
+
+
+def load_app_module(name):
+    """Import a module of the ingester as app_<name> so it does not clash with the web app's modules."""
+    if 'app_' + name in sys.modules:
+        return sys.modules['app_' + name]
+    # the ingester's modules import each other by plain names that the web app's modules may be using
+    shadowed = {other: sys.modules.pop(other) for other in APP_MODULES if other in sys.modules}
+    sys.modules.update((other, sys.modules['app_' + other]) for other in APP_MODULES if 'app_' + other in sys.modules)
+    spec = importlib.util.spec_from_file_location('app_' + name, os.path.join(APP_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['app_' + name] = module
+    sys.path.insert(0, APP_DIR)
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules['app_' + name]
+        raise
+    finally:
+        sys.path.remove(APP_DIR)
+        for other in APP_MODULES:
+            if other in sys.modules:
+                sys.modules.setdefault('app_' + other, sys.modules.pop(other))
+        sys.modules.update(shadowed)
+    return module
+
+
+def load_app_db():
+    return load_app_module('db')
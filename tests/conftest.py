@@ -0,0 +1,82 @@
+import asyncio
+import os
+import shutil
+import sys
+import sqlite3
+from datetime import datetime
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+from stubs import install, load_app_module, WEB_DIR  # noqa: E402
+from generate import generate  # noqa: E402
+
+# Reddit and Pushshift are stubbed the same way the benchmark does, the web app's modules import by plain names
+install()
+sys.path.insert(0, WEB_DIR)
+
+VOTES = 20000
+
+
+def fixed_datetime(now):
+    """Get a datetime whose now() is always the given epoch, so sql and python rank with the same hot weights."""
+    class Fixed(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromtimestamp(now, tz)
+    return Fixed
+
+
+@pytest.fixture(scope='session')
+def votes_db(tmp_path_factory):
+    """A generated db of two years of votes built with DB.create_tables."""
+    file = str(tmp_path_factory.mktemp('votes') / 'votes.db')
+    generate(file, VOTES, seed=1)
+    return file
+
+
+@pytest.fixture(scope='session')
+def archived_db(tmp_path_factory, votes_db, now):
+    """A copy of the fixture with its closed months moved to read-only archives."""
+    file = str(tmp_path_factory.mktemp('archived') / 'votes.db')
+    shutil.copy(votes_db, file)
+    partitions = load_app_module('partitions')
+    assert load_app_module('db').DB(file).archive_months(now - partitions.ARCHIVE_DELAY)
+    return file
+
+
+@pytest.fixture(params=['live', 'archived'])
+def any_db(request, votes_db, archived_db):
+    """The fixture with every vote in the live db and with its closed months archived."""
+    return votes_db if request.param == 'live' else archived_db
+
+
+@pytest.fixture(scope='session')
+def now(votes_db):
+    """A time just after the newest vote of the fixture."""
+    conn = sqlite3.connect(votes_db)
+    (latest,) = conn.execute("SELECT max(timestamp) FROM votes").fetchone()
+    conn.close()
+    return latest + 60
+
+
+@pytest.fixture
+def web_db(monkeypatch, now):
+    import db
+    monkeypatch.setattr(db, 'datetime', fixed_datetime(now))
+    return db
+
+
+@pytest.fixture
+def with_db(web_db):
+    """Run an async function with a web DB connected to a file, closing it after, and get its result."""
+    def run(file, fn):
+        async def main():
+            db = web_db.DB(file)
+            await db.connect()
+            try:
+                return await fn(db)
+            finally:
+                await db.close()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('fastapi')
+from fastapi.testclient import TestClient  # noqa: E402
+from stubs import WEB_DIR  # noqa: E402
+
+GRID_QUERY = '''query ($after: String, $sort: String, $first: Int) {
+  bots(after: $after, sort: $sort, first: $first) { rank name }
+  stats(after: $after) { votes { latest count } }
+}'''
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, votes_db):
+    """A client of the web app serving a copy of the fixture, started and shut down around each test."""
+    monkeypatch.chdir(WEB_DIR)
+    os.environ.setdefault('API_KEY', 'test')
+    file = str(tmp_path / 'votes.db')
+    shutil.copy(votes_db, file)
+    import app
+    import utils
+    monkeypatch.setattr(utils.pool, 'file', file)
+    with TestClient(app.app) as client:
+        yield client
+
+
+def test_graphql_get_runs_query(client):
+    response = client.get('/graphql', params={'query': GRID_QUERY,
+                                              'variables': json.dumps({'after': '1y', 'sort': 'top', 'first': 10})})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    body = response.json()
+    assert 'errors' not in body
+    assert len(body['data']['bots']) == 10
+    assert body['data']['stats']['votes']['count'] > 0
+    assert 'etag' in response.headers
+
+
+def test_graphql_get_without_query_serves_graphiql(client):
+    response = client.get('/graphql')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/html')
+    assert 'etag' not in response.headers
+
+
+def test_graphql_rejects_long_series(client):
+    query = '{ graph(after: "%s", resolution: %s) { timestamps } }'
+    response = client.post('/graphql', json={'query': query % ('20000d', 'HOURLY')})
+    body = response.json()
+    assert body['data']['graph'] is None
+    assert 'buckets' in body['errors'][0]['message']
+    response = client.post('/graphql', json={'query': query % ('1y', 'HOURLY')})
+    assert len(response.json()['data']['graph']['timestamps']) > 8000
+    response = client.post('/graphql', json={'query': query % ('20000d', 'MONTHLY')})
+    assert 'errors' not in response.json()
+
+
+def test_duplicate_vote_is_rejected(client, now):
+    headers = {'Authorization': 'Bearer {}'.format(os.environ['API_KEY'])}
+    vote = {'parent': 'bench_bot_1', 'id': 'zzvote', 'subreddit': 'test', 'created_utc': now, 'voter': 'test'}
+    response = client.post('/api/vote/good', json=vote, headers=headers)
+    assert response.status_code == 200
+    response = client.post('/api/vote/bad', json=vote, headers=headers)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Vote already exists'
@@ -0,0 +1,70 @@
+import random
+import sqlite3
+
+import pytest
+from run import add_fake_votes
+from stubs import FakePushshift, FakeReddit, load_app_module
+
+DAYS = 10
+VOTES = 500
+UNTIL = 1700000000
+SINCE = UNTIL - DAYS * 86400
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def pushshift(monkeypatch):
+    """A fake Pushshift with votes for a few bots over the last days, and a fake Reddit knowing the bots."""
+    pushshift = FakePushshift()
+    pushshift.reddit = FakeReddit()
+    bots = ['test_bot_{}'.format(i) for i in range(20)]
+    add_fake_votes(pushshift, pushshift.reddit, random.Random(1), bots, VOTES, 1, SINCE, UNTIL)
+    monkeypatch.setattr(load_app_module('db'), 'api', pushshift)
+    return pushshift
+
+
+def make_fetch(db, pushshift, fail_after=None):
+    """Fetch slices from the fake the way app/main.py does, failing once fail_after slices were fetched."""
+    fetched = []
+
+    def fetch(since, until):
+        if fail_after is not None and len(fetched) >= fail_after:
+            raise Interrupted()
+        fetched.append(since)
+        counts = {'fetched': 0, 'filtered': 0}
+
+        def fxn(item):
+            counts['fetched'] += 1
+            new = db.is_new_vote(item)
+            counts['filtered'] += not new
+            return new
+        votes = pushshift.search_comments(since=since, until=until, filter_fn=fxn)
+        return list(db.resolve_parents(votes)), counts
+    return fetch
+
+
+def test_interrupted_backfill_resumes_without_gaps(tmp_path, pushshift):
+    app_db = load_app_module('db')
+    backfill = load_app_module('backfill')
+    file = str(tmp_path / 'votes.db')
+    db = app_db.DB(file, reddit=pushshift.reddit)
+    db.create_tables()
+    db.load_vote_ids(SINCE)
+
+    with pytest.raises(Interrupted):
+        backfill.Backfill(db, make_fetch(db, pushshift, fail_after=4), workers=2).run(SINCE, UNTIL)
+    left = len(db.plan_backfill(SINCE, UNTIL, backfill.SLICE_SECONDS))
+    assert 0 < left < DAYS
+
+    counts = backfill.Backfill(db, make_fetch(db, pushshift), workers=2).run(SINCE, UNTIL)
+    assert counts['slices'] == left
+    assert db.plan_backfill(SINCE, UNTIL, backfill.SLICE_SECONDS) == []
+
+    conn = sqlite3.connect(file)
+    (total, distinct) = conn.execute("SELECT count(*), count(DISTINCT id) FROM votes").fetchone()
+    (checkpointed,) = conn.execute("SELECT sum(votes) FROM backfill_slices WHERE done = 1").fetchone()
+    conn.close()
+    assert total == distinct == checkpointed == VOTES
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import pytest
+
+
+def make_fn(calls, delay=0.05):
+    """Get an async function that counts its calls and returns the number of the call after a delay."""
+    async def fn():
+        calls.append(None)
+        number = len(calls)
+        await asyncio.sleep(delay)
+        return number
+    return fn
+
+
+def test_file_store_keeps_rows(tmp_path):
+    import cache
+    from models import RankRow, SubRow, GraphRows
+
+    # usernames can be anything the tags are made of
+    ranks = [RankRow(1, '__row__', 0.9, 10, 1, 5, 6), RankRow(2, '__tuple__', None, 3, 3, None, None),
+             RankRow(3, '__dict__', 0.1, 3, 3, 1, 1)]
+    values = {
+        ('1y', 'top'): ranks,
+        ('1y', 'index'): {rank.name: rank for rank in ranks},
+        ('1y',): {'count': {'': 5, 'G': 3, 'B': 2}, 'bots': 2},
+        ('1w', 'subs'): [SubRow('test', 3, 2)],
+        ('1d', 'hourly'): GraphRows(['00:00'], [0], [3], [2]),
+    }
+    store = cache.FileStore('rows', directory=str(tmp_path / 'cache'))
+    for key, value in values.items():
+        store.set((key, ()), (value, 7, 1.5, 2.5))
+    # a new store has nothing read yet, so every entry is decoded from its file
+    store = cache.FileStore('rows', directory=str(tmp_path / 'cache'))
+    for key, value in values.items():
+        entry = store.get((key, ()))
+        assert entry == (value, 7, 1.5, 2.5)
+        assert type(entry[0]) is type(value)
+    assert type(store.get((('1w', 'subs'), ()))[0][0]) is SubRow
+    assert store.get((('1m', 'top'), ())) is None
+
+
+def test_file_store_refuses_shared_directory(tmp_path):
+    import cache
+
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError):
+        cache.FileStore('rows', directory=str(directory))
+    os.chmod(directory, 0o700)
+    cache.FileStore('rows', directory=str(directory))
+    assert os.stat(directory / 'rows').st_mode & 0o777 == 0o700
+
+
+@pytest.mark.parametrize('backend', ['memory', 'file'])
+def test_concurrent_misses_compute_once(tmp_path, backend):
+    import cache
+    calls = []
+    fn = make_fn(calls)
+
+    def make_cache():
+        store = cache.MemoryStore('flight') if backend == 'memory' else \
+            cache.FileStore('flight', directory=str(tmp_path / 'cache'))
+        return cache.Cache(name='flight', store=store)
+
+    async def main():
+        # the file store is shared by every worker, each with its own cache
+        caches = [make_cache()] if backend == 'memory' else [make_cache(), make_cache()]
+        gets = [caches[i % len(caches)].get('key', fn) for i in range(10)]
+        # a request that is cancelled does not cancel the computation the others wait for
+        cancelled = asyncio.ensure_future(caches[0].get('key', fn))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await asyncio.gather(*gets)
+
+    assert asyncio.run(main()) == [1] * 10
+    assert len(calls) == 1
+
+
+def test_stale_values_are_served_while_refreshing():
+    import cache
+    calls = []
+    fn = make_fn(calls)
+    versions = [0]
+
+    async def main():
+        values = cache.Cache(ttl=60, name='stale', version=lambda: versions[0], store=cache.MemoryStore('stale'))
+        first = await values.get('key', fn)
+        versions[0] += 1
+        # the value of the old version is returned right away, and every stale get shares one refresh
+        stale = await asyncio.gather(*[values.get('key', fn) for i in range(5)])
+        refreshing = len(calls)
+        await asyncio.sleep(0.1)
+        return first, stale, refreshing, await values.get('key', fn)
+
+    first, stale, refreshing, fresh = asyncio.run(main())
+    assert first == 1
+    assert stale == [1] * 5
+    assert refreshing == 2
+    assert fresh == 2
+    assert len(calls) == 2
+
+
+def test_expired_values_are_computed_again():
+    import cache
+    calls = []
+    fn = make_fn(calls, delay=0)
+
+    async def main():
+        values = cache.Cache(ttl=0.01, stale_ttl=0.01, name='expired', store=cache.MemoryStore('expired'))
+        await values.get('key', fn)
+        await asyncio.sleep(0.05)
+        # past the stale ttl the old value is not served anymore
+        return await values.get('key', fn)
+
+    assert asyncio.run(main()) == 2
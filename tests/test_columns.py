@@ -0,0 +1,20 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+def test_columns_match_sql(any_db, with_db, now):
+    import columns
+
+    async def compare(db):
+        total, latest = await db.get_counters()
+        engine = columns.ColumnarRanks()
+        await engine.refresh(db, total)
+        for days in [1, 7, 30, 365]:
+            epoch = now - days * 86400
+            for sort in ['top', 'hot', 'controversial']:
+                rows = [tuple(row) for row in await db.get_ranks(epoch, sort)]
+                assert len(rows) > 0
+                assert engine.get_ranks(epoch, sort, now) == rows, (days, sort)
+
+    with_db(any_db, compare)
@@ -0,0 +1,24 @@
+import shutil
+import sqlite3
+from types import SimpleNamespace
+
+
+def test_counters_total_counts_every_vote(any_db, with_db, now, tmp_path):
+    file = str(tmp_path / 'votes.db')
+    shutil.copy(any_db, file)
+    conn = sqlite3.connect(file)
+    live = conn.execute("SELECT count(*) FROM votes").fetchone()[0]
+    archived = conn.execute("SELECT coalesce(sum(votes), 0) FROM partitions").fetchone()[0]
+    conn.close()
+
+    async def totals(db):
+        before, latest = await db.get_counters()
+        vote = SimpleNamespace(id='zzzzzz', parent='bench_bot_1', subreddit='test', voter='test', created_utc=now)
+        await db.add_votes([(vote, 'G')])
+        after, latest = await db.get_counters()
+        return before, after, latest
+
+    before, after, latest = with_db(file, totals)
+    assert before == live + archived
+    assert after == before + 1
+    assert latest['G'] == now
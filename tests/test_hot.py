@@ -0,0 +1,23 @@
+# The hot sort before it was written in plain sql, weighing every vote with a python function
+OLD_HOT_VOTES = '''select bot,
+                        sum(vote) as good_votes,
+                        count(*) - sum(vote) as bad_votes,
+                        sum(CASE WHEN vote = 1 THEN hot_weight({0}, timestamp) ELSE 0 END) as good_time,
+                        sum(CASE WHEN vote = 0 THEN hot_weight({0}, timestamp) ELSE 0 END) as bad_time
+                    from votes
+                    where timestamp >= ?
+                    group by bot'''
+
+
+def test_hot_matches_hot_weight_function(votes_db, web_db, with_db, now):
+    async def compare(db):
+        await db.conn.create_function("hot_weight", 2, lambda x, y: float(x) / float((x - y)**2))
+        for days in [1, 7, 30, 365]:
+            epoch = now - days * 86400
+            old = await db._rank('hot', OLD_HOT_VOTES.format(now), [epoch], '', '', web_db.MINVOTES)
+            new = await db.get_ranks(epoch, 'hot')
+            assert len(new) > 0
+            assert [row[1] for row in new] == [row[1] for row in old]
+            assert [tuple(row) for row in new] == [tuple(row) for row in old]
+
+    with_db(votes_db, compare)
@@ -0,0 +1,87 @@
+import asyncio
+import random
+import sqlite3
+from time import time
+
+from run import add_fake_votes
+from stubs import FakePushshift, FakeReddit, load_app_module
+
+BOTS = ['test_bot_{}'.format(i) for i in range(10)]
+
+
+async def wait_for(condition, timeout=5):
+    """Wait until a condition is true, failing after timeout seconds."""
+    for i in range(int(timeout * 100)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('Timed out')
+
+
+def test_ingester_advances_watermark_and_publishes_new_totals(tmp_path):
+    app_db = load_app_module('db')
+    ingester = load_app_module('ingester')
+    sources = load_app_module('sources')
+    pushshift = FakePushshift()
+    reddit = FakeReddit()
+    rand = random.Random(1)
+    now = int(time())
+    add_fake_votes(pushshift, reddit, rand, BOTS, 50, 1, now - 600, now - 300)
+
+    file = str(tmp_path / 'votes.db')
+    db = app_db.DB(file, reddit=reddit)
+    db.create_tables()
+    published = []
+    publish_snapshot = db.publish_snapshot
+
+    def record_publish():
+        published.append(db.get_vote_total())
+        return publish_snapshot()
+    db.publish_snapshot = record_publish
+
+    source = sources.PushshiftSource(pushshift)
+    polls = []
+    get_votes = source.get_votes
+
+    def record_poll(since):
+        polls.append(since)
+        return get_votes(since)
+    source.get_votes = record_poll
+
+    runner = ingester.Ingester(db, source, interval=0.01, max_interval=0.02, publish_interval=0.1)
+
+    async def drive():
+        await wait_for(lambda: published and published[-1] == 50)
+        first_watermark = runner.watermark
+        add_fake_votes(pushshift, reddit, rand, BOTS, 30, 51, now - 100, now)
+        await wait_for(lambda: published[-1] == 80)
+        # the source stays quiet, so the total does not move and nothing is published again
+        await asyncio.sleep(0.5)
+        quiet = len(published)
+        # a vote added by the web api is published even though the ingester did not poll it
+        other = FakePushshift()
+        add_fake_votes(other, reddit, rand, BOTS, 1, 1000, now - 10, now)
+        app_db.DB(file, reddit=reddit).add_votes(other.votes, get_parents=lambda ids: other.search_comments(ids=ids))
+        await wait_for(lambda: published[-1] == 81)
+        runner.stop()
+        return first_watermark, quiet
+
+    async def main():
+        return (await asyncio.gather(runner.run(), drive()))[1]
+
+    first_watermark, quiet = asyncio.run(main())
+    assert first_watermark == max(vote['created_utc'] for vote in pushshift.votes[:50])
+    assert runner.watermark == max(vote['created_utc'] for vote in pushshift.votes)
+    # the first poll starts a year back on an empty db, every later one looks back from the newest vote seen so far
+    assert polls[0] <= now - ingester.YEAR_IN_SECONDS
+    assert set(polls[1:]) <= {first_watermark - ingester.OVERLAP_SECONDS,
+                              runner.watermark - ingester.OVERLAP_SECONDS}
+    # a snapshot is only published when the total has moved since the last one
+    assert published == sorted(set(published))
+    assert quiet == published.index(80) + 1
+    assert published[-1] == 81
+
+    conn = sqlite3.connect(file)
+    (total, distinct) = conn.execute("SELECT count(*), count(DISTINCT id) FROM votes").fetchone()
+    conn.close()
+    assert total == distinct == 81
@@ -0,0 +1,55 @@
+import asyncio
+import shutil
+import sqlite3
+
+from stubs import FakeReddit
+
+
+class CountingReddit(FakeReddit):
+    """Fake Reddit that counts lookups and does not know one bot."""
+
+    def __init__(self):
+        super().__init__()
+        self.lookups = []
+
+    async def redditor(self, name, fetch=False):
+        self.lookups.append(name)
+        if name == 'deleted_bot':
+            raise Exception('Not found')
+        return await super().redditor(name, fetch)
+
+
+def test_refresh_only_looks_up_stale_bots(web_db, votes_db, tmp_path, monkeypatch):
+    import karma
+    file = str(tmp_path / 'votes.db')
+    shutil.copy(votes_db, file)
+    reddit = CountingReddit()
+    monkeypatch.setattr(karma, 'BATCH_DELAY', 0)
+
+    async def main():
+        pool = web_db.Pool(file)
+        refresher = karma.KarmaRefresher(pool, reddit_factory=lambda: reddit)
+        try:
+            first = await refresher.refresh(['new_bot', 'other_bot', 'deleted_bot', 'new_bot'])
+            lookups = sorted(reddit.lookups)
+            # the refreshed bots are fresh now, the one that failed is still stale
+            second = await refresher.refresh(['new_bot', 'other_bot', 'deleted_bot'])
+            for name in ['new_bot', 'new_bot', 'other_bot']:
+                refresher.submit(name)
+            batch = await refresher._next_batch()
+            return first, lookups, second, batch
+        finally:
+            await refresher.stop()
+            await pool.close()
+
+    first, lookups, second, batch = asyncio.run(main())
+    assert first == 2
+    assert lookups == ['deleted_bot', 'new_bot', 'other_bot']
+    assert second == 0
+    assert reddit.lookups[3:] == ['deleted_bot']
+    assert batch == ['new_bot', 'other_bot']
+
+    conn = sqlite3.connect(file)
+    rows = dict(conn.execute("SELECT bot, comment_karma FROM bots WHERE bot IN ('new_bot', 'other_bot')").fetchall())
+    conn.close()
+    assert rows == {'new_bot': sum(b'new_bot') * 7, 'other_bot': sum(b'other_bot') * 7}
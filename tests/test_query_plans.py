@@ -0,0 +1,49 @@
+import re
+
+import pytest
+
+# Statements reading the votes or their rollups
+READS_VOTES = re.compile(r'\bfrom\s+(\w+\.)?(votes|bot_days|sub_days|vote_hours|vote_total)\b', re.IGNORECASE)
+FULL_SCAN = re.compile(r'^SCAN (\w+\.)?(votes|bot_days)\b')
+DAY = 86400
+
+# The hot sort fills temp.window_votes from each partition before ranking it
+QUERIES = {
+    'get_ranks:top': lambda db, now: db.get_ranks(now - 30 * DAY, 'top'),
+    'get_ranks:hot': lambda db, now: db.get_ranks(now - 30 * DAY, 'hot'),
+    'get_subs': lambda db, now: db.get_subs(now - 30 * DAY),
+    'get_vote_counts': lambda db, now: db.get_vote_counts(now - 30 * DAY),
+    'get_timeline': lambda db, now: db.get_timeline(now - 365 * DAY, 'weekly'),
+    'get_counters': lambda db, now: db.get_counters(),
+}
+
+
+class PlanRecorder:
+    """Connection that explains every statement reading the votes before running it."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.plans = []
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def execute(self, sql, params=()):
+        if READS_VOTES.search(sql):
+            c = await self._conn.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            self.plans.append((sql, [row[3] for row in await c.fetchall()]))
+        return await self._conn.execute(sql, params)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_query_reads_covering_indexes(query, any_db, with_db, now):
+    async def explain(db):
+        db.conn = PlanRecorder(db.conn)
+        await QUERIES[query](db, now)
+        return db.conn.plans
+
+    plans = with_db(any_db, explain)
+    assert plans
+    for sql, details in plans:
+        assert any('USING COVERING INDEX' in detail for detail in details), (sql, details)
+        assert not any(FULL_SCAN.match(detail) for detail in details), (sql, details)
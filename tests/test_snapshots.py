@@ -0,0 +1,38 @@
+import sqlite3
+from conftest import fixed_datetime
+from stubs import load_app_module
+
+
+def build_snapshot(file, now, monkeypatch):
+    snapshots = load_app_module('snapshots')
+    monkeypatch.setattr(snapshots, 'datetime', fixed_datetime(now))
+    conn = sqlite3.connect(file, uri=True)
+    conn.create_function("power", 2, lambda x, y: x ** y)
+    try:
+        return snapshots.build_snapshot(conn), snapshots.WINDOWS
+    finally:
+        conn.close()
+
+
+def rows(result):
+    return [tuple(row) for row in result]
+
+
+def test_snapshot_matches_web_queries(any_db, with_db, now, monkeypatch):
+    """The ingester's snapshots and the web app's sql fallback keep their own copies of the queries."""
+    snapshot, windows = build_snapshot(any_db, now, monkeypatch)
+
+    async def compare(db):
+        for after, resolution in windows.items():
+            epoch = snapshot['series'][after]['epoch']
+            for sort in ['top', 'controversial']:
+                ranks = rows(await db.get_ranks(epoch, sort))
+                assert ranks and rows(snapshot['ranks']['{}:{}'.format(after, sort)]) == ranks
+            assert rows(snapshot['subs'][after]) == rows(await db.get_subs(epoch))
+            assert snapshot['stats'][after]['count'] == await db.get_vote_counts(epoch)
+            assert rows(snapshot['series'][after]['rows']) == rows(await db.get_timeline(epoch, resolution))
+        epoch = snapshot['series']['1y']['epoch']
+        assert rows(snapshot['ranks']['1y:hot']) == rows(await db.get_ranks(epoch, 'hot'))
+        assert snapshot['total'] == (await db.get_counters())[0]
+
+    with_db(any_db, compare)
@@ -0,0 +1,23 @@
+from stubs import load_app_module
+
+
+def test_http_source_pages_through_every_vote(monkeypatch):
+    sources = load_app_module('sources')
+    # several comments share the seconds that pages end on
+    comments = [{'id': str(i), 'created_utc': 1000 + i // 3, 'parent_id': 1, 'body': 'good bot'} for i in range(250)]
+    searches = []
+
+    def search(q, since, sort, sort_type, size, fields):
+        searches.append(since)
+        assert sort == 'asc' and sort_type == 'created_utc'
+        return [dict(comment) for comment in comments if comment['created_utc'] >= since][:size]
+
+    source = sources.HttpSource('http://pushshift', page_size=20)
+    monkeypatch.setattr(source, '_search', search)
+    votes = source.get_votes(1010)
+    assert sorted(int(vote['id']) for vote in votes) == list(range(30, 250))
+    assert searches == sorted(searches) and len(searches) > 10
+
+    # a page of comments made in one second moves on to the next second
+    comments = [{'id': str(i), 'created_utc': 1000, 'parent_id': 1, 'body': 'good bot'} for i in range(20)]
+    assert len(source.get_votes(1000)) == 20
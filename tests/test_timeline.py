@@ -0,0 +1,12 @@
+import pytest
+from timeline import BUCKETS, count_buckets, get_series
+
+DAY = 86400
+
+
+@pytest.mark.parametrize('resolution', BUCKETS)
+@pytest.mark.parametrize('days', [0, 1, 30, 400])
+def test_count_buckets_matches_series(resolution, days):
+    now = 1700000000
+    epoch = now - days * DAY
+    assert count_buckets(epoch, now, resolution) == len(get_series([], epoch, now, resolution))
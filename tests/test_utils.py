@@ -0,0 +1,37 @@
+from time import time
+
+
+def test_snapshot_behind_the_votes_is_skipped(monkeypatch):
+    import utils
+    now = int(time())
+    monkeypatch.setattr(utils, 'counters', utils.Counters())
+    utils.counters.total, utils.counters.latest[''] = 10, now - 60
+    monkeypatch.setattr(utils, 'snapshot', {'version': 1, 'timestamp': now, 'total': 10,
+                                            'ranks': {('1y', 'top'): 'ranking'}})
+    assert utils._from_snapshot('ranks', ('1y', 'top')) == 'ranking'
+
+    # a vote added through the api is not in the snapshot yet
+    utils.counters.add('G', now)
+    assert utils._from_snapshot('ranks', ('1y', 'top')) is None
+
+    # snapshots without a total are compared by the time of the newest vote
+    utils.snapshot.update({'total': None, 'timestamp': now - 1})
+    assert utils._from_snapshot('ranks', ('1y', 'top')) is None
+    utils.snapshot['timestamp'] = now
+    assert utils._from_snapshot('ranks', ('1y', 'top')) == 'ranking'
+
+    utils.snapshot['timestamp'] = now - utils.SNAPSHOT_MAX_AGE - 1
+    assert utils._from_snapshot('ranks', ('1y', 'top')) is None
+
+
+def test_ranking_index_follows_cached_ranks():
+    import utils
+    from models import RankRow
+    ranks = [RankRow(1, '__tuple__', 0.9, 10, 1, 5, 6)]
+    ranking = utils._index_ranking(('1y', 'test'), ranks)
+    assert ranking[1] == {'__tuple__': ranks[0]}
+    assert utils._index_ranking(('1y', 'test'), ranks) is ranking
+
+    # a worker reading a new entry of the cache gets new ranks
+    ranks = [RankRow(1, 'other', 0.9, 10, 1, 5, 6)]
+    assert utils._index_ranking(('1y', 'test'), ranks)[1] == {'other': ranks[0]}
@@ -0,0 +1,100 @@
+import asyncio
+import shutil
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def db_file(tmp_path, votes_db):
+    file = str(tmp_path / 'votes.db')
+    shutil.copy(votes_db, file)
+    return file
+
+
+def make_vote(i, now, parent='bench_bot_1'):
+    return SimpleNamespace(id='zz{}'.format(i), parent=parent, subreddit='test', voter='test', created_utc=now)
+
+
+def count_votes(file, votes):
+    conn = sqlite3.connect(file)
+    ids = [int(vote.id, 36) for vote in votes]
+    (count,) = conn.execute("SELECT count(*) FROM votes WHERE id IN ({})".format(', '.join('?' * len(ids))), ids).fetchone()
+    conn.close()
+    return count
+
+
+def test_stop_finishes_the_batch_being_written(web_db, db_file, now, monkeypatch):
+    import writer
+    add_votes = web_db.DB.add_votes
+
+    async def slow_add_votes(self, votes):
+        await asyncio.sleep(0.1)
+        return await add_votes(self, votes)
+
+    monkeypatch.setattr(web_db.DB, 'add_votes', slow_add_votes)
+    votes = [make_vote(i, now) for i in range(8)]
+
+    async def main():
+        pool = web_db.Pool(db_file)
+        vote_writer = writer.VoteWriter(pool, interval=0.01)
+        vote_writer.start()
+        adds = [asyncio.ensure_future(vote_writer.add(vote, 'G')) for vote in votes[:5]]
+        await asyncio.sleep(0.05)
+        # the first batch is being written and the next one is queued when the app shuts down
+        assert vote_writer.depth == 0 and vote_writer.flushes == 0
+        adds += [asyncio.ensure_future(vote_writer.add(vote, 'G')) for vote in votes[5:]]
+        await asyncio.sleep(0)
+        await vote_writer.stop()
+        results = await asyncio.wait_for(asyncio.gather(*adds), 1)
+        await pool.close()
+        return results, vote_writer.flushes
+
+    results, flushes = asyncio.run(main())
+    assert results == [None] * len(votes)
+    assert flushes == 2
+    assert count_votes(db_file, votes) == len(votes)
+
+
+def test_concurrent_votes_share_batches(web_db, db_file, now):
+    import writer
+    votes = [make_vote(i, now) for i in range(25)]
+
+    async def main():
+        pool = web_db.Pool(db_file)
+        vote_writer = writer.VoteWriter(pool, interval=0.05, size=10)
+        vote_writer.start()
+        results = await asyncio.gather(*[vote_writer.add(vote, 'G') for vote in votes])
+        await vote_writer.stop()
+        await pool.close()
+        return results, vote_writer.flushes
+
+    results, flushes = asyncio.run(main())
+    assert results == [None] * len(votes)
+    # full batches are written without waiting for the interval and the rest goes in one more
+    assert flushes == 3
+    assert count_votes(db_file, votes) == len(votes)
+
+
+def test_duplicate_votes_fail_alone(web_db, db_file, now):
+    import writer
+    votes = [make_vote(i, now) for i in range(6)]
+
+    async def main():
+        pool = web_db.Pool(db_file)
+        vote_writer = writer.VoteWriter(pool)
+        vote_writer.start()
+        await vote_writer.add(votes[0], 'G')
+        # a vote that was already written and one repeated within the batch fail, the others are still written
+        results = await asyncio.gather(*[vote_writer.add(vote, 'B') for vote in votes + votes[3:4]],
+                                       return_exceptions=True)
+        await vote_writer.stop()
+        await pool.close()
+        return results
+
+    results = asyncio.run(main())
+    assert isinstance(results[0], sqlite3.IntegrityError)
+    assert results[1:6] == [None] * 5
+    assert isinstance(results[6], sqlite3.IntegrityError)
+    assert count_votes(db_file, votes) == len(votes)
@@ -5,15 +5,28 @@ from fastapi import FastAPI, Request, HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response, PlainTextResponse, JSONResponse
+from starlette.routing import Match
+from starlette.background import BackgroundTasks
 from starlette_graphene3 import GraphQLApp, make_graphiql_handler
 from graphene import ObjectType, Int, List, String, Field
-from models import Bot, Stats, Sub, VoteType, Graph
-from utils import get_ranks, get_stats, get_graph, get_subs, add_vote
+from models import Bot, Stats, Sub, VoteType, Graph, Resolution
+from loaders import Loaders
+from metrics import ResolverMetrics, REQUEST_LATENCY, WRITER_DEPTH, render
+from utils import get_ranks, get_stats, get_graph, get_subs, add_vote, pool, karma, writer, \
+    warm_up, watch_updates, export_ranks, rank_to_dict, get_data_version, HTTP_MAX_AGE, READ_ONLY
+from email.utils import formatdate, parsedate_to_datetime
 from os import environ
+from time import perf_counter
+import asyncio
+import json
 import sqlite3
 
-API_KEY = environ['API_KEY']
+# Read-only replicas take no votes, so they need no api key
+API_KEY = None if READ_ONLY else environ['API_KEY']
+MAX_BATCH_SIZE = 20
+# GET responses that only change with the data version
+CACHEABLE_PATHS = ('/graphql', '/api/getrank/', '/api/getbadge/', '/api/bots')
 
 class Query(ObjectType):
     bot = Field(Bot, name=String())
@@ -21,6 +34,8 @@ class Query(ObjectType):
                 after=String(default_value="1y"),
                 sort=String(default_value="top"),
                 limit=Int(),
+                first=Int(description="Number of ranks to return"),
+                cursor=Int(description="Rank of the last bot of the previous page"),
                 description="List of all ranks")
     subs = List(Sub,
                 after=String(default_value="1y"),
@@ -28,19 +43,21 @@ class Query(ObjectType):
                 description="List of all subreddits with votes")
     graph = Field(Graph,
                   after=String(default_value="1y"),
+                  resolution=Resolution(description="Size of each bucket, chosen from the window by default"),
                   description="Graph data")
     stats = Field(Stats,
                   after=String(default_value="1y"),
                   vote_type=VoteType())
 
     async def resolve_bot(self, info, name):
-        ranks = await get_ranks('1y', bot=name)
-        if len(ranks) < 1:
+        # every bot field of a request is answered from the same ranking
+        rank = await info.context['loaders'].bots.load(name)
+        if rank is None:
             raise GraphQLError("Bot not found")
-        return ranks[0]
+        return rank
 
-    async def resolve_bots(self, info, after, sort, limit=None):
-        return await get_ranks(after, sort, limit=limit)
+    async def resolve_bots(self, info, after, sort, limit=None, first=None, cursor=None):
+        return await get_ranks(after, sort, limit=first or limit, cursor=cursor)
 
     async def resolve_stats(self, info, after, vote_type=None):
         return await get_stats(after, vote_type)
@@ -48,8 +65,11 @@ class Query(ObjectType):
     async def resolve_subs(self, info, after, limit=None):
         return await get_subs(after, limit)
 
-    async def resolve_graph(self, info, after):
-        return await get_graph(after)
+    async def resolve_graph(self, info, after, resolution=None):
+        try:
+            return await get_graph(after, resolution.value if resolution else None)
+        except ValueError as e:
+            raise GraphQLError(str(e))
 
 
 class Vote(BaseModel):
@@ -59,9 +79,39 @@ class Vote(BaseModel):
     created_utc: int
     voter: str
 
+
+def get_context(request):
+    """Create the context of one graphql request with its own loaders."""
+    return {
+        "request": request,
+        "background": BackgroundTasks(),
+        "loaders": Loaders(),
+    }
+
+
+graphiql = make_graphiql_handler()
+
+
+async def graphql_get(request):
+    """Run a query sent as url parameters so it is cached like the other GETs, serving GraphiQL without one."""
+    if 'query' not in request.query_params:
+        return graphiql(request)
+    try:
+        variables = json.loads(request.query_params.get('variables') or 'null')
+    except ValueError:
+        return JSONResponse({'data': None, 'errors': [{'message': 'Variables must be JSON'}]}, status_code=400)
+    context = get_context(request)
+    operation = {'query': request.query_params['query'], 'variables': variables,
+                 'operationName': request.query_params.get('operationName')}
+    return JSONResponse(await execute_operation(operation, context), background=context['background'])
+
+
+schema = Schema(query=Query)
+resolver_metrics = ResolverMetrics()
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.add_route("/graphql", GraphQLApp(schema=Schema(query=Query), on_get=make_graphiql_handler()))
+app.add_route("/graphql", GraphQLApp(schema=schema, on_get=graphql_get, context_value=get_context,
+                                     middleware=[resolver_metrics]))
 templates = Jinja2Templates(directory="templates")
 
 api_keys = [
@@ -71,6 +121,11 @@ api_keys = [
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # use token authentication
 
 def api_key_auth(api_key: str = Depends(oauth2_scheme)):
+    if READ_ONLY:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Read-only replica"
+        )
     if api_key not in api_keys:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -78,6 +133,92 @@ def api_key_auth(api_key: str = Depends(oauth2_scheme)):
         )
 
 
+def is_not_modified(request, etag, updated):
+    """Check the conditional headers of a request against the current data version."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or etag[2:] in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= updated
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@app.middleware("http")
+async def http_cache(request: Request, call_next):
+    if request.method not in ('GET', 'HEAD') or not request.url.path.startswith(CACHEABLE_PATHS):
+        return await call_next(request)
+    # the GraphiQL page does not change with the data
+    if request.url.path == '/graphql' and 'query' not in request.query_params:
+        return await call_next(request)
+    version, updated = get_data_version()
+    headers = {
+        'ETag': 'W/"{}"'.format(version),
+        'Last-Modified': formatdate(updated, usegmt=True),
+        'Cache-Control': 'public, max-age={}'.format(HTTP_MAX_AGE),
+    }
+    if is_not_modified(request, headers['ETag'], updated):
+        return Response(status_code=304, headers=headers)
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+
+def get_route(scope):
+    """Get the path template a request matches so every bot shares one label."""
+    for route in app.router.routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    start = perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        REQUEST_LATENCY.observe(perf_counter() - start, request.method, get_route(request.scope), status_code)
+
+
+async def serve_updates():
+    """Warm up before reporting ready, then keep up with the ingester."""
+    try:
+        await warm_up()
+    except Exception as e:
+        print('Could not warm up: {}'.format(e))
+    app.state.ready = True
+    await watch_updates()
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.ready = False
+    await pool.open()
+    app.state.updates = asyncio.create_task(serve_updates())
+    if not READ_ONLY:
+        karma.start()
+        writer.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.updates.cancel()
+    if not READ_ONLY:
+        await writer.stop()
+        await karma.stop()
+    await pool.close()
+
+
 @app.get("/robots.txt")
 async def robots():
     return FileResponse("static/robots.txt")
@@ -106,15 +247,52 @@ async def read_stats(request: Request):
 @app.head('/api/ping')
 @app.get('/api/ping')
 async def ping():
+    # load balancers only send traffic once the standard windows are warm
+    if not app.state.ready:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Warming up")
     return 'pong'
 
 
+async def execute_operation(operation, context):
+    if not isinstance(operation, dict):
+        return {'data': None, 'errors': [{'message': 'Operation must be an object'}]}
+    result = await schema.execute_async(operation.get('query'),
+                                        variable_values=operation.get('variables'),
+                                        operation_name=operation.get('operationName'),
+                                        context_value=context,
+                                        middleware=[resolver_metrics])
+    response = {'data': result.data}
+    if result.errors:
+        response['errors'] = [error.formatted for error in result.errors]
+    return response
+
+
+@app.post('/graphql/batch')
+async def graphql_batch(request: Request):
+    """Run a list of graphql operations that share one request context."""
+    operations = await request.json()
+    if not isinstance(operations, list) or len(operations) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400,
+                            detail="Expected a list of at most {} operations".format(MAX_BATCH_SIZE))
+    context = get_context(request)
+    return await asyncio.gather(*[execute_operation(operation, context) for operation in operations])
+
+
+@app.get('/metrics')
+async def metrics():
+    if writer is not None:
+        WRITER_DEPTH.set(writer.depth)
+    async with pool.acquire() as db:
+        ingest = await db.get_ingest_metrics()
+    return PlainTextResponse(render(ingest), media_type='text/plain; version=0.0.4')
+
+
 @app.get('/api/getrank/{bot}')
 async def get_bot_rank(bot: str):
     ranks = await get_ranks('1y', bot=bot)
     if len(ranks) < 1:
         raise HTTPException(status_code=404, detail="Bot not found")
-    return ranks[0]
+    return rank_to_dict(ranks[0])
 
 
 @app.get('/api/getbadge/{bot}')
@@ -130,6 +308,18 @@ async def get_bot_rank(bot: str):
     }
 
 
+@app.get('/api/bots')
+async def export_bots(after: str = '1y', sort: str = 'top', cursor: int = None):
+    """Stream a full ranking as newline delimited json."""
+    chunks = await export_ranks(after, sort, cursor)
+    return StreamingResponse(chunks, media_type='application/x-ndjson')
+
+
+@app.get('/api/vote/queue', dependencies=[Depends(api_key_auth)])
+async def vote_queue():
+    return writer.status()
+
+
 @app.post('/api/vote/good', dependencies=[Depends(api_key_auth)])
 async def vote_good(vote: Vote):
     try:
@@ -137,6 +327,8 @@ async def vote_good(vote: Vote):
         return vote
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Vote already exists")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid vote id")
 
 
 @app.post('/api/vote/bad', dependencies=[Depends(api_key_auth)])
@@ -146,3 +338,5 @@ async def vote_good(vote: Vote):
         return vote
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Vote already exists")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid vote id")
@@ -0,0 +1,312 @@
+import asyncio
+import hashlib
+import json
+import os
+import stat
+import tempfile
+from collections import OrderedDict
+from functools import wraps
+from time import time
+from metrics import CACHE_REQUESTS, CACHE_REFRESHES
+from models import RankRow, SubRow, GraphRows
+
+TTL = 60
+STALE_TTL = 600
+MAX_ENTRIES = 256
+# Workers started by uvicorn --workers or WEB_CONCURRENCY share their results through files unless set otherwise
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'file' if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 else 'memory')
+# Only the user running the workers may read or write the cache, see _private_dir
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'botranks-cache-{}'.format(os.getuid())))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_MB', 256)) * 1024 * 1024
+# A worker computing an entry for the others is given up on after this long
+LEASE_SECONDS = 30
+LEASE_POLL = 0.05
+# Rows that file entries are decoded back into, every other value is plain json
+ROWS = {row.__name__: row for row in [RankRow, SubRow, GraphRows]}
+
+
+class MemoryStore:
+    """Entries of a single process, evicting the least recently used."""
+
+    def __init__(self, name, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lease(self, key):
+        # the cache already computes each key once per process
+        return True
+
+    def release(self, key):
+        pass
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _private_dir(path):
+    """Create a directory only the current user can use, refusing one that someone else could have written to."""
+    os.makedirs(path, 0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError('Cache directory {} is not a directory private to this user'.format(path))
+    return path
+
+
+def _encode(value):
+    """Get a json value of an entry, keeping the tuples and rows that json would turn into lists.
+
+    Dicts are written as lists of items too, so the only json objects are tags and no key of the data can be
+    mistaken for one.
+    """
+    if type(value) in ROWS.values():
+        return {'__row__': type(value).__name__, 'values': [_encode(item) for item in value]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return {'__dict__': [[_encode(key), _encode(item)] for key, item in value.items()]}
+    return value
+
+
+def _decode(obj):
+    if '__row__' in obj:
+        return ROWS[obj['__row__']](*obj['values'])
+    if '__tuple__' in obj:
+        return tuple(obj['__tuple__'])
+    return dict((key, item) for key, item in obj['__dict__'])
+
+
+class FileStore:
+    """Entries written as json to files that every worker on the host reads, evicting the oldest past a size bound.
+
+    Files are replaced atomically, so readers see a whole entry or none, and the page cache keeps the hot ones in
+    memory. Each worker keeps the last entry it read of a file until the file changes, so a hit is one stat.
+    """
+
+    def __init__(self, name, max_entries=MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, directory=CACHE_DIR):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = _private_dir(os.path.join(_private_dir(directory), name))
+        self._read = {}
+
+    def _path(self, key, ext='.json'):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + ext)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            info = os.stat(path)
+            read = self._read.get(key)
+            if read and read[0] == (info.st_ino, info.st_mtime_ns):
+                return read[1]
+            with open(path) as f:
+                stored_key, entry = json.load(f, object_hook=_decode)
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing, half written by an older version or not an entry at all
+            return None
+        # files are named by a hash of the key, so the key is kept to tell collisions apart
+        if stored_key != repr(key):
+            return None
+        self._read[key] = ((info.st_ino, info.st_mtime_ns), entry)
+        return entry
+
+    def set(self, key, entry):
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump([repr(key), _encode(entry)], f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for item in os.scandir(self.directory):
+            if item.name.endswith('.json'):
+                try:
+                    info = item.stat()
+                except OSError:
+                    continue
+                files.append((info.st_mtime_ns, info.st_size, item.path))
+        files.sort()
+        total = sum(size for mtime, size, path in files)
+        while files and (total > self.max_bytes or len(files) > self.max_entries):
+            mtime, size, path = files.pop(0)
+            total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._read = {key: read for key, read in self._read.items() if os.path.exists(self._path(key))}
+
+    def lease(self, key):
+        """Claim computing a key for every worker, taking over claims that were abandoned."""
+        path = self._path(key, '.lock')
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+            return True
+        except FileExistsError:
+            try:
+                if time() - os.stat(path).st_mtime < LEASE_SECONDS:
+                    return False
+                os.remove(path)
+            except OSError:
+                pass
+            return self.lease(key)
+
+    def release(self, key):
+        try:
+            os.remove(self._path(key, '.lock'))
+        except OSError:
+            pass
+
+    def clear(self):
+        for item in os.scandir(self.directory):
+            try:
+                os.remove(item.path)
+            except OSError:
+                pass
+        self._read.clear()
+
+
+STORES = {'memory': MemoryStore, 'file': FileStore}
+
+
+def make_store(name, max_entries=MAX_ENTRIES):
+    """Get the store of the configured backend."""
+    if CACHE_BACKEND not in STORES:
+        print('Unknown CACHE_BACKEND {}, caching in memory.'.format(CACHE_BACKEND))
+        return MemoryStore(name, max_entries)
+    try:
+        return STORES[CACHE_BACKEND](name, max_entries)
+    except OSError as e:
+        print('Could not use the {} cache, caching in memory: {}'.format(CACHE_BACKEND, e))
+        return MemoryStore(name, max_entries)
+
+
+class Cache:
+    """Cache with single-flight computation and stale-while-revalidate refreshes.
+
+    Entries computed from an older data version than version() are refreshed like expired ones.
+    """
+
+    def __init__(self, ttl=TTL, stale_ttl=STALE_TTL, max_entries=MAX_ENTRIES, name='cache', version=None, store=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.version = version or (lambda: 0)
+        self.store = store or make_store(name, max_entries)
+        self._inflight = {}
+
+    def _set(self, key, value, version):
+        now = time()
+        self.store.set(key, (value, version, now + self.ttl, now + self.ttl + self.stale_ttl))
+
+    def _get_fresh(self, key):
+        entry = self.store.get(key)
+        if entry:
+            value, version, fresh_until, stale_until = entry
+            if time() < fresh_until and version >= self.version():
+                return entry
+        return None
+
+    async def _wait(self, key):
+        """Wait for another worker to store a key, giving up when its lease runs out."""
+        for _ in range(int(LEASE_SECONDS / LEASE_POLL)):
+            await asyncio.sleep(LEASE_POLL)
+            entry = self._get_fresh(key)
+            if entry:
+                return entry
+            if self.store.lease(key):
+                return None
+        return None
+
+    async def _compute(self, key, fn):
+        leased = False
+        try:
+            leased = self.store.lease(key)
+            if not leased:
+                entry = await self._wait(key)
+                if entry:
+                    return entry[0]
+                leased = True
+            else:
+                # another worker may have stored it between the lookup and the lease
+                entry = self._get_fresh(key)
+                if entry:
+                    return entry[0]
+            version = self.version()
+            value = await fn()
+            self._set(key, value, version)
+            return value
+        finally:
+            if leased:
+                self.store.release(key)
+            self._inflight.pop(key, None)
+
+    def _refresh(self, key, fn):
+        """Start computing a key unless the same key is already being computed."""
+        task = self._inflight.get(key)
+        if task is None:
+            CACHE_REFRESHES.inc(self.name)
+            task = asyncio.ensure_future(self._compute(key, fn))
+            task.add_done_callback(_log_failure)
+            self._inflight[key] = task
+        return task
+
+    async def get(self, key, fn):
+        """Get a cached value, computing it with fn() when it is missing or stale."""
+        entry = self.store.get(key)
+        if entry:
+            value, version, fresh_until, stale_until = entry
+            now = time()
+            if now < fresh_until and version >= self.version():
+                CACHE_REQUESTS.inc(self.name, 'hit')
+                return value
+            if now < stale_until:
+                CACHE_REQUESTS.inc(self.name, 'stale')
+                self._refresh(key, fn)
+                return value
+
+        CACHE_REQUESTS.inc(self.name, 'miss')
+        # shield the shared computation so one cancelled request does not cancel it for every waiter
+        return await asyncio.shield(self._refresh(key, fn))
+
+    def clear(self):
+        self.store.clear()
+
+
+def _log_failure(task):
+    if not task.cancelled() and task.exception():
+        print('Cache refresh failed: {}'.format(task.exception()))
+
+
+def cached(ttl=TTL, stale_ttl=STALE_TTL, max_entries=MAX_ENTRIES, version=None):
+    """Cache an async function on its arguments, refreshing its results once version() moves past them."""
+    def decorator(fn):
+        cache = Cache(ttl, stale_ttl, max_entries, fn.__name__.lstrip('_'), version)
+
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            return await cache.get(key, lambda: fn(*args, **kwargs))
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
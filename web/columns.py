@@ -0,0 +1,161 @@
+from os import environ
+from time import time
+from db import MINVOTES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Rank from numpy columns of the votes instead of sql when set to numpy
+RANK_ENGINE = environ.get('RANK_ENGINE', 'sql')
+LOAD_CHUNK_SIZE = 100000
+# Votes can be added a little out of order, so every refresh looks this far back for votes it has not seen
+LATE_SECONDS = 60 * 60
+
+
+def _wilson(good, bad, total, exact):
+    """Get the lower bound of the wilson score the same way the sql of db.get_ranks computes it."""
+    # sql divides integers with integer division
+    mean = (good * bad) // total if exact else (good * bad) / total
+    # power() in sql is python's x ** 0.5, which numpy's power and sqrt do not always round the same way
+    root = np.fromiter((value ** 0.5 for value in (mean + 0.9604).tolist()), float, len(total))
+    return ((good + 1.9208) / total - 1.96 * root / total) / (1 + 3.8416 / total)
+
+
+class ColumnarRanks:
+    """Votes held in memory as numpy columns sorted by time, ranking every bot of a window in one pass."""
+
+    def __init__(self):
+        self.size = 0
+        self.bots = np.empty(0, np.int64)
+        self.timestamps = np.empty(0, np.int64)
+        self.votes = np.empty(0, np.int8)
+        self.rows = {}
+        self.ranked = np.empty(0, bool)
+        self.partitions = []
+        self.loaded = False
+        self._recent = {}
+
+    def _append(self, rows):
+        """Add (bot, timestamp, vote, id) rows, keeping the columns sorted by time."""
+        rows = [row for row in rows if row[3] not in self._recent]
+        if not rows:
+            return
+        self._recent.update((vote_id, timestamp) for bot, timestamp, vote, vote_id in rows)
+        chunk = np.array([row[:3] for row in rows], np.int64)
+        if self.size + len(chunk) > len(self.timestamps):
+            capacity = max(self.size + len(chunk), len(self.timestamps) * 2)
+            for name in ['bots', 'timestamps', 'votes']:
+                column = getattr(self, name)
+                grown = np.empty(capacity, column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+
+        # late votes are merged into the tail of the columns that is newer than the oldest of them
+        start = int(np.searchsorted(self.timestamps[:self.size], chunk[:, 1].min(), 'right'))
+        end = self.size + len(chunk)
+        for name, i in [('bots', 0), ('timestamps', 1), ('votes', 2)]:
+            column = getattr(self, name)
+            column[start:end] = np.concatenate([column[start:self.size], chunk[:, i]])
+        order = np.argsort(self.timestamps[start:end], kind='stable')
+        for name in ['bots', 'timestamps', 'votes']:
+            column = getattr(self, name)
+            column[start:end] = column[start:end][order]
+        self.size = end
+
+        cutoff = self.timestamps[self.size - 1] - LATE_SECONDS
+        self._recent = {vote_id: timestamp for vote_id, timestamp in self._recent.items() if timestamp >= cutoff}
+
+    async def _load_bots(self, db):
+        self.partitions = await db.get_partitions()
+        rows = await db.get_bots()
+        self.rows = {bot_id: (bot, link_karma, comment_karma) for bot_id, bot, link_karma, comment_karma in rows}
+        # bots are only ranked once their karma is known
+        self.ranked = np.zeros(max(self.rows, default=-1) + 1, bool)
+        self.ranked[[bot_id for bot_id, (bot, link_karma, comment_karma) in self.rows.items()
+                     if comment_karma is not None]] = True
+
+    async def load(self, db):
+        """Load every vote."""
+        self.__init__()
+        async for rows in db.iter_votes(0, LOAD_CHUNK_SIZE):
+            self._append(rows)
+        await self._load_bots(db)
+        self.loaded = True
+        print('Loaded {} votes into columns.'.format(self.size))
+
+    async def refresh(self, db, total):
+        """Add the votes since the last refresh, reloading everything when older votes were added.
+
+        total is the number of votes in the db, read before the refresh.
+        """
+        if not self.loaded:
+            return await self.load(db)
+        since = int(self.timestamps[self.size - 1]) - LATE_SECONDS if self.size else 0
+        async for rows in db.iter_votes(since, LOAD_CHUNK_SIZE):
+            self._append(rows)
+        if self.size < total:
+            print('Votes older than {} were added, reloading columns...'.format(since))
+            return await self.load(db)
+        await self._load_bots(db)
+
+    def get_ranks(self, epoch, sort, now=None, minvotes=MINVOTES):
+        """Get the same rows as db.get_ranks for every bot, without sql."""
+        if sort not in ['top', 'hot', 'controversial']:
+            sort = 'top'
+        now = now or int(time())
+        start = np.searchsorted(self.timestamps[:self.size], epoch, 'left')
+        bots = self.bots[start:self.size]
+        votes = self.votes[start:self.size]
+        length = max(len(self.ranked), int(bots.max()) + 1 if len(bots) else 0)
+        total = np.bincount(bots, minlength=length)
+        good = np.bincount(bots, weights=votes, minlength=length).astype(np.int64)
+        bad = total - good
+        ranked = np.zeros(length, bool)
+        ranked[:len(self.ranked)] = self.ranked
+        ids = np.flatnonzero(ranked & (total > 0) & (total >= minvotes))
+        good, bad, total = good[ids], bad[ids], total[ids]
+
+        top = np.round(_wilson(good, bad, total, True), 4)
+        controversial = total // (np.abs(good - bad) + 1)
+        if sort == 'hot':
+            # each vote weighs now / (now - timestamp)^2, a vote from this second has no weight in sql
+            age = now - self.timestamps[start:self.size]
+            fresh = age == 0
+            weight = np.where(fresh, 0, now / np.where(fresh, 1, age * age))
+            # sql sums each partition on its own and then adds the partitions up, oldest first
+            cuts = [0] + [int(np.searchsorted(self.timestamps[start:self.size], since, 'left'))
+                          for since in self.partitions if since > epoch] + [len(bots)]
+            good_time = np.zeros(length)
+            bad_time = np.zeros(length)
+            for i, j in zip(cuts, cuts[1:]):
+                good_time += np.bincount(bots[i:j], weights=weight[i:j] * votes[i:j], minlength=length)
+                bad_time += np.bincount(bots[i:j], weights=weight[i:j] * (1 - votes[i:j]), minlength=length)
+            good_time, bad_time = good_time[ids], bad_time[ids]
+            # so the score of a bot with nothing but weightless votes is null
+            null = np.bincount(bots[fresh], minlength=length)[ids] == total
+            with np.errstate(divide='ignore', invalid='ignore'):
+                hot = np.where(null, np.nan, _wilson(good_time, bad_time, good_time + bad_time, False))
+        else:
+            hot = _wilson(good, bad, total, True)
+
+        score = {'top': top, 'hot': hot, 'controversial': controversial}[sort]
+        # nulls rank last, ties rank by votes and then by bot id like the sql does
+        order = np.lexsort((ids, bad, -good, np.where(np.isnan(score), np.inf, -score)))
+        ranks = []
+        for rank, i in enumerate(order.tolist(), 1):
+            bot, link_karma, comment_karma = self.rows[int(ids[i])]
+            ranks.append((rank, bot, link_karma, comment_karma, int(good[i]), int(bad[i]), float(top[i]),
+                          None if np.isnan(hot[i]) else float(hot[i]), int(controversial[i])))
+        return ranks
+
+
+def make_columns():
+    """Get the columnar ranking engine if it is enabled and numpy is installed."""
+    if RANK_ENGINE != 'numpy':
+        return None
+    if np is None:
+        print('RANK_ENGINE is numpy but numpy is not installed, ranking with sql.')
+        return None
+    return ColumnarRanks()
@@ -1,50 +1,75 @@
+import asyncio
+import os
 import aiosqlite
-import sqlite3
-from os import environ
+from contextlib import asynccontextmanager
 from datetime import datetime
-from asyncpraw import Reddit
+from time import time, perf_counter
+from urllib.parse import quote
+from metrics import observe_query, POOL_WAIT
+from partitions import get_archives, get_live_since, schema_at, iter_schemas
+from timeline import BUCKETS, HOUR_IN_SECONDS
 
 MINVOTES = 3
-REDDIT_CLIENT_ID = environ['REDDIT_CLIENT_ID']
-REDDIT_CLIENT_SECRET = environ['REDDIT_CLIENT_SECRET']
-REDDIT_USERNAME = environ['REDDIT_USERNAME']
-REDDIT_PASSWORD = environ['REDDIT_PASSWORD']
+DAY_IN_SECONDS = 86400
+POOL_SIZE = 4
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KB = 16 * 1024
+VOTE_FLAGS = {'G': 1, 'B': 0}
+INTERN_CHUNK_SIZE = 500
 
 
 class DB:
-    def __init__(self, file, debug=False):
+    def __init__(self, file, debug=False, read_only=False):
         self.file = file
         self.debug = debug
+        self.read_only = read_only
         self.conn = None
+        self._ids = {}
 
     async def connect(self):
-        self.conn = await aiosqlite.connect(self.file)
+        # uris open the archived months read-only, and the live db too on read-only replicas
+        if self.read_only:
+            self.conn = await aiosqlite.connect('file:{}?mode=ro'.format(quote(os.path.abspath(self.file))), uri=True)
+        else:
+            self.conn = await aiosqlite.connect(self.file, uri=True)
+            await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA mmap_size={}".format(MMAP_SIZE))
+        await self.conn.execute("PRAGMA cache_size=-{}".format(CACHE_SIZE_KB))
         await self.conn.create_function("power", 2, lambda x, y: x ** y)
-        await self.conn.create_function("hot_weight", 2, lambda x, y: float(x) / float((x - y)**2))
+
+    async def ping(self):
+        """Check that the connection is still usable."""
+        try:
+            c = await self.conn.execute("SELECT 1")
+            return (await c.fetchone())[0] == 1
+        except Exception:
+            return False
+
+    async def _query(self, name, sql, params=()):
+        """Run a statement and fetch its rows, recording how long it took."""
+        start = perf_counter()
+        c = await self.conn.execute(sql, params)
+        rows = await c.fetchall()
+        observe_query(name, perf_counter() - start, len(rows), sql, params)
+        return rows
 
     async def _check_if_exists(self, table):
         # get the count of tables with the name
-        c = await self.conn.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=? LIMIT 1",
-                                    [table])
+        rows = await self._query('check_if_exists',
+                                 "SELECT count(name) FROM sqlite_master WHERE type='table' AND name=? LIMIT 1",
+                                 [table])
 
         # if the count is 1, then table exists
-        return (await c.fetchone())[0] == 1
-
-    async def get_latest_vote(self, vote_type):
-        """Get the last updated time."""
-        if vote_type not in ['G', 'B']:
-            vote_type = None
-        if vote_type:
-            c = await self.conn.execute('''SELECT timestamp from votes where vote = ? order by id DESC LIMIT 1''',
-                                        [vote_type])
-        else:
-            c = await self.conn.execute("SELECT timestamp from votes order by id DESC LIMIT 1")
+        return rows[0][0] == 1
 
-        query = await c.fetchone()
-        if query and len(query) > 0:
-            return query[0]
-        else:
-            return None
+    async def get_counters(self):
+        """Get the total number of votes and the time of the newest vote of each type."""
+        rows = await self._query('get_counters', '''SELECT (SELECT votes FROM vote_total WHERE id = 0),
+                                            (SELECT max(timestamp) FROM votes),
+                                            (SELECT max(timestamp) FROM votes WHERE vote = 1),
+                                            (SELECT max(timestamp) FROM votes WHERE vote = 0)''')
+        total, latest, latest_good, latest_bad = rows[0]
+        return total or 0, {'': latest, 'G': latest_good, 'B': latest_bad}
 
     async def get_ranks(self, epoch, sort, limit=None, bot=None, minvotes=MINVOTES):
         """Get ranks from db."""
@@ -53,14 +78,77 @@ class DB:
         where_str = 'where bot = \'{}\''.format(bot) if bot else ''
         limit_str = 'LIMIT {}'.format(int(limit)) if limit else ''
         now = int((datetime.now()).strftime('%s'))
-        c = await self.conn.execute('''select *
+        if sort == 'hot':
+            # The partitions are summed one at a time and combined per bot
+            await self._load_window_votes(epoch, now)
+            votes_str = '''select bot,
+                                sum(good_votes) as good_votes,
+                                sum(bad_votes) as bad_votes,
+                                sum(good_time) as good_time,
+                                sum(bad_time) as bad_time
+                            from temp.window_votes
+                            group by bot'''
+            return await self._rank(sort, votes_str, [], where_str, limit_str, minvotes)
+
+        # Sum the daily rollups for whole days and only count the raw votes of the partial first day.
+        # The time weighted columns are only ranked on by the hot sort.
+        epoch_day = epoch // DAY_IN_SECONDS
+        async with schema_at(self.conn, epoch) as schema:
+            votes_str = '''select bot,
+                                sum(good_votes) as good_votes,
+                                sum(bad_votes) as bad_votes,
+                                sum(good_votes) as good_time,
+                                sum(bad_votes) as bad_time
+                            from (select bot, good_votes, bad_votes
+                                    from bot_days
+                                    where day > ?
+                                  union all
+                                  select bot, vote, 1 - vote
+                                    from {}.votes
+                                    where timestamp >= ? AND timestamp < ?)
+                            group by bot'''.format(schema)
+            return await self._rank(sort, votes_str, [epoch_day, epoch, (epoch_day + 1) * DAY_IN_SECONDS],
+                                    where_str, limit_str, minvotes)
+
+    async def _load_window_votes(self, epoch, now):
+        """Fill temp.window_votes with the time weighted vote counts of every bot in each partition since epoch."""
+        await self.conn.execute('''CREATE TEMP TABLE IF NOT EXISTS window_votes
+                                   (bot INTEGER,
+                                   part INTEGER,
+                                   good_votes INTEGER,
+                                   bad_votes INTEGER,
+                                   good_time REAL,
+                                   bad_time REAL,
+                                   PRIMARY KEY (bot, part)) WITHOUT ROWID''')
+        await self.conn.execute("DELETE FROM temp.window_votes")
+        part = 0
+        async for schema in iter_schemas(self.conn, epoch):
+            # Weigh each vote by now / (now - timestamp)^2 in plain sql to avoid a python call per row
+            await self.conn.execute('''INSERT INTO temp.window_votes
+                                       select bot,
+                                           {1},
+                                           sum(vote),
+                                           count(*) - sum(vote),
+                                           sum(CASE WHEN vote = 1 THEN {0}.0 / (({0} - timestamp) * ({0} - timestamp))
+                                               ELSE 0 END),
+                                           sum(CASE WHEN vote = 0 THEN {0}.0 / (({0} - timestamp) * ({0} - timestamp))
+                                               ELSE 0 END)
+                                       from {2}.votes
+                                       where timestamp >= ?
+                                       group by bot'''.format(now, part, schema), [epoch])
+            # archives can only be detached outside of a transaction
+            await self.conn.commit()
+            part += 1
+
+    async def _rank(self, sort, votes_str, params, where_str, limit_str, minvotes):
+        return await self._query('get_ranks:' + sort, '''select *
             from (
                 select
                 row_number () over (
                     order by {} desc, good_votes desc, bad_votes
                 ) rank, *
                 from (
-                    select v.bot,
+                    select b.bot,
                     b.link_karma,
                     b.comment_karma,
                     v.good_votes,
@@ -74,113 +162,183 @@ class DB:
                     (v.good_time + v.bad_time)) / (
                     1 + 3.8416 / (v.good_time + v.bad_time)) as hot,
                     (v.good_votes + v.bad_votes) / (abs(v.good_votes - v.bad_votes) + 1) as controversial
-                        from (select bot,
-                                count(CASE WHEN vote = 'G' THEN 1 END) as good_votes,
-                                count(CASE WHEN vote = 'B' THEN 1 END) as bad_votes,
-                                sum(CASE WHEN vote = 'G' THEN hot_weight({}, timestamp) ELSE 0 END) as good_time,
-                                sum(CASE WHEN vote = 'B' THEN hot_weight({}, timestamp) ELSE 0 END) as bad_time
-                            from votes
-                            where timestamp >= ?
-                            group by bot) v
-                        inner join bots b on v.bot = b.bot
-                        where v.good_votes + v.bad_votes >= ?
+                        from ({}) v
+                        inner join bots b on v.bot = b.id
+                        where b.comment_karma IS NOT NULL AND v.good_votes + v.bad_votes >= ?
                 )
-            ) {} {}'''.format(sort, now, now, where_str, limit_str), [epoch, minvotes])
-        return c
+            ) {} {}'''.format(sort, votes_str, where_str, limit_str), params + [minvotes])
+
+    async def iter_votes(self, timestamp, chunk_size):
+        """Yield chunks of (bot, timestamp, vote, id) rows of the votes since timestamp in time order."""
+        start = perf_counter()
+        sql = "SELECT bot, timestamp, vote, id FROM {}.votes WHERE timestamp >= ? ORDER BY timestamp"
+        count = 0
+        # partitions hold consecutive months, so reading them oldest first keeps the rows in time order
+        async for schema in iter_schemas(self.conn, timestamp):
+            c = await self.conn.execute(sql.format(schema), [timestamp])
+            while True:
+                rows = await c.fetchmany(chunk_size)
+                if not rows:
+                    break
+                count += len(rows)
+                yield rows
+            # an archive can not be detached while it is being read
+            await c.close()
+        observe_query('iter_votes', perf_counter() - start, count, sql, [timestamp])
+
+    async def get_partitions(self):
+        """Get the time each partition of the votes starts at, oldest first."""
+        archives = await get_archives(self.conn)
+        return [since for month, since, until, file in archives] + [await get_live_since(self.conn)]
+
+    async def get_bots(self):
+        """Get the (id, bot, link_karma, comment_karma) rows of every bot."""
+        return await self._query('get_bots', "SELECT id, bot, link_karma, comment_karma FROM bots")
 
     async def get_subs(self, epoch, limit=None):
-        """Get top subreddits from db."""
+        """Get top subreddits from the daily rollups and the raw votes of the partial first day."""
         limit_str = 'LIMIT {}'.format(int(limit)) if limit else ''
-        c = await self.conn.execute('''select subreddit,
-                            sum(CASE WHEN vote = 'G' THEN 1 ELSE 0 END) as good_votes,
-                            sum(CASE WHEN vote = 'B' THEN 1 ELSE 0 END) as bad_votes
-                        from votes
-                        where subreddit IS NOT NULL AND subreddit != '' AND timestamp >= ?
-                        group by subreddit
-                        order by count(*) desc
-                        {}'''.format(limit_str), [epoch])
-        return c
-
-    async def get_vote_count(self, epoch, vote_type):
-        """Get count of specific vote type."""
-        if vote_type not in ['G', 'B']:
-            vote_type = None
-        if vote_type:
-            c = await self.conn.execute('''select sum(CASE WHEN vote = ? THEN 1 ELSE 0 END) from votes where 
-            timestamp >= ? LIMIT 1''', [vote_type, epoch])
-        else:
-            c = await self.conn.execute('''SELECT count(id) from votes where timestamp >= ?''', [epoch])
+        epoch_day = epoch // DAY_IN_SECONDS
+        async with schema_at(self.conn, epoch) as schema:
+            return await self._query('get_subs', '''select s.name,
+                            sum(v.good_votes) as good_votes,
+                            sum(v.bad_votes) as bad_votes
+                        from (select subreddit, good_votes, bad_votes
+                                from sub_days
+                                where day > ?
+                              union all
+                              select subreddit, vote, 1 - vote
+                                from {}.votes
+                                where timestamp >= ? AND timestamp < ?) v
+                        inner join subreddits s on v.subreddit = s.id
+                        group by v.subreddit
+                        order by sum(v.good_votes + v.bad_votes) desc
+                        {}'''.format(schema, limit_str), [epoch_day, epoch, (epoch_day + 1) * DAY_IN_SECONDS])
 
-        query = await c.fetchone()
-        if query and len(query) > 0:
-            return query[0]
-        else:
-            return 0
-
-    async def get_bot_count(self, epoch, minvotes=MINVOTES):
-        """Get count of bots."""
-        c = await self.conn.execute('''select count(bot)
-                from (select vo.bot,
-                        count(vote) as votes
-                    from votes vo
-                    inner join bots b on vo.bot = b.bot
-                    where timestamp >= ?
-                    group by vo.bot) v
-                where v.votes >= ?''', [epoch, minvotes])
-
-        query = await c.fetchone()
-        if query and len(query) > 0:
-            return query[0]
-        else:
-            return 0
-
-    async def get_timeline_data(self, epoch, date_format):
-        """Get data for timeline."""
-        c = await self.conn.execute('''select strftime(?, timestamp, 'unixepoch') as unit,
-                           sum(CASE WHEN vote = 'G' THEN 1 ELSE 0 END) as good_votes,
-                           sum(CASE WHEN vote = 'B' THEN 1 ELSE 0 END) as bad_votes
-                    from votes
-                    where timestamp >= ?
-                    group by unit''', [date_format, epoch])
-        return c
-
-    async def add_bot(self, user):
-        async with Reddit(
-            client_id=REDDIT_CLIENT_ID,
-            client_secret=REDDIT_CLIENT_SECRET,
-            password=REDDIT_PASSWORD,
-            user_agent='mobile:botranker:0.1 (by /u/brandawg93)',
-            username=REDDIT_USERNAME) as r:
-            bot = await r.redditor(user)
-            await bot.load()
-            try:
-                # Insert a row of data
-                data = [str(bot.name), bot.comment_karma, bot.link_karma]
-                await self.conn.execute("INSERT INTO bots VALUES (?, ?, ?)", data)
-                print('Adding bot {} with comment karma={}, link karma={}.'.format(bot.name, bot.comment_karma,
-                                                                                        bot.link_karma))
-            except sqlite3.IntegrityError:
-                data = [bot.comment_karma, bot.link_karma, str(bot.name)]
-                await self.conn.execute("UPDATE bots SET comment_karma = ?, link_karma = ? WHERE bot = ?", data)
-                print('Updating bot {} with comment karma={}, link karma={}.'.format(bot.name, bot.comment_karma,
-                                                                                            bot.link_karma))
-
-            except Exception as e:
-                print(e)
-
-
-    async def add_vote(self, vote, vote_type):
-        # Insert a row of data
-        await self.conn.execute("INSERT INTO votes VALUES (?, ?, ?, ?, ?, ?)",
-                    [vote.parent,
-                    vote.id,
-                    vote.subreddit,
-                    vote.created_utc,
-                    vote_type[0],
-                    vote.voter
-                    ])
-        print('Adding vote with id={}, bot={}, vote={}.'.format(vote.id, vote.parent, vote_type[0]))
-        await self.add_bot(vote.parent)
+    async def get_vote_counts(self, epoch):
+        """Get the count of all, good and bad votes from the hourly rollups and the partial first hour."""
+        epoch_hour = epoch // HOUR_IN_SECONDS
+        async with schema_at(self.conn, epoch) as schema:
+            rows = await self._query('get_vote_counts', '''select sum(good_votes + bad_votes), sum(good_votes)
+                        from (select good_votes, bad_votes
+                                from vote_hours
+                                where hour > ?
+                              union all
+                              select vote, 1 - vote
+                                from {}.votes
+                                where timestamp >= ? AND timestamp < ?)'''.format(schema),
+                                     [epoch_hour, epoch, (epoch_hour + 1) * HOUR_IN_SECONDS])
+        total, good = rows[0]
+        total = total or 0
+        good = good or 0
+        return {'': total, 'G': good, 'B': total - good}
+
+    async def get_timeline(self, epoch, resolution):
+        """Get the vote counts of each bucket since epoch from the hourly rollups."""
+        epoch_hour = epoch // HOUR_IN_SECONDS
+        async with schema_at(self.conn, epoch) as schema:
+            return await self._query('get_timeline:' + resolution, '''select {} as bucket,
+                           sum(good_votes),
+                           sum(bad_votes)
+                    from (select hour, good_votes, bad_votes
+                            from vote_hours
+                            where hour > ?
+                          union all
+                          select timestamp / {}, vote, 1 - vote
+                            from {}.votes
+                            where timestamp >= ? AND timestamp < ?)
+                    group by bucket
+                    order by bucket'''.format(BUCKETS[resolution], HOUR_IN_SECONDS, schema),
+                                     [epoch_hour, epoch, (epoch_hour + 1) * HOUR_IN_SECONDS])
+
+    async def get_snapshot_version(self):
+        """Get the version of the latest snapshot published by the ingester."""
+        if not await self._check_if_exists('snapshots'):
+            return None
+        rows = await self._query('get_snapshot_version', "SELECT max(version) FROM snapshots")
+        return rows[0][0]
+
+    async def get_snapshot(self, version):
+        """Get the publish time and data of a snapshot."""
+        rows = await self._query('get_snapshot', "SELECT timestamp, data FROM snapshots WHERE version = ?", [version])
+        return rows[0] if rows else None
+
+    async def get_ingest_metrics(self):
+        """Get the (name, value) counters and gauges recorded by the ingester."""
+        if not await self._check_if_exists('ingest_metrics'):
+            return []
+        return await self._query('get_ingest_metrics', "SELECT name, value FROM ingest_metrics ORDER BY name")
+
+    async def get_stale_bots(self, names, ttl):
+        """Get the bots whose karma is missing or older than ttl."""
+        unique = list(dict.fromkeys(names))
+        fresh = set()
+        # only the asked for bots are read, through the unique index on bot
+        for i in range(0, len(unique), INTERN_CHUNK_SIZE):
+            chunk = unique[i:i + INTERN_CHUNK_SIZE]
+            rows = await self._query('get_stale_bots', "SELECT bot FROM bots WHERE bot IN ({}) AND last_refreshed >= ?"
+                                     .format(', '.join('?' * len(chunk))), chunk + [int(time()) - ttl])
+            fresh.update(row[0] for row in rows)
+        return [name for name in unique if name not in fresh]
+
+    async def update_bots(self, rows):
+        """Add or update bots from (bot, comment_karma, link_karma, last_refreshed) rows."""
+        await self.conn.executemany('''INSERT INTO bots (bot, comment_karma, link_karma, last_refreshed)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (bot) DO UPDATE SET comment_karma = excluded.comment_karma,
+                                            link_karma = excluded.link_karma,
+                                            last_refreshed = excluded.last_refreshed''', rows)
+
+    async def _intern(self, table, column, names):
+        """Get the ids of names in a dimension table, adding the missing ones."""
+        ids = self._ids.setdefault(table, {})
+        missing = list(set(name for name in names if name and name not in ids))
+        await self.conn.executemany("INSERT OR IGNORE INTO {} ({}) VALUES (?)".format(table, column),
+                                    [[name] for name in missing])
+        for i in range(0, len(missing), INTERN_CHUNK_SIZE):
+            chunk = missing[i:i + INTERN_CHUNK_SIZE]
+            c = await self.conn.execute("SELECT id, {1} FROM {0} WHERE {1} IN ({2})".format(
+                table, column, ', '.join('?' * len(chunk))), chunk)
+            ids.update((name, row_id) for row_id, name in await c.fetchall())
+        return ids
+
+    async def add_votes(self, votes):
+        """Insert (vote, vote_type) pairs in one transaction and return whether each one was new."""
+        # take the write lock first so no other writer can add an id between the check and the insert
+        start = perf_counter()
+        live_since = await get_live_since(self.conn)
+        await self.conn.execute("BEGIN IMMEDIATE")
+        ids = [int(vote.id, 36) for vote, vote_type in votes]
+        c = await self.conn.execute("SELECT id FROM votes WHERE id IN ({})".format(', '.join('?' * len(ids))), ids)
+        existing = set(row[0] for row in await c.fetchall())
+        bots = await self._intern('bots', 'bot', [vote.parent for vote, vote_type in votes])
+        subreddits = await self._intern('subreddits', 'name', [vote.subreddit for vote, vote_type in votes])
+        authors = await self._intern('authors', 'name', [vote.voter for vote, vote_type in votes])
+        inserted = []
+        rows = []
+        for vote_id, (vote, vote_type) in zip(ids, votes):
+            # archived months are immutable, so their late votes are dropped
+            if vote.created_utc < live_since:
+                existing.add(vote_id)
+            inserted.append(vote_id not in existing)
+            if vote_id not in existing:
+                existing.add(vote_id)
+                rows.append([vote_id, bots[vote.parent], subreddits.get(vote.subreddit), authors.get(vote.voter),
+                             vote.created_utc, VOTE_FLAGS[vote_type[0]]])
+        await self.conn.executemany('''INSERT INTO votes (id, bot, subreddit, author, timestamp, vote)
+            VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        await self.conn.commit()
+        observe_query('add_votes', perf_counter() - start, len(rows), 'INSERT INTO votes', len(votes))
+        print('Added {} of {} votes.'.format(len(rows), len(votes)))
+        return inserted
+
+    async def commit(self):
+        await self.conn.commit()
+
+    async def rollback(self):
+        await self.conn.rollback()
+        # interned ids from the rolled back transaction no longer exist
+        self._ids.clear()
 
     async def close(self):
         # commit the changes to db
@@ -188,3 +346,58 @@ class DB:
 
         # close the connection
         await self.conn.close()
+
+
+class Pool:
+    """Bounded pool of long-lived connections shared by the whole process."""
+
+    def __init__(self, file, size=POOL_SIZE, read_only=False):
+        self.file = file
+        self.size = size
+        self.read_only = read_only
+        self._queue = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        db = DB(self.file, read_only=self.read_only)
+        await db.connect()
+        return db
+
+    async def open(self):
+        async with self._lock:
+            if self._queue is not None:
+                return
+            queue = asyncio.Queue(maxsize=self.size)
+            for _ in range(self.size):
+                queue.put_nowait(await self._connect())
+            self._queue = queue
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a connection, replacing it first if it no longer responds."""
+        if self._queue is None:
+            await self.open()
+        start = perf_counter()
+        db = await self._queue.get()
+        POOL_WAIT.observe(perf_counter() - start)
+        try:
+            if not await db.ping():
+                try:
+                    await db.conn.close()
+                except Exception:
+                    pass
+                db = await self._connect()
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
+        finally:
+            self._queue.put_nowait(db)
+
+    async def close(self):
+        async with self._lock:
+            if self._queue is None:
+                return
+            while not self._queue.empty():
+                await self._queue.get_nowait().close()
+            self._queue = None
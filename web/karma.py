@@ -0,0 +1,91 @@
+import asyncio
+from os import environ
+from time import time
+
+KARMA_TTL = 24 * 60 * 60
+BATCH_SIZE = 100
+BATCH_DELAY = 1
+CONCURRENCY = 8
+
+
+def make_reddit():
+    # asyncpraw is only imported once a vote needs karma, read-only replicas never load it
+    from asyncpraw import Reddit
+    return Reddit(
+        client_id=environ['REDDIT_CLIENT_ID'],
+        client_secret=environ['REDDIT_CLIENT_SECRET'],
+        password=environ['REDDIT_PASSWORD'],
+        user_agent='mobile:botranker:0.1 (by /u/brandawg93)',
+        username=environ['REDDIT_USERNAME'])
+
+
+class KarmaRefresher:
+    """Background queue that refreshes the karma of voted bots with one shared reddit session."""
+
+    def __init__(self, pool, reddit_factory=make_reddit, ttl=KARMA_TTL, batch_size=BATCH_SIZE):
+        self.pool = pool
+        self.reddit_factory = reddit_factory
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.reddit = None
+        self._queue = asyncio.Queue()
+        self._pending = set()
+        self._task = None
+
+    def submit(self, bot):
+        """Queue a bot for a karma refresh unless it is already queued."""
+        if bot not in self._pending:
+            self._pending.add(bot)
+            self._queue.put_nowait(bot)
+
+    async def _next_batch(self):
+        """Wait for a bot, then give later votes a moment to join its batch."""
+        batch = [await self._queue.get()]
+        await asyncio.sleep(BATCH_DELAY)
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        self._pending.difference_update(batch)
+        return batch
+
+    async def _fetch(self, name, semaphore):
+        async with semaphore:
+            try:
+                bot = await self.reddit.redditor(name, fetch=True)
+                return [str(bot.name), bot.comment_karma, bot.link_karma, int(time())]
+            except Exception as e:
+                print('Could not refresh bot {}: {}'.format(name, e))
+                return None
+
+    async def refresh(self, names):
+        """Refresh the karma of the bots that are stale."""
+        async with self.pool.acquire() as db:
+            names = await db.get_stale_bots(names, self.ttl)
+        if not names:
+            return 0
+        if self.reddit is None:
+            self.reddit = self.reddit_factory()
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        rows = [row for row in await asyncio.gather(*[self._fetch(name, semaphore) for name in names]) if row]
+        async with self.pool.acquire() as db:
+            await db.update_bots(rows)
+            await db.commit()
+        print('Refreshed karma of {} bots.'.format(len(rows)))
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.refresh(batch)
+            except Exception as e:
+                print(e)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self.reddit is not None:
+            await self.reddit.close()
+            self.reddit = None
@@ -0,0 +1,49 @@
+import asyncio
+from utils import get_ranking
+
+
+class RankingLoader:
+    """Rankings memoized for the lifetime of one request."""
+
+    def __init__(self):
+        self._rankings = {}
+
+    def load(self, after='1y', sort='top'):
+        key = (after, sort)
+        if key not in self._rankings:
+            self._rankings[key] = asyncio.ensure_future(get_ranking(after, sort))
+        return self._rankings[key]
+
+
+class BotLoader:
+    """Collects the bot lookups of one request and answers them together from a single ranking."""
+
+    def __init__(self, rankings):
+        self.rankings = rankings
+        self._queue = []
+
+    def load(self, name):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._queue:
+            # dispatch once every resolver waiting in this loop iteration has queued its name
+            loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        self._queue.append((name, future))
+        return future
+
+    async def _dispatch(self):
+        queue, self._queue = self._queue, []
+        try:
+            ranks, bots = await self.rankings.load('1y', 'top')
+        except Exception as e:
+            for name, future in queue:
+                future.set_exception(e)
+            return
+        for name, future in queue:
+            future.set_result(bots.get(name))
+
+
+class Loaders:
+    def __init__(self):
+        self.rankings = RankingLoader()
+        self.bots = BotLoader(self.rankings)
@@ -0,0 +1,131 @@
+from inspect import isawaitable
+from os import environ
+from time import perf_counter
+
+PREFIX = 'botranks_'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_SECONDS = float(environ.get('SLOW_QUERY_MS', 250)) / 1000
+
+registry = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        for values, value in self.values.items():
+            yield self.name + _format_labels(self.labels, values), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend('{} {}'.format(sample, value) for sample, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            # a count per bucket, then the sum and the count of every observation
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def samples(self):
+        for values, counts in self.values.items():
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + '_bucket' + _format_labels(self.labels + ('le',), values + (bound,)), count
+            yield self.name + '_bucket' + _format_labels(self.labels + ('le',), values + ('+Inf',)), counts[-1]
+            yield self.name + '_sum' + _format_labels(self.labels, values), round(counts[-2], 6)
+            yield self.name + '_count' + _format_labels(self.labels, values), counts[-1]
+
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Latency of http requests by route.',
+                            ('method', 'route', 'status'))
+RESOLVER_LATENCY = Histogram('graphql_resolver_duration_seconds', 'Latency of top level graphql fields.',
+                             ('field',))
+QUERY_LATENCY = Histogram('sql_query_duration_seconds', 'Time to run a sql statement and fetch its rows.',
+                          ('query',))
+QUERY_ROWS = Counter('sql_query_rows_total', 'Rows returned by sql statements.', ('query',))
+SLOW_QUERIES = Counter('sql_slow_queries_total', 'Sql statements slower than the slow query threshold.',
+                       ('query',))
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups by result.', ('cache', 'result'))
+CACHE_REFRESHES = Counter('cache_refreshes_total', 'Cache entries computed or refreshed.', ('cache',))
+POOL_WAIT = Histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection.')
+WRITER_DEPTH = Gauge('vote_writer_queue_depth', 'Votes waiting to be written.')
+
+
+def observe_query(name, elapsed, rows, sql, params):
+    """Record the timing of a sql statement and log it when it is slow."""
+    QUERY_LATENCY.observe(elapsed, name)
+    QUERY_ROWS.inc(name, amount=rows)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        SLOW_QUERIES.inc(name)
+        print('Slow query {} took {:.0f}ms with params {}: {}'.format(name, elapsed * 1000, params,
+                                                                      ' '.join(sql.split())))
+
+
+class ResolverMetrics:
+    """Graphql middleware timing the top level fields of each operation."""
+
+    def resolve(self, next, root, info, **args):
+        if info.parent_type.name != 'Query':
+            return next(root, info, **args)
+        start = perf_counter()
+        result = next(root, info, **args)
+        if isawaitable(result):
+            return self._timed(result, info.field_name, start)
+        RESOLVER_LATENCY.observe(perf_counter() - start, info.field_name)
+        return result
+
+    async def _timed(self, result, field, start):
+        try:
+            return await result
+        finally:
+            RESOLVER_LATENCY.observe(perf_counter() - start, field)
+
+
+def render(extra=()):
+    """Get every metric in the prometheus text format, followed by extra (name, value) gauges."""
+    lines = [metric.render() for metric in registry]
+    for name, value in extra:
+        kind = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append('# TYPE {0}{1} {2}\n{0}{1} {3}'.format(PREFIX, name, kind, value))
+    return '\n'.join(lines) + '\n'
@@ -1,11 +1,24 @@
+from collections import namedtuple
 from graphene import ObjectType, String, Float, Int, Enum, Field, List
 
+# Compact rows that results are cached as, the graphene types below resolve their fields from them
+RankRow = namedtuple('RankRow', ['rank', 'name', 'score', 'good', 'bad', 'link', 'comment'])
+SubRow = namedtuple('SubRow', ['name', 'good', 'bad'])
+GraphRows = namedtuple('GraphRows', ['labels', 'timestamps', 'good', 'bad'])
+
 
 class VoteType(Enum):
     GOOD = 'G'
     BAD = 'B'
 
 
+class Resolution(Enum):
+    HOURLY = 'hourly'
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+
+
 class VotesStats(ObjectType):
     latest = Int(description="Epoch of the latest vote")
     count = Int(description="Total number of votes")
@@ -27,8 +40,12 @@ class Votes(ObjectType):
 
 class Graph(ObjectType):
     labels = List(String)
+    timestamps = List(Int, description="Epoch of the start of each bucket")
     votes = List(Votes)
 
+    def resolve_votes(parent, info):
+        return [Votes(good=good, bad=bad) for good, bad in zip(parent.good, parent.bad)]
+
 
 class Karma(ObjectType):
     link = Int()
@@ -42,7 +59,16 @@ class Bot(ObjectType):
     votes = Field(Votes)
     karma = Field(Karma)
 
+    def resolve_votes(parent, info):
+        return Votes(good=parent.good, bad=parent.bad)
+
+    def resolve_karma(parent, info):
+        return Karma(link=parent.link, comment=parent.comment)
+
 
 class Sub(ObjectType):
     name = String()
     votes = Field(Votes)
+
+    def resolve_votes(parent, info):
+        return Votes(good=parent.good, bad=parent.bad)
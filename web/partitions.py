@@ -0,0 +1,51 @@
+import os
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+
+
+async def get_archives(conn, epoch=0):
+    """Get the (month, since, until, file) rows of the archived months with votes since epoch, oldest first."""
+    c = await conn.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='partitions'")
+    if (await c.fetchone())[0] == 0:
+        return []
+    c = await conn.execute("SELECT month, since, until, file FROM partitions WHERE until > ? ORDER BY since",
+                           [epoch])
+    return await c.fetchall()
+
+
+async def get_live_since(conn):
+    """Get the time the live partition starts at, every vote before it is archived by the ingester."""
+    archives = await get_archives(conn)
+    return archives[-1][2] if archives else 0
+
+
+@asynccontextmanager
+async def attach(conn, file, schema='archive'):
+    """Attach an archive next to the main db read-only while the block runs."""
+    c = await conn.execute("PRAGMA database_list")
+    main = (await c.fetchone())[2]
+    path = os.path.join(os.path.dirname(main), file)
+    await conn.execute("ATTACH DATABASE ? AS {}".format(schema), ['file:{}?mode=ro'.format(quote(path))])
+    try:
+        yield schema
+    finally:
+        await conn.execute("DETACH DATABASE {}".format(schema))
+
+
+@asynccontextmanager
+async def schema_at(conn, timestamp):
+    """Get the schema holding the votes of a timestamp, attaching its archive if it has one."""
+    for month, since, until, file in await get_archives(conn, timestamp):
+        if since <= timestamp:
+            async with attach(conn, file) as schema:
+                yield schema
+            return
+    yield 'main'
+
+
+async def iter_schemas(conn, epoch):
+    """Yield the schema of every partition with votes since epoch, oldest first, attaching archives one at a time."""
+    for month, since, until, file in await get_archives(conn, epoch):
+        async with attach(conn, file) as schema:
+            yield schema
+    yield 'main'
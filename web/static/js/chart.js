@@ -214,14 +214,13 @@ function loadData(time) {
 	}`;
 	$.ajax({
 		url: "/graphql",
-		method: "POST",
-		contentType: "application/json",
-		data: JSON.stringify({
+		method: "GET",
+		data: {
 			query: query,
-			variables: {
+			variables: JSON.stringify({
 				after: time
-			}
-		})
+			})
+		}
 	}).done(function( data ) {
         $('#loader').remove();
         destroyAllCharts();
@@ -1,6 +1,17 @@
+const PAGE_SIZE = 100;
+let currentLoad = 0;
+
+function loadRemaining(after, sort, cursor) {
+	let params = $.param({after: after || '1y', sort: sort || 'top', cursor: cursor});
+	return fetch('/api/bots?' + params)
+		.then((response) => response.text())
+		.then((text) => text.split('\n').filter((line) => line).map((line) => JSON.parse(line)));
+}
+
 function loadData(after, sort) {
-	let query = `query ($after:String, $sort:String) {
-	  bots(after: $after, sort: $sort) {
+	let load = ++currentLoad;
+	let query = `query ($after:String, $sort:String, $first:Int) {
+	  bots(after: $after, sort: $sort, first: $first) {
 		rank
 		name
 		score
@@ -22,15 +33,15 @@ function loadData(after, sort) {
 	}`;
 	$.ajax({
 		url: "/graphql",
-		method: "POST",
-		contentType: "application/json",
-		data: JSON.stringify({
+		method: "GET",
+		data: {
 			query: query,
-			variables: {
+			variables: JSON.stringify({
 				after: after,
-				sort: sort
-			}
-		})
+				sort: sort,
+				first: PAGE_SIZE
+			})
+		}
 	}).done(function(response) {
 		let data = response.data;
 		let bots = data['bots'];
@@ -45,6 +56,7 @@ function loadData(after, sort) {
 		lastUpdate.text("Latest Vote: " + d.toLocaleDateString() + " " + d.toLocaleTimeString())
 		totalVotes.text("Total Votes: " + addCommas(voteCount));
 		let firstLoad = true;
+		let complete = bots.length < PAGE_SIZE;
 		let grid = $('#ranksGrid');
 		let searchbar = $('.searchbar');
 		grid.jsGrid({
@@ -53,18 +65,19 @@ function loadData(after, sort) {
 			editing: false,
 			sorting: true,
 			paging: true,
-			pageSize: 100,
+			pageSize: PAGE_SIZE,
 			pageButtonCount: 3,
 			data: bots,
 			noDataContent: 'Bot not found',
 			onRefreshed() {
-				if (firstLoad) {
+				// search and bot selection need the full ranking
+				if (firstLoad && complete) {
 					firstLoad = false;
 					searchbar.show();
 					let bot = getUrlParameter('bot');
-					if (typeof bot !== 'undefined') {
-						let rank = bots.find((x) => x['name'] === bot);
-						let page = Math.ceil(rank['rank'] / 100);
+					let rank = bots.find((x) => x['name'] === bot);
+					if (typeof rank !== 'undefined') {
+						let page = Math.ceil(rank['rank'] / PAGE_SIZE);
 						if (page > 1) {
 							let gridData = grid.data('JSGrid');
 							gridData.openPage(page);
@@ -93,6 +106,18 @@ function loadData(after, sort) {
 			]
 		}).data('JSGrid');
 
+		if (!complete) {
+			loadRemaining(after, sort, bots[bots.length - 1]['rank']).then(function(remaining) {
+				// a newer window or sort has been selected since
+				if (load !== currentLoad) {
+					return;
+				}
+				bots = bots.concat(remaining);
+				complete = true;
+				grid.jsGrid('option', 'data', bots);
+			});
+		}
+
 		searchbar.keyup(function() {
 			let val = $(this).val();
 			let filtered = $.grep( bots, function( rank ) {
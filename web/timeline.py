@@ -0,0 +1,92 @@
+import datetime
+
+HOUR_IN_SECONDS = 3600
+DAY_IN_SECONDS = 86400
+# Enough for a year of hours, each bucket of a graph is built in python
+MAX_BUCKETS = 9000
+
+# Bucket of an hour of vote_hours at each resolution, weeks start on monday and the epoch was a thursday
+BUCKETS = {
+    'hourly': 'hour',
+    'daily': 'hour / 24',
+    'weekly': '(hour / 24 + 3) / 7',
+    'monthly': "strftime('%Y-%m', hour * 3600, 'unixepoch')",
+}
+LABEL_FORMATS = {
+    'hourly': '%b %d %H:00',
+    'daily': '%b %d',
+    'weekly': 'Week of %b %d',
+    'monthly': '%B %Y',
+}
+# Resolution a window is graphed at unless one is requested
+DEFAULT_RESOLUTIONS = {
+    'h': 'hourly',
+    'd': 'hourly',
+    'w': 'daily',
+    'M': 'daily',
+    'y': 'monthly',
+}
+
+
+def default_resolution(after):
+    return DEFAULT_RESOLUTIONS.get(after[-1], 'hourly')
+
+
+def get_bucket(timestamp, resolution):
+    """Get the bucket of a timestamp the same way the timeline query groups hours."""
+    if resolution == 'monthly':
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m')
+    hour = timestamp // HOUR_IN_SECONDS
+    if resolution == 'daily':
+        return hour // 24
+    if resolution == 'weekly':
+        return (hour // 24 + 3) // 7
+    return hour
+
+
+def get_bucket_start(bucket, resolution):
+    """Get the epoch of the start of a bucket."""
+    if resolution == 'monthly':
+        year, month = bucket.split('-')
+        return int(datetime.datetime(int(year), int(month), 1, tzinfo=datetime.timezone.utc).timestamp())
+    if resolution == 'daily':
+        return bucket * DAY_IN_SECONDS
+    if resolution == 'weekly':
+        return (bucket * 7 - 3) * DAY_IN_SECONDS
+    return bucket * HOUR_IN_SECONDS
+
+
+def get_next_bucket(bucket, resolution):
+    if resolution == 'monthly':
+        year, month = (int(x) for x in bucket.split('-'))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return '{:04d}-{:02d}'.format(year, month)
+    return bucket + 1
+
+
+def count_buckets(epoch, now, resolution):
+    """Get the number of buckets get_series returns from epoch to now without building them."""
+    first = get_bucket(epoch, resolution)
+    last = get_bucket(now, resolution)
+    if resolution == 'monthly':
+        (first_year, first_month), (last_year, last_month) = [(int(x) for x in bucket.split('-'))
+                                                              for bucket in [first, last]]
+        return (last_year - first_year) * 12 + last_month - first_month + 1
+    return last - first + 1
+
+
+def get_series(rows, epoch, now, resolution):
+    """Get the start, good and bad votes of every bucket from epoch to now in chronological order."""
+    counts = {bucket: (good_votes, bad_votes) for bucket, good_votes, bad_votes in rows}
+    bucket = get_bucket(epoch, resolution)
+    last = get_bucket(now, resolution)
+    series = []
+    while bucket <= last:
+        good_votes, bad_votes = counts.get(bucket, (0, 0))
+        series.append((get_bucket_start(bucket, resolution), good_votes, bad_votes))
+        bucket = get_next_bucket(bucket, resolution)
+    return series
+
+
+def get_label(timestamp, resolution):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime(LABEL_FORMATS[resolution])
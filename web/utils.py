@@ -1,19 +1,60 @@
+import asyncio
 import datetime
-from db import DB
-from models import Bot, Stats, Votes, Karma, VotesStats, BotsStats, Sub, Graph
-from aiocache import cached
-from aiocache.serializers import PickleSerializer
+import json
+from os import environ
+from time import time, perf_counter
+from db import Pool
+from columns import make_columns
+from models import Stats, VotesStats, BotsStats, RankRow, SubRow, GraphRows
+from cache import cached, MemoryStore
+from metrics import CACHE_REQUESTS
+from timeline import BUCKETS, MAX_BUCKETS, default_resolution, count_buckets, get_series, get_label
 
 DB_FILE = '../votes.db'
 TTL = 60
+SORTS = ['top', 'hot', 'controversial']
+SNAPSHOT_POLL = 10
+SNAPSHOT_MAX_AGE = 30 * 60
+# Clients and CDNs may reuse a response for as long as the ingester takes to publish a new snapshot of the votes
+HTTP_MAX_AGE = 60
+EXPORT_CHUNK_SIZE = 500
+# Replicas that only serve reads open the db read-only and never load reddit or the vote writer
+READ_ONLY = environ.get('READ_ONLY') == '1'
+# Windows computed before the app reports ready, the same ones the ingester publishes snapshots of
+WINDOWS = ['1d', '1w', '1M', '1y']
 
+pool = Pool(DB_FILE, read_only=READ_ONLY)
+if READ_ONLY:
+    karma = None
+    writer = None
+else:
+    from karma import KarmaRefresher
+    from writer import VoteWriter
+    karma = KarmaRefresher(pool)
+    writer = VoteWriter(pool)
+columns = make_columns()
+snapshot = None
+# Cached rankings are stored without their index, which is kept by each worker instead
+ranking_indexes = MemoryStore('ranking_indexes')
 
-def get_epoch(after):
-    """Get epoch from string."""
+
+def parse_after(after):
+    """Get length and unit from string."""
     length = abs(int(after[:-1]))
     l_type = after[-1]
     if l_type not in 'hdwMy':
         l_type = 'h'
+    return length, l_type
+
+
+def normalize_after(after):
+    """Get the canonical form of a time string so equal windows share cache entries."""
+    return '{}{}'.format(*parse_after(after))
+
+
+def get_epoch(after):
+    """Get epoch from string."""
+    length, l_type = parse_after(after)
     tdelta = None
     if l_type == 'h':
         tdelta = datetime.timedelta(hours=length)
@@ -29,136 +70,283 @@ def get_epoch(after):
 
 
 async def add_vote(vote, vote_type):
-    db = DB(DB_FILE)
-    try:
-        await db.connect()
-        await db.add_vote(vote, vote_type)
-        await db.close()
-    except Exception as e:
-        await db.close()
-        raise e
-
-@cached(ttl=TTL, serializer=PickleSerializer())
-async def get_ranks(after='1y', sort='top', bot=None, limit=None):
-    if sort == 'hot':
-        after = '1y'
-    epoch = get_epoch(after)
-    ranks = []
-    db = DB(DB_FILE)
-    await db.connect()
-    data = await db.get_ranks(epoch, sort, bot=bot, limit=limit)
-
-    async for row in data:
-        rank_num, bot, link_karma, comment_karma, good_bots, bad_bots, top_score, hot_score, controversial_score = row
-        rank = Bot()
-        rank.rank = rank_num
-        rank.name = bot
-        rank.score = top_score
-        votes = Votes()
-        votes.good = good_bots
-        votes.bad = bad_bots
-        rank.votes = votes
-        karma = Karma()
-        karma.link = link_karma
-        karma.comment = comment_karma
-        rank.karma = karma
-        ranks.append(rank)
-    await db.close()
-    return ranks
-
-
-@cached(ttl=TTL, serializer=PickleSerializer())
-async def get_stats(after='1y', vote=None):
-    vote_type = None
-    if vote:
-        vote_type = vote.value
+    await writer.add(vote, vote_type)
+    counters.add(vote_type, vote.created_utc)
+    karma.submit(vote.parent)
+
+
+class Counters:
+    """Total vote count and newest vote time of each vote type, kept in memory."""
+
+    def __init__(self):
+        self.total = 0
+        self.latest = {'': None, 'G': None, 'B': None}
+
+    async def load(self, db):
+        self.total, self.latest = await db.get_counters()
+
+    def add(self, vote_type, timestamp):
+        self.total += 1
+        for key in ['', vote_type[0]]:
+            if self.latest[key] is None or timestamp > self.latest[key]:
+                self.latest[key] = timestamp
+
+
+counters = Counters()
+
+
+def _limit(lst, limit):
+    return lst[:limit] if limit and limit > 0 else lst
+
+
+def _after_cursor(ranks, cursor):
+    """Get the ranks after the rank of a cursor."""
+    if not cursor or cursor < 0:
+        return ranks
+    # ranks are numbered from 1 without gaps, so the rank is also the index of the next page
+    return ranks[cursor:]
+
+
+def _make_ranks(rows):
+    return [RankRow(rank_num, bot, top_score, good_bots, bad_bots, link_karma, comment_karma)
+            for rank_num, bot, link_karma, comment_karma, good_bots, bad_bots, top_score, hot_score,
+            controversial_score in rows]
+
+
+def _make_ranking(rows):
+    """Get ranks from rows along with an index of them by bot name."""
+    ranks = _make_ranks(rows)
+    return ranks, {rank.name: rank for rank in ranks}
+
+
+def _index_ranking(key, ranks):
+    """Get cached ranks along with their index by bot name, built again only when the cache returns new ranks."""
+    ranking = ranking_indexes.get(key)
+    if ranking is None or ranking[0] is not ranks:
+        ranking = (ranks, {rank.name: rank for rank in ranks})
+        ranking_indexes.set(key, ranking)
+    return ranking
+
+
+def _make_stats(latest, count, bots_count):
     stats = Stats()
-    epoch = get_epoch(after)
-    db = DB(DB_FILE)
-    await db.connect()
     votes_stats = VotesStats()
-    votes_stats.latest = await db.get_latest_vote(vote_type)
-    votes_stats.count = await db.get_vote_count(epoch, vote_type)
+    votes_stats.latest = latest
+    votes_stats.count = count
     stats.votes = votes_stats
     bots_stats = BotsStats()
-    bots_stats.count = await db.get_bot_count(epoch)
+    bots_stats.count = bots_count
     stats.bots = bots_stats
-    await db.close()
     return stats
 
 
-@cached(ttl=TTL, serializer=PickleSerializer())
-async def get_subs(after='1y', limit=None):
+def _make_subs(rows):
+    return [SubRow(*row) for row in rows]
+
+
+def _make_graph(rows, epoch, now, resolution):
+    series = get_series(rows, epoch, now, resolution)
+    return GraphRows([get_label(start, resolution) for start, good_votes, bad_votes in series],
+                     [start for start, good_votes, bad_votes in series],
+                     [good_votes for start, good_votes, bad_votes in series],
+                     [bad_votes for start, good_votes, bad_votes in series])
+
+
+async def refresh_snapshot():
+    """Load the latest snapshot published by the ingester if it has changed."""
+    global snapshot
+    async with pool.acquire() as db:
+        version = await db.get_snapshot_version()
+        if version is None or (snapshot and snapshot['version'] == version):
+            return
+        timestamp, data = await db.get_snapshot(version)
+    data = json.loads(data)
+
+    # build everything before swapping it in so readers never see a partial snapshot
+    snapshot = {
+        'version': version,
+        'timestamp': timestamp,
+        'total': data.get('total'),
+        'ranks': {tuple(key.split(':')): _make_ranking(rows) for key, rows in data['ranks'].items()},
+        'subs': {after: _make_subs(rows) for after, rows in data['subs'].items()},
+        'stats': data['stats'],
+        # snapshots published before the hourly rollups have no series, their graphs fall back to queries
+        'graph': {(after, series['resolution']): _make_graph(series['rows'], series['epoch'], series['now'],
+                                                             series['resolution'])
+                  for after, series in data.get('series', {}).items()},
+    }
+    print('Loaded snapshot {}.'.format(version))
+
+
+async def warm_up():
+    """Load the latest snapshot and votes and compute every standard window so first requests are served warm."""
+    start = perf_counter()
+    await refresh_snapshot()
+    async with pool.acquire() as db:
+        await counters.load(db)
+        if columns is not None:
+            await columns.refresh(db, counters.total)
+    calls = [get_ranking('1y', 'hot')]
+    for after in WINDOWS:
+        calls += [get_ranking(after, sort) for sort in ['top', 'controversial']]
+        calls += [get_stats(after), get_subs(after), get_graph(after)]
+    await asyncio.gather(*calls)
+    print('Warmed up {} windows in {:.2f}s.'.format(len(WINDOWS), perf_counter() - start))
+
+
+async def watch_updates():
+    """Poll for new snapshots and votes added by the ingester until cancelled."""
+    while True:
+        try:
+            await refresh_snapshot()
+            async with pool.acquire() as db:
+                await counters.load(db)
+                if columns is not None:
+                    await columns.refresh(db, counters.total)
+        except Exception as e:
+            print(e)
+        await asyncio.sleep(SNAPSHOT_POLL)
+
+
+def get_data_version():
+    """Get a version that changes with every snapshot and vote along with the time of the last change."""
+    version = snapshot['version'] if snapshot else 0
+    updated = max(snapshot['timestamp'] if snapshot else 0, counters.latest[''] or 0)
+    return '{}-{}-{}'.format(version, counters.total, counters.latest[''] or 0), updated
+
+
+def get_cache_version():
+    """Get the version of the data cached results are computed from, the same in every worker once it polls."""
+    return snapshot['version'] if snapshot else 0
+
+
+def _snapshot_is_current():
+    """Check that the snapshot is recent and holds every vote this worker knows of."""
+    if snapshot is None or time() - snapshot['timestamp'] > SNAPSHOT_MAX_AGE:
+        return False
+    # snapshots published before the running total are compared by the time of the newest vote
+    if snapshot['total'] is None:
+        return snapshot['timestamp'] >= (counters.latest[''] or 0)
+    return snapshot['total'] >= counters.total
+
+
+def _from_snapshot(kind, key):
+    """Get a precomputed result if a current snapshot has one."""
+    result = None
+    if _snapshot_is_current():
+        result = snapshot[kind].get(key)
+    CACHE_REQUESTS.inc('snapshot', 'miss' if result is None else 'hit')
+    return result
+
+
+async def get_ranking(after='1y', sort='top'):
+    """Get the full ranking for a window along with an index of its ranks by bot name."""
+    if sort not in SORTS:
+        sort = 'top'
+    if sort == 'hot':
+        after = '1y'
+    after = normalize_after(after)
+    ranking = _from_snapshot('ranks', (after, sort))
+    if ranking is None:
+        ranking = _index_ranking((after, sort), await _get_ranking(after, sort))
+    return ranking
+
+
+async def get_ranks(after='1y', sort='top', bot=None, limit=None, cursor=None):
+    ranks, bots = await get_ranking(after, sort)
+    if bot:
+        return [bots[bot]] if bot in bots else []
+    return _limit(_after_cursor(ranks, cursor), limit)
+
+
+def rank_to_dict(rank):
+    return {
+        'rank': rank.rank,
+        'name': rank.name,
+        'score': rank.score,
+        'votes': {'good': rank.good, 'bad': rank.bad},
+        'karma': {'link': rank.link, 'comment': rank.comment},
+    }
+
+
+async def export_ranks(after='1y', sort='top', cursor=None):
+    """Get a ranking as chunks of newline delimited json."""
+    ranks = await get_ranks(after, sort, cursor=cursor)
+
+    def chunks():
+        for i in range(0, len(ranks), EXPORT_CHUNK_SIZE):
+            yield ''.join(json.dumps(rank_to_dict(rank)) + '\n' for rank in ranks[i:i + EXPORT_CHUNK_SIZE])
+
+    return chunks()
+
+
+@cached(ttl=TTL, version=get_cache_version)
+async def _get_ranking(after, sort):
+    epoch = get_epoch(after)
+    if columns is not None and columns.loaded:
+        return _make_ranks(columns.get_ranks(epoch, sort))
+    async with pool.acquire() as db:
+        rows = await db.get_ranks(epoch, sort)
+    return _make_ranks(rows)
+
+
+async def get_stats(after='1y', vote=None):
+    after = normalize_after(after)
+    vote_type = vote.value if vote else ''
+    window = _from_snapshot('stats', after)
+    if window is None:
+        window = await _get_window_stats(after)
+    return _make_stats(counters.latest[vote_type], window['count'][vote_type], window['bots'])
+
+
+@cached(ttl=TTL, version=get_cache_version)
+async def _get_window_stats(after):
     epoch = get_epoch(after)
-    db = DB(DB_FILE)
-    subs = []
-    await db.connect()
-    data = await db.get_subs(epoch, limit)
-    async for row in data:
-        sub = Sub()
-        sub.name = row[0]
-        votes = Votes()
-        votes.good = row[1]
-        votes.bad = row[2]
-        sub.votes = votes
-        subs.append(sub)
-    await db.close()
-    return subs
-
-
-@cached(ttl=TTL, serializer=PickleSerializer())
-async def get_graph(after='1y'):
+    async with pool.acquire() as db:
+        count = await db.get_vote_counts(epoch)
+    # every ranked bot has the minimum number of votes, so the cached ranking is also the bot count
+    ranks = await _get_ranking(after, 'top')
+    return {'count': count, 'bots': len(ranks)}
+
+
+async def get_subs(after='1y', limit=None):
+    after = normalize_after(after)
+    subs = _from_snapshot('subs', after)
+    if subs is None:
+        subs = await _get_subs(after)
+    return _limit(subs, limit)
+
+
+@cached(ttl=TTL, version=get_cache_version)
+async def _get_subs(after):
     epoch = get_epoch(after)
-    db = DB(DB_FILE)
-    await db.connect()
-
-    results = {}
-    if 'd' in after:
-        for i in range(24):
-            results[str(i)] = {'good_votes': 0, 'bad_votes': 0}
-        data = await db.get_timeline_data(epoch, '%H')
-        async for row in data:
-            key, good_votes, bad_votes = row
-            results[str(int(key))] = {'good_votes': good_votes, 'bad_votes': bad_votes}
-
-    elif 'w' in after:
-        days_of_week = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
-        for day in days_of_week:
-            results[day] = {'good_votes': 0, 'bad_votes': 0}
-        data = await db.get_timeline_data(epoch, '%w')
-        async for row in data:
-            key, good_votes, bad_votes = row
-            results[days_of_week[int(key)]] = {'good_votes': good_votes, 'bad_votes': bad_votes}
-
-    elif 'M' in after:
-        for i in range(31):
-            results[str(i)] = {'good_votes': 0, 'bad_votes': 0}
-        data = await db.get_timeline_data(epoch, '%d')
-        async for row in data:
-            key, good_votes, bad_votes = row
-            results[str(int(key))] = {'good_votes': good_votes, 'bad_votes': bad_votes}
-
-    else:
-        months_of_year = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
-                          'October', 'November', 'December']
-        for month in months_of_year:
-            results[month] = {'good_votes': 0, 'bad_votes': 0}
-        data = await db.get_timeline_data(epoch, '%m')
-        async for row in data:
-            key, good_votes, bad_votes = row
-            results[months_of_year[int(key) - 1]] = {'good_votes': good_votes, 'bad_votes': bad_votes}
-
-    graph = Graph()
-    graph.labels = []
-    graph.votes = []
-    for key in results:
-        good_votes = results[key]['good_votes']
-        bad_votes = results[key]['bad_votes']
-        graph.labels.append(key)
-        votes = Votes()
-        votes.good = good_votes
-        votes.bad = bad_votes
-        graph.votes.append(votes)
-
-    await db.close()
+    async with pool.acquire() as db:
+        rows = await db.get_subs(epoch)
+    return _make_subs(rows)
+
+
+async def get_graph(after='1y', resolution=None):
+    after = normalize_after(after)
+    resolution = resolution or default_resolution(after)
+    # every window is a new cache key, so long series are rejected before anything is computed for them
+    if resolution not in BUCKETS:
+        raise ValueError('Unknown resolution {}'.format(resolution))
+    try:
+        epoch = get_epoch(after)
+    except OverflowError:
+        raise ValueError('Window {} is too long'.format(after))
+    if count_buckets(epoch, int(time()), resolution) > MAX_BUCKETS:
+        raise ValueError('A graph of {} has more than {} {} buckets, use a coarser resolution'.format(
+            after, MAX_BUCKETS, resolution))
+    graph = _from_snapshot('graph', (after, resolution))
+    if graph is None:
+        graph = await _get_graph(after, resolution)
     return graph
+
+
+@cached(ttl=TTL, version=get_cache_version)
+async def _get_graph(after, resolution):
+    epoch = get_epoch(after)
+    async with pool.acquire() as db:
+        rows = await db.get_timeline(epoch, resolution)
+    return _make_graph(rows, epoch, int(time()), resolution)
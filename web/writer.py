@@ -0,0 +1,117 @@
+import asyncio
+import re
+import sqlite3
+from time import perf_counter
+
+FLUSH_INTERVAL = 0.05
+FLUSH_SIZE = 100
+# Reddit usernames the votes are counted for
+PARENT_REGEX = re.compile(r'^[\w-]+$')
+
+
+class VoteWriter:
+    """Write-behind queue that coalesces api votes into batched transactions."""
+
+    def __init__(self, pool, interval=FLUSH_INTERVAL, size=FLUSH_SIZE):
+        self.pool = pool
+        self.interval = interval
+        self.size = size
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._pending = []
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    async def add(self, vote, vote_type):
+        """Queue a vote and wait until it is written, raising IntegrityError if its id already exists."""
+        # reject ids that are not base36 and missing bots before they can fail a whole batch
+        int(vote.id, 36)
+        if not vote.parent or not PARENT_REGEX.match(vote.parent):
+            raise ValueError('Invalid parent {!r}'.format(vote.parent))
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((vote, vote_type, future))
+        self._ready.set()
+        if len(self._pending) >= self.size:
+            self._full.set()
+        await future
+
+    async def flush(self):
+        """Write one batch of pending votes."""
+        batch = self._pending[:self.size]
+        del self._pending[:self.size]
+        start = perf_counter()
+        try:
+            await self._write(batch)
+        finally:
+            self.flushes += 1
+            self.last_flush_latency = perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+    async def _write(self, batch):
+        try:
+            async with self.pool.acquire() as db:
+                inserted = await db.add_votes([(vote, vote_type) for vote, vote_type, future in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # the failed transaction was rolled back, so each vote is retried alone and only the bad ones fail
+                print('Could not write a batch of {} votes, writing them one at a time: {}'.format(len(batch), e))
+                for item in batch:
+                    await self._write([item])
+                return
+            for vote, vote_type, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (vote, vote_type, future), new in zip(batch, inserted):
+            if future.done():
+                continue
+            if new:
+                future.set_result(None)
+            else:
+                future.set_exception(sqlite3.IntegrityError('UNIQUE constraint failed: votes.id'))
+
+    async def _run(self):
+        while not self._stopping:
+            await self._ready.wait()
+            if len(self._pending) < self.size and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._ready.clear()
+            self._full.clear()
+            while self._pending:
+                await self.flush()
+
+    def start(self):
+        # a stopped writer can be started again, such as by each lifespan of an app in the same process
+        self._stopping = False
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Write every queued vote, letting a batch that is being written finish instead of cancelling it."""
+        self._stopping = True
+        self._ready.set()
+        self._full.set()
+        if self._task:
+            await self._task
+        while self._pending:
+            await self.flush()
+
+    def status(self):
+        return {
+            'depth': self.depth,
+            'flushes': self.flushes,
+            'last_flush_ms': round(self.last_flush_latency * 1000, 3),
+            'max_flush_ms': round(self.max_flush_latency * 1000, 3),
+        }